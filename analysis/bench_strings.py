@@ -0,0 +1,70 @@
+"""
+Times checkModel.strings() against the character at a time implementation it replaced, on
+marshaled code objects like the ones pulled out of Lambda layers. The payload is built by
+compiling the analysis scripts over and over until it reaches the requested size.
+
+    python bench_strings.py --size 8 --repeat 3
+"""
+import marshal
+import string
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from checkModel import strings
+
+
+def legacy_strings(encoded_code, min=4):
+    encoded_code = encoded_code.decode("latin1")
+    result = ""
+    for c in encoded_code:
+        if c in string.printable:
+            result += c
+            continue
+        if len(result) >= min:
+            yield result
+        result = ""
+    if len(result) >= min:
+        yield result
+
+
+def marshaled_payload(size_mb):
+    sources = [path.read_text() for path in sorted(Path(__file__).parent.glob("*.py"))]
+    chunks = []
+    total = 0
+    while total < size_mb * 1024 * 1024:
+        for source in sources:
+            chunk = marshal.dumps(compile(source, "<lambda>", "exec"))
+            chunks.append(chunk)
+            total += len(chunk)
+    return b"".join(chunks)
+
+
+def best_of(repeat, extract, payload):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        found = sum(1 for _ in extract(payload))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, found
+
+
+def main():
+    parser = ArgumentParser(description="benchmark strings() on marshaled code")
+    parser.add_argument("--size", type=float, default=4, help="payload size in MB")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    payload = marshaled_payload(args.size)
+    print(f"payload: {len(payload) / 1024 / 1024:.1f} MB of marshaled code")
+    legacy, legacy_found = best_of(args.repeat, legacy_strings, payload)
+    regex, regex_found = best_of(args.repeat, strings, memoryview(payload))
+    assert legacy_found == regex_found, "implementations disagree"
+    print(f"legacy strings(): {legacy:.3f}s ({legacy_found} strings)")
+    print(f"regex strings():  {regex:.3f}s ({regex_found} strings)")
+    print(f"speedup: {legacy / regex:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Structured analysis of the marshaled code objects that keras stores in Lambda layers. Rather
+than printing a disassembly, every code object in the payload (nested functions, lambdas and
+comprehensions included) is walked with dis.get_instructions and the interesting parts are
+collected into a json friendly dict: modules imported, global names loaded, dotted attribute
+chains like os.system, string constants and any URLs in them.
+
+Marshal is tied to the Python version that wrote it, so payloads from other versions can fail
+to load or disassemble; that's reported as an error in the result rather than raised.
+"""
+import base64
+import copy
+import dis
+import hashlib
+import marshal
+import re
+from collections import OrderedDict
+from types import CodeType
+from typing import Any, Dict, List, Optional, Set, Union
+from collections.abc import Generator
+
+URL_PATTERN = re.compile(r"(?:https?|ftp)://[^\s'\"<>|`()]+")
+MAX_CONSTANTS = 200
+MAX_CONSTANT_LENGTH = 512
+CACHE_SIZE = 1024
+
+LOAD_GLOBAL_OPS = {"LOAD_GLOBAL", "LOAD_NAME"}
+LOAD_LOCAL_OPS = {"LOAD_FAST", "LOAD_DEREF", "LOAD_CLOSURE", "LOAD_FAST_CHECK"}
+ATTRIBUTE_OPS = {"LOAD_ATTR", "LOAD_METHOD"}
+STORE_OPS = {"STORE_FAST", "STORE_NAME", "STORE_GLOBAL", "STORE_DEREF"}
+CALL_OPS = {"CALL", "CALL_FUNCTION", "CALL_FUNCTION_KW", "CALL_METHOD"}
+
+_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+
+def iter_code_objects(code: CodeType) -> Generator[CodeType, None, None]:
+    """Yields code and every code object nested in its constants, depth first."""
+    stack = [code]
+    while stack:
+        current = stack.pop()
+        yield current
+        stack.extend(
+            const for const in reversed(current.co_consts) if isinstance(const, CodeType)
+        )
+
+
+def constant_text(const: Any) -> Optional[str]:
+    if isinstance(const, str):
+        return const
+    if isinstance(const, bytes):
+        return const.decode("latin1")
+    return None
+
+
+class BytecodeSummary:
+    """Accumulates what's found across all the code objects of one payload."""
+
+    def __init__(self) -> None:
+        self.imports: Set[str] = set()
+        self.globals: Set[str] = set()
+        self.attributes: Set[str] = set()
+        self.constants: List[str] = []
+        self.urls: Set[str] = set()
+        self.functions: List[str] = []
+        self.errors: List[str] = []
+        self.constants_truncated = False
+
+    def add_constant(self, text: str) -> None:
+        self.urls.update(URL_PATTERN.findall(text))
+        if len(self.constants) >= MAX_CONSTANTS:
+            self.constants_truncated = True
+            return
+        text = text[:MAX_CONSTANT_LENGTH]
+        if text not in self.constants:
+            self.constants.append(text)
+
+    def walk(self, code: CodeType) -> None:
+        self.functions.append(code.co_name)
+        for const in code.co_consts:
+            text = constant_text(const)
+            if text:
+                self.add_constant(text)
+        try:
+            instructions = list(dis.get_instructions(code))
+        except Exception as e:
+            self.errors.append(f"could not disassemble {code.co_name}: {e}")
+            return
+
+        # names bound by an import, so "import os as o; o.system" still reads as os.system
+        aliases: Dict[str, str] = {}
+        chain: Optional[str] = None
+        last_import: Optional[str] = None
+        # __import__("os") with a constant name counts as importing os
+        dynamic_import: Optional[str] = None
+        for instruction in instructions:
+            op = instruction.opname
+            name = instruction.argval if isinstance(instruction.argval, str) else None
+            if op == "LOAD_CONST" and chain == "__import__" and name:
+                self.imports.add(name)
+                dynamic_import = name
+                chain = None
+                continue
+            if op in CALL_OPS and dynamic_import:
+                chain = dynamic_import
+                dynamic_import = None
+                continue
+            if op == "IMPORT_NAME" and name:
+                self.imports.add(name)
+                last_import = name
+                chain = name
+                continue
+            if op == "IMPORT_FROM" and name and last_import:
+                self.imports.add(f"{last_import}.{name}")
+                chain = f"{last_import}.{name}"
+                continue
+            if op in STORE_OPS and name and chain and last_import:
+                aliases[name] = chain
+                chain = None
+                continue
+            if op in LOAD_GLOBAL_OPS and name:
+                self.globals.add(name)
+                chain = aliases.get(name, name)
+                last_import = None
+                continue
+            if op in LOAD_LOCAL_OPS and name:
+                chain = aliases.get(name)
+                last_import = None
+                continue
+            if op in ATTRIBUTE_OPS and name and chain:
+                chain = f"{chain}.{name}"
+                self.attributes.add(chain)
+                continue
+            if op in {"PRECALL", "CACHE", "EXTENDED_ARG", "NOP", "PUSH_NULL"}:
+                continue
+            if op != "POP_TOP":
+                last_import = None
+            chain = None
+            dynamic_import = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        result = {
+            "imports": sorted(self.imports),
+            "globals": sorted(self.globals),
+            "attributes": sorted(self.attributes),
+            "constants": self.constants,
+            "urls": sorted(self.urls),
+            "functions": self.functions,
+        }
+        if self.constants_truncated:
+            result["constants_truncated"] = True
+        if self.errors:
+            result["errors"] = self.errors
+        return result
+
+
+def analyze_payload(payload: bytes) -> Dict[str, Any]:
+    """Analyzes a raw (already base64 decoded) marshaled code object."""
+    try:
+        code = marshal.loads(payload)
+    except Exception as e:
+        return {"errors": [f"could not unmarshal payload: {e}"]}
+    if not isinstance(code, CodeType):
+        return {"errors": [f"payload is a {type(code).__name__}, not a code object"]}
+    summary = BytecodeSummary()
+    for nested in iter_code_objects(code):
+        summary.walk(nested)
+    return summary.as_dict()
+
+
+def decode_payload(encoded_code: Union[str, bytes]) -> bytes:
+    return base64.b64decode(encoded_code)
+
+
+def analyze_encoded(
+    encoded_code: Union[str, bytes], payload: Optional[bytes] = None
+) -> Dict[str, Any]:
+    """Analyzes a base64 encoded Lambda payload, caching results by the payload's sha256 so
+    the same function showing up in many models is only analyzed once. Pass the decoded
+    payload if the caller already has it.
+    """
+    if payload is None:
+        payload = decode_payload(encoded_code)
+    digest = hashlib.sha256(payload).hexdigest()
+    cached = _cache.get(digest)
+    if cached is None:
+        cached = analyze_payload(payload)
+        cached["sha256"] = digest
+        _cache[digest] = cached
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    else:
+        _cache.move_to_end(digest)
+    return copy.deepcopy(cached)
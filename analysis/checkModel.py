@@ -1,20 +1,43 @@
+import asyncio
 import json
 from pathlib import Path
 import logging
 import requests
-from tensorflow.python.keras.protobuf.saved_metadata_pb2 import SavedMetadata
+import requests.adapters
+from saved_metadata import scan_nodes
+from h5_remote import fetch_root_attribute
+from hf_blobs import HF_ENDPOINT, remote_blob, same_file
+from bytecode import analyze_encoded, decode_payload
+from yara_rules import RULE_SCOPES, RULES_ENV, SCOPE_ENV, load_rules, rule_scope
+from verdict_cache import (
+    CACHE_ENV,
+    CACHE_TABLE_ENV,
+    DEFAULT_CACHE,
+    file_digests,
+    fingerprint,
+    open_cache,
+    payload_digest,
+)
+from lambda_layers import (
+    DEFAULT_MAX_BYTES,
+    DEFAULT_MAX_LAYERS,
+    LambdaExtractor,
+    layer_regions,
+    summarize,
+)
 from optparse import OptionParser
 from datetime import datetime
 import os
-import dis
-import codecs
-import marshal
-import base64
-import string
+import random
+import re
 import sys
 import h5py
 import shutil
-from typing import Union, Dict, Any
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit
+from functools import lru_cache, partial
+from typing import Union, Dict, Any, Iterable, List, Optional
 from collections.abc import Generator
 
 # output config
@@ -27,45 +50,63 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
-def gather_file(remote_model: str, api_token: str, directory: str) -> Union[Path, str]:
-    """Attempts to assess a repo on huggingface and download any h5 or keras_metadata.pb 
-    files found within it. Returns either an error string or a Path object.
+def pick_keras_file(siblings: List[Dict[str, Any]]) -> str:
+    """Picks the keras_metadata.pb file out of a repo's siblings, or an h5 file if there isn't
+    one. Returns an empty string if neither is present.
     """
-    filename = ""
     pb_filename = ""
     h5_filename = ""
-    api_token = api_token
-    url = f"https://huggingface.co/api/models/?id={remote_model}&full=full"
+    for file in siblings:
+        if "keras_metadata.pb" in file["rfilename"]:
+            pb_filename = file["rfilename"]
+        elif file["rfilename"].endswith(".h5"):
+            h5_filename = file["rfilename"]
+    return pb_filename or h5_filename
+
+
+def find_keras_file(remote_model: str, api_token: str) -> str:
+    """Asks huggingface which files are in a repo and picks the keras_metadata.pb file, or an
+    h5 file if there isn't one. Returns an empty string if neither is present.
+    """
+    url = f"{HF_ENDPOINT}/api/models/?id={remote_model}&full=full"
 
     headers = {"Authorization": f"Bearer {api_token}"}
 
     response = requests.request("GET", url, headers=headers)
     hf_model = response.json()
+    return pick_keras_file(hf_model[0]["siblings"])
 
-    for file in hf_model[0]["siblings"]:
-        if "keras_metadata.pb" in file["rfilename"]:
-            pb_filename = file["rfilename"]
-        elif file["rfilename"].endswith(".h5"):
-            h5_filename = file["rfilename"]
 
-    if pb_filename:
-        filename = pb_filename
-    elif h5_filename:
-        filename = h5_filename
+def gather_file(
+    remote_model: str, api_token: str, directory: str, filename: Optional[str] = None
+) -> Union[Path, str]:
+    """Attempts to assess a repo on huggingface and download any h5 or keras_metadata.pb 
+    files found within it. Returns either an error string or a Path object.
+    """
+    headers = {"Authorization": f"Bearer {api_token}"}
+    if filename is None:
+        filename = find_keras_file(remote_model, api_token)
 
     if filename:
         downloadLoc = Path(f"{directory}/{remote_model}/{filename}")
         downloadLoc.parent.mkdir(parents=True, exist_ok=True)
-        downloadLink = f"https://huggingface.co/{remote_model}/resolve/main/{filename}"
+        if downloadLoc.is_file():
+            # a copy left over from an earlier run only needs downloading again if it changed
+            sha256, git_oid = file_digests(downloadLoc)
+            blob = remote_blob(remote_model, filename, api_token)
+            if same_file(blob, {"sha256": sha256, "git_oid": git_oid}):
+                logger.info((f"{downloadLoc} is already up to date, not downloading it again"))
+                return downloadLoc
+        downloadLink = f"{HF_ENDPOINT}/{remote_model}/resolve/main/{filename}"
         logger.info((f"Attempting to download: {downloadLink}"))
         try:
             with requests.get(downloadLink, headers=headers, stream=True) as r:
-                if response.status_code == 401:
+                if r.status_code == 401:
                     logger.error(
                         f"!!! Unfortunately, we're not authorized to retrieve {remote_model}"
                     )
                     downloadLoc = "UNAUTHORIZED"
-                elif response.status_code == 200:
+                elif r.status_code == 200:
                     with open(downloadLoc, "wb") as resultFile:
                         shutil.copyfileobj(r.raw, resultFile)
                         logger.info((f"Wrote file to {downloadLoc}"))
@@ -82,49 +123,110 @@ def gather_file(remote_model: str, api_token: str, directory: str) -> Union[Path
         logger.info("Couldn't find a keras metadata file for this repo!")
 
 
-def check_pb_for_code(local_file: Path, id: str) -> Dict[str, Any]:
-    """Looks for the presence of a lambda layer within a keras_metadata.pb metadata file. 
-    If a layer is found, attempts to pull out the embedded code. Returns a dictionary
-    describing the model assessed. 
+def match_signatures(
+    metadata: Dict[str, Any],
+    lambda_layers: List[Dict[str, Any]],
+    extractor: LambdaExtractor,
+    buffer: Union[str, bytes, None] = None,
+    path: Union[Path, str, None] = None,
+) -> Dict[str, Any]:
+    """Runs the yara rules and records the ones that fired in the metadata dictionary under
+    "yara_matches". In the default "lambda" scope every rule is evaluated against each Lambda
+    layer's config and decoded payload on its own; in the "file" scope against the whole file
+    (mmap'd) like a yara run, or the metadata buffer when there's no local file. Does nothing
+    when no rules directory can be found.
+    """
+    rules = load_rules()
+    if rules is None:
+        return metadata
+    if rule_scope() == "lambda":
+        matches = rules.match_regions(layer_regions(lambda_layers, extractor.configs))
+    elif path is not None:
+        matches = rules.match_file(path)
+    else:
+        if isinstance(buffer, str):
+            buffer = buffer.encode("utf-8")
+        matches = rules.match(buffer or b"")
+    metadata["yara_matches"] = matches
+    for match in matches:
+        logger.info((f"YARA: {metadata['id']} matched {match['rule']} on {match['strings']}"))
+    return metadata
+
+
+def check_pb_for_code(
+    local_file: Path,
+    id: str,
+    max_layers: int = DEFAULT_MAX_LAYERS,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+) -> Dict[str, Any]:
+    """Looks for the presence of lambda layers within a keras_metadata.pb metadata file. 
+    Every lambda layer found is reported along with its embedded code, up to a per-model
+    budget of layers and code bytes. Returns a dictionary describing the model assessed. 
     """
     metadata = {"id": id, "type": "pb"}
-    saved_metadata = SavedMetadata()
     logger.info((f"Checking {local_file} for keras lambda layer"))
+    extractor = LambdaExtractor(max_layers=max_layers, max_bytes=max_bytes)
     try:
-        with open(local_file, "rb") as f:
-            saved_metadata.ParseFromString(f.read())
-        lambda_code = [
-            layer["config"]["function"]["items"][0]
-            for layer in [
-                json.loads(node.metadata)
-                for node in saved_metadata.nodes
-                if node.identifier == "_tf_keras_layer"
-            ]
-            if layer["class_name"] == "Lambda"
-        ]
-        for code in lambda_code:
-            logger.info((f"Found code in {local_file}: "))
-            logger.info((f"CODE: {code}"))
-        code = lambda_code[0]
-        metadata["extracted_encoded_code"] = code
-        metadata["contains_code"] = True
-        return metadata
-    # If we don't find a lambda layer, the above check will give an IndexError that we can assume
-    # that the model does not contain a Lambda layer
-    except IndexError as ie:
-        metadata["contains_code"] = False
-        logger.info((f"Didn't find code in {local_file}"))
-        return metadata
+        lambda_layers = []
+        # only layers whose metadata mentions "Lambda" ever get json decoded, but every node
+        # walked counts against the layer budget
+        for index, node_metadata in scan_nodes(local_file):
+            if extractor.exhausted():
+                logger.info((f"Stopped early, {local_file} hit the extraction limit"))
+                break
+            if node_metadata is None:
+                extractor.skip_layer()
+                continue
+            lambda_layers.extend(extractor.from_layer(json.loads(node_metadata), index, nested=False))
+        for layer in lambda_layers:
+            logger.info((f"Found code in {local_file} layer {layer['name']}: "))
+            logger.info((f"CODE: {layer['encoded_code']}"))
+        if not lambda_layers:
+            logger.info((f"Didn't find code in {local_file}"))
+        metadata.update(summarize(lambda_layers, extractor))
+        return match_signatures(metadata, lambda_layers, extractor, path=local_file)
     except Exception as e:
-        logger.info((f"We had a non-index error analyzing {local_file} : {e}"))
+        logger.info((f"We had an error analyzing {local_file} : {e}"))
         return metadata
 
 
-def check_h5_for_code(local_file: str, id: str) -> Dict[str, Any]:
-    """Looks for the presence of a lambda layer within an h5 model file. 
-    If a layer is found, attempts to pull out the embedded code. Definitely
-    will only work for Keras Tensorflow models saved using .save().
-    Returns a dictionary describing the model assessed. 
+def check_model_config(
+    model_config: Union[str, bytes],
+    metadata: Dict[str, Any],
+    source: str,
+    max_layers: int = DEFAULT_MAX_LAYERS,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+    path: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Pulls every lambda layer out of a keras model_config json blob, like the one stored
+    as a root attribute of h5 models, and adds what was found to the metadata dictionary.
+    path is the local file the blob came from, if there is one.
+    """
+    extractor = LambdaExtractor(max_layers=max_layers, max_bytes=max_bytes)
+    lambda_layers = list(extractor.from_model_config(json.loads(model_config)))
+    for layer in lambda_layers:
+        logger.info((f"Found code in {source} layer {layer['name']}: "))
+        logger.info((f"CODE: {layer['encoded_code']}"))
+    if not lambda_layers:
+        logging.info(f"Didn't find code in {source}")
+    if extractor.truncated:
+        logging.info(f"Stopped early, {source} hit the extraction limit")
+    metadata.update(summarize(lambda_layers, extractor))
+    return match_signatures(
+        metadata, lambda_layers, extractor, buffer=model_config, path=path
+    )
+
+
+def check_h5_for_code(
+    local_file: str,
+    id: str,
+    max_layers: int = DEFAULT_MAX_LAYERS,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+) -> Dict[str, Any]:
+    """Looks for the presence of lambda layers within an h5 model file, including inside
+    nested models. Every lambda layer found is reported along with its embedded code, up to
+    a per-model budget of layers and code bytes. Definitely will only work for Keras
+    Tensorflow models saved using .save(). Returns a dictionary describing the model assessed. 
     """
     metadata = {"id": id, "type": "h5"}
     logger.info((f"********* Checking {local_file} for keras lambda layer *********"))
@@ -133,24 +235,14 @@ def check_h5_for_code(local_file: str, id: str) -> Dict[str, Any]:
             # models saved with .save will contain a "model_config" attribute. Keras documentation
             # encourages this saving method in that this is the most consistent way to embed serialized code
             if "model_config" in list(f.attrs.keys()):
-                try:
-                    lambda_code = [
-                        layer.get("config", {}).get("function", {})
-                        for layer in json.loads(f.attrs["model_config"])["config"][
-                            "layers"
-                        ]
-                        if layer["class_name"] == "Lambda"
-                    ]
-                    code = lambda_code[0][0]
-                    logger.info((f"Found code in {local_file}: "))
-                    logger.info((f"CODE: {code}"))
-                    metadata["contains_code"] = True
-                    metadata["extracted_encoded_code"] = code
-                    return metadata
-                except IndexError as ie:
-                    logging.info(f"Didn't find code in {local_file}")
-                    metadata["contains_code"] = False
-                    return metadata
+                return check_model_config(
+                    f.attrs["model_config"],
+                    metadata,
+                    local_file,
+                    max_layers=max_layers,
+                    max_bytes=max_bytes,
+                    path=local_file,
+                )
             else:
                 metadata["contains_code"] = False
                 logging.info(
@@ -163,29 +255,527 @@ def check_h5_for_code(local_file: str, id: str) -> Dict[str, Any]:
         )
         return metadata
     except Exception as e:
-        logging.error(f"!!! We had a non-index error analyzing {local_file} : {e}")
+        logging.error(f"!!! We had an error analyzing {local_file} : {e}")
     return metadata
 
 
-def strings(encoded_code: bytes, min=4) -> Generator[str, None, None]:
+def check_remote_h5_for_code(
+    remote_model: str,
+    filename: str,
+    api_token: str,
+    max_layers: int = DEFAULT_MAX_LAYERS,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+) -> Optional[Dict[str, Any]]:
+    """Reads just the model_config attribute of an h5 file on huggingface using range requests
+    and looks for lambda layers in it, without downloading any weights. Returns None when the
+    attribute can't be located this way, in which case the whole file should be downloaded.
+    """
+    metadata = {"id": remote_model, "type": "h5", "header_only": True}
+    link = f"{HF_ENDPOINT}/{remote_model}/resolve/main/{filename}"
+    logger.info((f"********* Reading the model config of {link} *********"))
+    model_config = fetch_root_attribute(
+        link, "model_config", headers={"Authorization": f"Bearer {api_token}"}
+    )
+    if model_config is None:
+        return None
+    try:
+        return check_model_config(
+            model_config, metadata, link, max_layers=max_layers, max_bytes=max_bytes
+        )
+    except Exception as e:
+        logging.error(f"!!! We had an error analyzing the model config of {link} : {e}")
+        return None
+
+
+def verdict_settings(limits: Dict[str, int]) -> str:
+    """Fingerprint of everything besides the file itself that a model's verdict depends on."""
+    rules = load_rules()
+    return fingerprint(
+        {"max_layers": DEFAULT_MAX_LAYERS, "max_bytes": DEFAULT_MAX_BYTES, **limits},
+        rule_scope(),
+        rules.digest if rules else None,
+    )
+
+
+# extensions check_model_file knows how to assess, for -f and batch mode alike
+MODEL_EXTENSIONS = (".pb", ".h5")
+
+
+def check_model_file(
+    local_file: Union[Path, str], id: str, **limits: int
+) -> Dict[str, Any]:
+    """Hands a local model file to the matching extractor based on its extension, passing
+    along any max_layers/max_bytes extraction limits. Verdicts are cached by the file's
+    sha256, so a byte identical file under another repo isn't parsed again. Returns an empty
+    dictionary for files we don't know how to assess.
+    """
+    file_path = str(local_file)
+    if not file_path.endswith(MODEL_EXTENSIONS):
+        return {}
+    cache = open_cache(verdict_settings(limits))
+    try:
+        sha256, git_oid = file_digests(local_file)
+    except OSError as e:
+        logger.error(f"!!! Couldn't read {local_file}: {e}")
+        sha256, git_oid, cache = None, None, None
+    if cache is not None:
+        cached = cache.get_file(sha256=sha256)
+        if cached is not None:
+            logger.info((f"Reusing the verdict for {local_file}, sha256 {sha256}"))
+            cached["id"] = id
+            return cached
+
+    if not file_path.endswith(".h5"):
+        results = check_pb_for_code(local_file, id, **limits)
+    else:
+        results = check_h5_for_code(local_file, id, **limits)
+    if sha256 is not None:
+        results["sha256"] = sha256
+        results["git_oid"] = git_oid
+    # files that couldn't be analyzed don't get a verdict, they're retried next time
+    if cache is not None and "contains_code" in results:
+        cache.put_file(sha256, git_oid, {k: v for k, v in results.items() if k != "id"})
+    return results
+
+
+def cached_remote_verdict(
+    remote_model: str,
+    filename: str,
+    api_token: str,
+    limits: Dict[str, int],
+    session: Optional[requests.Session] = None,
+) -> Optional[Dict[str, Any]]:
+    """Pre-flight check before downloading a model: HEADs the file on huggingface for its
+    sha256 or git blob id and returns the cached verdict for that file, if there is one.
     """
-    Attempts to find printable strings >= 4 characters in length. Approximates
-    Unix strings capability, but a lot more brittle. 
+    cache = open_cache(verdict_settings(limits))
+    if cache is None:
+        return None
+    blob = remote_blob(remote_model, filename, api_token, session=session)
+    if blob is None:
+        return None
+    verdict = cache.get_file(**blob)
+    if verdict is None:
+        return None
+    logger.info((f"{remote_model}/{filename} matches a verdict we already have, not downloading it"))
+    verdict["id"] = remote_model
+    return verdict
+
+
+def analyze_payload(encoded_code: str, id: str) -> Dict[str, Any]:
+    """Walks the bytecode of one extracted payload and pulls printable strings out of it.
+    Returns what's found under "bytecode" and "string_list". The analysis is cached by the
+    sha256 of the decoded payload, since the same lambda shows up in many models.
     """
     try:
-        encoded_code = encoded_code.decode("latin1")
-    except UnicodeDecodeError as e:
-        logger.error("Unable to decode blob as text!")
-    result = ""
-    for c in encoded_code:
-        if c in string.printable:
-            result += c
+        decoded_code = decode_payload(encoded_code)
+    except ValueError as e:
+        logger.error(f"!!! Extracted code in {id} isn't valid base64: {e}")
+        return {}
+    cache = open_cache(fingerprint())
+    digest = payload_digest(decoded_code)
+    cached = cache.get("payload", digest) if cache is not None else None
+    if cached is not None:
+        logger.info(f"Reusing the analysis of payload {digest} for {id}")
+        return cached
+    analysis = {"bytecode": analyze_encoded(encoded_code, payload=decoded_code)}
+    for error in analysis["bytecode"].get("errors", []):
+        logger.error(f"!!! Unfortunately, dis struggled with {id}: {error}")
+    for field in ("imports", "attributes", "urls"):
+        if analysis["bytecode"].get(field):
+            logger.info(f"{field.upper()}: {analysis['bytecode'][field]}")
+    logger.info(f"********* Attempting to find strings for {id}: *********")
+    sl = list(strings(decoded_code))
+    if len(sl) > 0:
+        analysis["string_list"] = sl
+        logger.info(f"Found strings in {id}:")
+        logger.info(f"STRINGS: {sl}")
+    else:
+        logger.info(f"Could not find any printable strings in {id}!")
+    if cache is not None:
+        cache.put("payload", digest, analysis)
+    return analysis
+
+
+def analyze_code(results: Dict[str, Any]) -> Dict[str, Any]:
+    """Analyzes the code of every Lambda layer extracted from a model with analyze_payload,
+    adding what's found to that layer's entry in results["lambda_layers"]. Named functions
+    aren't code and are left alone.
+    """
+    for layer in results.get("lambda_layers", []):
+        if not layer.get("encoded_code") or layer.get("function_type") != "lambda":
             continue
-        if len(result) >= min:
-            yield result
-        result = ""
-    if len(result) >= min: 
-        yield result
+        logger.info(
+            f"********* Trying to analyze extracted code in {results['id']} layer {layer['name']}: *********"
+        )
+        layer.update(analyze_payload(layer["encoded_code"], results["id"]))
+    return results
+
+
+def find_model_files(directory: str) -> Generator[str, None, None]:
+    """Walks a directory tree and yields every .pb or .h5 file in it, the same files -f
+    accepts."""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(MODEL_EXTENSIONS):
+                yield os.path.join(root, name)
+
+
+def read_manifest(manifest: str) -> Generator[str, None, None]:
+    """Yields the local paths or author/repo ids listed one per line in a manifest file, or
+    on stdin when the manifest is "-". Blank lines and lines starting with # are skipped.
+    """
+    with (open(manifest, "r") if manifest != "-" else sys.stdin) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+
+def remove_download(downloaded_file: Union[Path, str], directory: str) -> None:
+    """Deletes a downloaded model and any directories left empty beneath the download directory."""
+    os.remove(downloaded_file)
+    top = Path(directory).resolve()
+    parent = Path(downloaded_file).resolve().parent
+    while parent != top and top in parent.parents:
+        try:
+            parent.rmdir()
+        except OSError:
+            break
+        parent = parent.parent
+
+
+def scan_target(
+    target: str,
+    api_token: str = "",
+    directory: str = ".",
+    clean_up: bool = False,
+    limits: Optional[Dict[str, int]] = None,
+    header_only: bool = False,
+) -> Dict[str, Any]:
+    """Assesses a single batch entry, either a local model file or a huggingface repo id.
+    Runs inside a pool worker, so any failure is recorded in the results rather than raised.
+    """
+    limits = limits or {}
+    try:
+        if os.path.isfile(target):
+            return analyze_code(check_model_file(target, target, **limits))
+
+        filename = find_keras_file(target, api_token)
+        if filename:
+            results = cached_remote_verdict(target, filename, api_token, limits)
+            if results is not None:
+                return analyze_code(results)
+        if header_only and filename.endswith(".h5"):
+            results = check_remote_h5_for_code(target, filename, api_token, **limits)
+            if results is not None:
+                return analyze_code(results)
+
+        downloaded_file = gather_file(target, api_token, directory, filename=filename)
+        if downloaded_file is None:
+            return {"id": target, "error": "no keras model file found"}
+        if downloaded_file == "UNAUTHORIZED":
+            return {"id": target, "private": True}
+        results = analyze_code(check_model_file(downloaded_file, target, **limits))
+        if clean_up and os.path.exists(downloaded_file):
+            remove_download(downloaded_file, directory)
+        return results
+    except Exception as e:
+        logger.error(f"!!! We had an issue assessing {target}: {e}")
+        return {"id": target, "error": str(e)}
+
+
+def batch_scan(
+    targets: Iterable[str],
+    results_file: Optional[str],
+    workers: Optional[int] = None,
+    api_token: str = "",
+    directory: str = ".",
+    clean_up: bool = False,
+    limits: Optional[Dict[str, int]] = None,
+    header_only: bool = False,
+) -> int:
+    """Fans batch entries out to a pool of worker processes that stay alive across models, so
+    imports and interpreter startup are paid once per worker instead of once per model. Writes
+    one JSON line per model as results come back and returns the number of models assessed.
+    """
+    scan = partial(
+        scan_target,
+        api_token=api_token,
+        directory=directory,
+        clean_up=clean_up,
+        limits=limits,
+        header_only=header_only,
+    )
+    out = None
+    if results_file:
+        results_path = Path(results_file)
+        results_path.parent.mkdir(parents=True, exist_ok=True)
+        out = open(results_path, "a")
+    count = 0
+    try:
+        with multiprocessing.Pool(processes=workers) as pool:
+            for results in pool.imap_unordered(scan, targets):
+                count += 1
+                if out:
+                    out.write(json.dumps(results))
+                    out.write("\n")
+                    out.flush()
+                else:
+                    logger.info(json.dumps(results))
+    finally:
+        if out:
+            out.close()
+    logger.info(f"********* Batch scan assessed {count} models *********")
+    return count
+
+
+# statuses huggingface answers with when it wants us to back off
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_BACKOFF = 60.0
+
+
+def retry_after(headers: Any) -> Optional[float]:
+    """Seconds a 429/503 asked us to wait, when it says so in seconds."""
+    try:
+        return min(float(headers.get("Retry-After", "")), MAX_BACKOFF)
+    except (TypeError, ValueError):
+        return None
+
+
+def set_log_level(level: int) -> None:
+    """Lets remote_scan's analysis processes log at the same level as the scan itself."""
+    logger.setLevel(level)
+
+
+def analyze_downloaded(
+    downloaded_file: str, remote_model: str, limits: Dict[str, int]
+) -> Dict[str, Any]:
+    """Parse and code analysis of one downloaded model, run on remote_scan's process pool."""
+    try:
+        return analyze_code(check_model_file(downloaded_file, remote_model, **limits))
+    except Exception as e:
+        logger.error(f"!!! We had an issue assessing {remote_model}: {e}")
+        return {"id": remote_model, "error": str(e)}
+
+
+class RemoteScanner:
+    """Scans many huggingface repos as an overlapped asyncio pipeline: the api lookup and the
+    download of one repo run while others are being parsed and analyzed. requests does the
+    http on a thread pool, with a semaphore per host capping the connections to each one and
+    429/5xx answers retried with exponential backoff (or their Retry-After), outside the host
+    slot so a throttled host doesn't tie up a connection while we wait. Parsing and code
+    analysis happen on a process pool so they don't hold up the event loop.
+    """
+
+    def __init__(
+        self,
+        api_token: str = "",
+        directory: str = ".",
+        clean_up: bool = False,
+        limits: Optional[Dict[str, int]] = None,
+        header_only: bool = False,
+        concurrency: int = 32,
+        per_host: int = 8,
+        workers: Optional[int] = None,
+        attempts: int = 5,
+        backoff: float = 1.0,
+    ) -> None:
+        self.api_token = api_token
+        self.directory = directory
+        self.clean_up = clean_up
+        self.limits = limits or {}
+        self.header_only = header_only
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.workers = workers
+        self.attempts = attempts
+        self.backoff = backoff
+        self.headers = {"Authorization": f"Bearer {api_token}"} if api_token else {}
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=per_host)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.host_slots: Dict[str, asyncio.Semaphore] = {}
+
+    def host_slot(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self.host_slots:
+            self.host_slots[host] = asyncio.Semaphore(self.per_host)
+        return self.host_slots[host]
+
+    async def on_host(self, url: str, call, *args, **kwargs):
+        async with self.host_slot(url):
+            return await asyncio.to_thread(call, *args, **kwargs)
+
+    async def retrying(self, url: str, call, *args):
+        """Runs a blocking call that returns (status, headers, value) for url, retrying
+        connection errors and RETRY_STATUSES. Returns the last (status, headers, value).
+        """
+        for attempt in range(self.attempts):
+            try:
+                status, headers, value = await self.on_host(url, call, *args)
+            except requests.RequestException as e:
+                if attempt == self.attempts - 1:
+                    raise
+                status, headers, value = None, {}, e
+            if status is not None and (status not in RETRY_STATUSES or attempt == self.attempts - 1):
+                return status, headers, value
+            delay = retry_after(headers)
+            if delay is None:
+                delay = min(self.backoff * 2**attempt, MAX_BACKOFF)
+            logger.info((f"{url} answered {status or value}, retrying in {delay:.1f}s"))
+            await asyncio.sleep(delay * random.uniform(1, 1.5))
+        raise RuntimeError(f"gave up on {url}")
+
+    def get_json(self, url: str):
+        with self.session.get(url, headers=self.headers, timeout=60) as response:
+            value = response.json() if response.status_code == 200 else None
+            return response.status_code, response.headers, value
+
+    def download(self, url: str, destination: Path):
+        with self.session.get(url, headers=self.headers, stream=True, timeout=60) as response:
+            if response.status_code == 200:
+                with open(destination, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+            return response.status_code, response.headers, destination
+
+    async def scan(self, remote_model: str, analysis: ProcessPoolExecutor) -> Dict[str, Any]:
+        lookup = f"{HF_ENDPOINT}/api/models/?id={remote_model}&full=full"
+        status, _, listing = await self.retrying(lookup, self.get_json, lookup)
+        if status == 401:
+            return {"id": remote_model, "private": True}
+        if status != 200 or not listing:
+            return {"id": remote_model, "error": f"model lookup failed with {status}"}
+        filename = pick_keras_file(listing[0].get("siblings", []))
+        if not filename:
+            return {"id": remote_model, "error": "no keras model file found"}
+
+        link = f"{HF_ENDPOINT}/{remote_model}/resolve/main/{filename}"
+        results = await self.on_host(
+            link, cached_remote_verdict, remote_model, filename, self.api_token,
+            self.limits, session=self.session,
+        )
+        if results is None and self.header_only and filename.endswith(".h5"):
+            results = await self.on_host(
+                link, check_remote_h5_for_code, remote_model, filename, self.api_token,
+                **self.limits,
+            )
+        loop = asyncio.get_running_loop()
+        if results is not None:
+            return await loop.run_in_executor(analysis, analyze_code, results)
+
+        destination = Path(f"{self.directory}/{remote_model}/{filename}")
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        status, _, _ = await self.retrying(link, self.download, link, destination)
+        if status == 401:
+            return {"id": remote_model, "private": True}
+        if status != 200:
+            return {"id": remote_model, "error": f"download failed with {status}"}
+        results = await loop.run_in_executor(
+            analysis, analyze_downloaded, str(destination), remote_model, self.limits
+        )
+        if self.clean_up:
+            remove_download(destination, self.directory)
+        return results
+
+    async def guarded_scan(self, remote_model: str, analysis: ProcessPoolExecutor) -> Dict[str, Any]:
+        try:
+            return await self.scan(remote_model, analysis)
+        except Exception as e:
+            logger.error(f"!!! We had an issue assessing {remote_model}: {e}")
+            return {"id": remote_model, "error": str(e)}
+
+    async def run(self, repos: Iterable[str], out) -> int:
+        """Scans every repo with at most concurrency of them in flight, calling out with each
+        result as it's ready. Returns the number of repos scanned.
+        """
+        count = 0
+        repos = iter(repos)
+        # each repo in flight makes one blocking call at a time, plus one thread reading repos
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=self.concurrency + 1)
+        )
+        # forking once the download threads are running could copy a held lock into the child
+        context = multiprocessing.get_context("forkserver")
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=set_log_level,
+            initargs=(logger.level,),
+        ) as analysis:
+            in_flight = set()
+            while True:
+                # stdin can block for a while, so repos are read off the event loop
+                remote_model = await asyncio.to_thread(next, repos, None)
+                if remote_model is None:
+                    break
+                if len(in_flight) >= self.concurrency:
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        out(task.result())
+                        count += 1
+                in_flight.add(asyncio.create_task(self.guarded_scan(remote_model, analysis)))
+            for task in asyncio.as_completed(in_flight):
+                out(await task)
+                count += 1
+        return count
+
+
+def remote_scan(
+    repos: Iterable[str], results_file: Optional[str], **scanner_options: Any
+) -> int:
+    """Runs RemoteScanner over repos, writing one JSON line per repo as results come back."""
+    out = None
+    if results_file:
+        results_path = Path(results_file)
+        results_path.parent.mkdir(parents=True, exist_ok=True)
+        out = open(results_path, "a")
+
+    def write(results: Dict[str, Any]) -> None:
+        if out:
+            out.write(json.dumps(results))
+            out.write("\n")
+            out.flush()
+        else:
+            logger.info(json.dumps(results))
+
+    try:
+        count = asyncio.run(RemoteScanner(**scanner_options).run(repos, write))
+    finally:
+        if out:
+            out.close()
+    logger.info(f"********* Remote scan assessed {count} repos *********")
+    return count
+
+
+# the bytes string.printable covers: tab through carriage return and space through tilde
+PRINTABLE_BYTES = rb"\t-\r -~"
+
+
+@lru_cache(maxsize=None)
+def strings_pattern(min: int, encoding: str) -> "re.Pattern[bytes]":
+    if encoding == "s":
+        return re.compile(rb"[%s]{%d,}" % (PRINTABLE_BYTES, min))
+    if encoding == "l":
+        return re.compile(rb"(?:[%s]\x00){%d,}" % (PRINTABLE_BYTES, min))
+    raise ValueError(f"unsupported strings encoding {encoding!r}, expected 's' or 'l'")
+
+
+def strings(
+    encoded_code: Union[bytes, bytearray, memoryview], min=4, encoding: str = "s"
+) -> Generator[str, None, None]:
+    """
+    Attempts to find printable strings >= min characters in length, approximating Unix
+    strings. The regex runs straight over the buffer so nothing is copied but the matches.
+    encoding follows strings -e: "s" for single byte characters, "l" for UTF-16LE.
+    """
+    pattern = strings_pattern(min, encoding)
+    codec = "ascii" if encoding == "s" else "utf-16-le"
+    for match in pattern.finditer(encoded_code):
+        yield match.group().decode(codec)
 
 
 def main():
@@ -200,10 +790,20 @@ def main():
     - Unusual huggingface repo structures might behave oddly.
     - Not specifying a results file will result in results being written to std out.
     - Requesting a huggingface model without specifying a directory will write the file to the working directory
+    - Header only mode (-H) reads the model config of remote h5 files with range requests, falling back to a full download
+    - Batch mode (-s or -l) scans many models on a pool of worker processes and writes one json line per model
+    - Remote mode (-M) scans many huggingface repos, read from a file or stdin (-), downloading and analyzing them concurrently
+    - Remote mode retries 429s and 5xx with backoff and keeps at most --per_host connections open to each host
+    - The yara rules in the repo's yara directory are evaluated against every model unless --rules points elsewhere
+    - Rules are evaluated per lambda layer (config and decoded code) unless --rule_scope file asks for whole files
+    - Verdicts are cached by file and payload sha256 in ~/.cache/bhakti, so identical files are only analyzed once
     
 Examples:
     checkModel.py -m 'author/model' -r '/path/to/local/results/file' -d '/path/to/download/models' -a 'hugging_face_api_key' -c 'True'
-    checkModel.py -f '/path/to/local/model' -r '/path/to/local/results/file'"""
+    checkModel.py -f '/path/to/local/model' -r '/path/to/local/results/file'
+    checkModel.py -s '/path/to/model/corpus' -r '/path/to/local/results.jsonl' -w 8
+    checkModel.py -l '/path/to/manifest.txt' -r '/path/to/local/results.jsonl' -d '/path/to/download/models' -c 'True'
+    cat repos.txt | checkModel.py -M - -r '/path/to/local/results.jsonl' -d '/path/to/download/models' -c 'True' --concurrency 64"""
     parser = BhaktiParser(usage=usage, epilog=epilog)
     parser.add_option(
         "-m",
@@ -248,15 +848,129 @@ Examples:
         help="Set to true if you want to delete models that are downloaded",
         default="False",
     )
+    parser.add_option(
+        "-s",
+        "--scan_dir",
+        dest="scan_dir",
+        metavar="/path/to/model/corpus",
+        help="directory tree to recursively scan for .h5 and .pb files in batch mode",
+    )
+    parser.add_option(
+        "-l",
+        "--manifest",
+        dest="manifest",
+        metavar="/path/to/manifest.txt",
+        help="file listing local model paths or author/repo ids, one per line, to scan in batch mode",
+    )
+    parser.add_option(
+        "-M",
+        "--repos",
+        dest="repos",
+        metavar="/path/to/repos.txt",
+        help="file listing huggingface author/repo ids, one per line, or - for stdin, to scan concurrently",
+    )
+    parser.add_option(
+        "--concurrency",
+        dest="concurrency",
+        type="int",
+        default=32,
+        metavar="32",
+        help="number of repos in flight at once in remote mode",
+    )
+    parser.add_option(
+        "--per_host",
+        dest="per_host",
+        type="int",
+        default=8,
+        metavar="8",
+        help="number of connections to open to each host in remote mode",
+    )
+    parser.add_option(
+        "-w",
+        "--workers",
+        dest="workers",
+        type="int",
+        metavar="N",
+        help="number of worker processes to use in batch and remote mode, defaults to the number of cpus",
+    )
+    parser.add_option(
+        "-H",
+        "--header_only",
+        dest="header_only",
+        action="store_true",
+        default=False,
+        help="read only the model config of remote h5 files with range requests instead of downloading them",
+    )
+    parser.add_option(
+        "--max_layers",
+        dest="max_layers",
+        type="int",
+        default=DEFAULT_MAX_LAYERS,
+        metavar=str(DEFAULT_MAX_LAYERS),
+        help="stop extracting lambda layers from a model after walking this many layers, or keras_metadata.pb nodes",
+    )
+    parser.add_option(
+        "--max_bytes",
+        dest="max_bytes",
+        type="int",
+        default=DEFAULT_MAX_BYTES,
+        metavar=str(DEFAULT_MAX_BYTES),
+        help="stop extracting lambda layers from a model after collecting this many bytes of code",
+    )
+
+    parser.add_option(
+        "--rules",
+        dest="rules",
+        metavar="/path/to/yara",
+        help="yara rule file or directory of rules to evaluate, defaults to the repo's yara directory",
+    )
+
+    parser.add_option(
+        "--rule_scope",
+        dest="rule_scope",
+        type="choice",
+        choices=list(RULE_SCOPES),
+        metavar="|".join(RULE_SCOPES),
+        help="evaluate rules against each lambda layer (default) or against the whole file",
+    )
+
+    parser.add_option(
+        "--cache",
+        dest="cache",
+        metavar=str(DEFAULT_CACHE),
+        help="sqlite database to cache verdicts in by file and payload sha256",
+    )
+    parser.add_option(
+        "--cache_table",
+        dest="cache_table",
+        metavar="table",
+        help="dynamodb table to share cached verdicts through",
+    )
+    parser.add_option(
+        "--no_cache",
+        dest="no_cache",
+        action="store_true",
+        default=False,
+        help="analyze every file from scratch, neither reading nor writing cached verdicts",
+    )
 
     (options, args) = parser.parse_args()
 
-    if options.remote_model and options.local_model:
-        parser.error("specify either a local file or remote repo, but not both :)")
+    modes = [
+        options.remote_model,
+        options.local_model,
+        options.scan_dir,
+        options.manifest,
+        options.repos,
+    ]
+    if len([mode for mode in modes if mode]) > 1:
+        parser.error(
+            "specify only one of a local file, remote repo, scan directory, manifest, or repo list :)"
+        )
 
-    if not options.remote_model and not options.local_model:
+    if not any(modes):
         parser.error(
-            "Please specify at least one model to analyze using either [-m|--model] (remote) or [-f|--file] (local)"
+            "Please specify at least one model to analyze using either [-m|--model] (remote), [-f|--file] (local), [-s|--scan_dir] or [-l|--manifest] (batch) or [-M|--repos] (remote)"
         )
 
     if options.remote_model and not options.dir:
@@ -264,21 +978,70 @@ Examples:
             "No results directory specified, fetching remote model to working directory..."
         )
 
-    if not options.hf_api_key and options.remote_model:
+    hf_api_key = ""
+    if not options.hf_api_key and (options.remote_model or options.repos):
         logger.info(
             "No api key provided but requesting model, trying to download without authorization"
         )
-        hf_api_key = ""
     elif options.hf_api_key:
         hf_api_key = options.hf_api_key
 
+    limits = {"max_layers": options.max_layers, "max_bytes": options.max_bytes}
+
+    if options.rules:
+        # set in the environment so batch mode's pool workers pick the same rules up
+        os.environ[RULES_ENV] = options.rules
+    if options.rule_scope:
+        os.environ[SCOPE_ENV] = options.rule_scope
+    if options.cache:
+        os.environ[CACHE_ENV] = options.cache
+    if options.cache_table:
+        os.environ[CACHE_TABLE_ENV] = options.cache_table
+    if options.no_cache:
+        os.environ[CACHE_ENV] = ""
+        os.environ[CACHE_TABLE_ENV] = ""
+    if load_rules() is None:
+        logger.info("No yara rules found, skipping signature matching")
+
+    if options.scan_dir or options.manifest:
+        if options.scan_dir:
+            targets = find_model_files(options.scan_dir)
+        else:
+            targets = read_manifest(options.manifest)
+        batch_scan(
+            targets,
+            options.results_file,
+            workers=options.workers,
+            api_token=hf_api_key,
+            directory=options.dir or ".",
+            clean_up=options.clean_up.lower() in ["true", "1"],
+            limits=limits,
+            header_only=options.header_only,
+        )
+        return
+
+    if options.repos:
+        if options.concurrency < 1 or options.per_host < 1:
+            parser.error("--concurrency and --per_host need to be at least 1")
+        remote_scan(
+            read_manifest(options.repos),
+            options.results_file,
+            api_token=hf_api_key,
+            directory=options.dir or ".",
+            clean_up=options.clean_up.lower() in ["true", "1"],
+            limits=limits,
+            header_only=options.header_only,
+            concurrency=options.concurrency,
+            per_host=options.per_host,
+            workers=options.workers,
+        )
+        return
+
+    results = {}
+    downloaded_file = None
     if options.local_model:
         local_model = options.local_model
-        results = {}
-        if not local_model.endswith(".h5") and local_model.endswith(".pb"):
-            results = check_pb_for_code(local_model, local_model)
-        elif local_model.endswith(".h5"):
-            results = check_h5_for_code(local_model, local_model)
+        results = check_model_file(local_model, local_model, **limits)
 
     elif options.remote_model:
         remote_model = options.remote_model
@@ -287,33 +1050,22 @@ Examples:
             directory = options.dir
         else:
             directory = "."
-        downloaded_file = gather_file(remote_model, api_token, directory)
-        file_path = str(downloaded_file)
-        if downloaded_file != "UNAUTHORIZED":
-            if not file_path.endswith(".h5") and file_path.endswith(".pb"):
-                results = check_pb_for_code(downloaded_file, remote_model)
-            elif file_path.endswith(".h5"):
-                results = check_h5_for_code(downloaded_file, remote_model)
-
-    if code := results.get("extracted_encoded_code"):
-        logger.info(
-            f"********* Trying to disassemble extracted code layer in {results['id']}: *********"
-        )
-        try:
-            dis.dis(marshal.loads(codecs.decode(code.encode("ascii"), "base64")))
-        except Exception as e:
-            logger.error(f"!!! Unfortunately, dis struggled with {results['id']}: {e}")
-        logger.info(
-            f"********* Attempting to find strings for {results['id']}: *********"
-        )
-        decoded_code = base64.b64decode(code)
-        sl = list(strings(decoded_code))
-        if len(sl) > 0:
-            results["string_list"] = sl
-            logger.info(f"Found strings in {results['id']}:")
-            logger.info(f"STRINGS: {sl}")
-        else:
-            logger.info(f"Could not find any printable strings in {results['id']}!")
+        filename = find_keras_file(remote_model, api_token)
+        if filename:
+            results = cached_remote_verdict(remote_model, filename, api_token, limits) or {}
+        if not results and options.header_only and filename.endswith(".h5"):
+            results = check_remote_h5_for_code(
+                remote_model, filename, api_token, **limits
+            )
+        if not results:
+            downloaded_file = gather_file(
+                remote_model, api_token, directory, filename=filename
+            )
+            file_path = str(downloaded_file)
+            if downloaded_file != "UNAUTHORIZED":
+                results = check_model_file(file_path, remote_model, **limits)
+
+    analyze_code(results)
 
     if options.results_file:
         results_file = options.results_file
@@ -329,7 +1081,7 @@ Examples:
         logger.info(results)
 
     clean_up = options.clean_up
-    if clean_up.lower() in ["true", "1"] and options.remote_model:
+    if clean_up.lower() in ["true", "1"] and options.remote_model and downloaded_file:
         os.remove(downloaded_file)
         parent_dir = remote_model.split("/")[0]
         if options.dir:
@@ -0,0 +1,331 @@
+"""
+Reads the model_config attribute out of a remote .h5 model with HTTP Range requests, so we
+don't have to download gigabytes of weights to look at a few KB of json. Only enough of the
+HDF5 format is understood to get from the superblock to the root group's object header and
+decode a compact string attribute stored there. Anything fancier (dense attribute storage,
+shared messages, odd datatypes) raises H5RemoteError and callers fall back to downloading
+the whole file.
+
+See https://docs.hdfgroup.org/hdf5/develop/_f_m_t3.html for the layouts referenced below.
+"""
+import logging
+import struct
+from typing import Dict, Optional, Tuple
+
+import requests
+
+logger = logging.getLogger()
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+MSG_ATTRIBUTE = 0x000C
+MSG_CONTINUATION = 0x0010
+MSG_ATTRIBUTE_INFO = 0x0015
+
+DATATYPE_STRING = 3
+DATATYPE_VLEN = 9
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_MAX_FETCH = 32 * 1024 * 1024
+# seconds to connect, and to wait on each read
+DEFAULT_TIMEOUT = (10, 60)
+
+
+class H5RemoteError(Exception):
+    """Raised when the attribute can't be located with range requests alone."""
+
+
+class RangeReader:
+    """Reads byte ranges of a remote file, fetching and caching aligned blocks so the many
+    small reads done while walking HDF5 structures only cost a handful of requests.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        session: Optional[requests.Session] = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        max_fetch: int = DEFAULT_MAX_FETCH,
+        timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+    ) -> None:
+        self.url = url
+        self.headers = dict(headers or {})
+        self.session = session or requests.Session()
+        self.block_size = block_size
+        self.max_fetch = max_fetch
+        self.timeout = timeout
+        self.fetched = 0
+        self.size: Optional[int] = None
+        self._blocks: Dict[int, bytes] = {}
+
+    def _fetch(self, first_block: int, last_block: int) -> None:
+        start = first_block * self.block_size
+        end = (last_block + 1) * self.block_size - 1
+        if self.fetched + (end - start + 1) > self.max_fetch:
+            raise H5RemoteError(
+                f"read more than {self.max_fetch} bytes without finding the attribute"
+            )
+        headers = dict(self.headers)
+        headers["Range"] = f"bytes={start}-{end}"
+        with self.session.get(
+            self.url, headers=headers, stream=True, timeout=self.timeout
+        ) as response:
+            if response.status_code == 416:
+                for block in range(first_block, last_block + 1):
+                    self._blocks[block] = b""
+                return
+            if response.status_code != 206:
+                raise H5RemoteError(
+                    f"server answered a range request with {response.status_code}"
+                )
+            if response.history:
+                # Follow huggingface's redirect to the LFS store once, not on every read. The
+                # store URL is pre-signed, so our bearer token must not be sent along with it.
+                self.url = response.url
+                self.headers.pop("Authorization", None)
+            content_range = response.headers.get("Content-Range", "")
+            if "/" in content_range and not content_range.endswith("/*"):
+                self.size = int(content_range.rsplit("/", 1)[1])
+            data = response.content
+        self.fetched += len(data)
+        for block in range(first_block, last_block + 1):
+            offset = (block - first_block) * self.block_size
+            self._blocks[block] = data[offset : offset + self.block_size]
+
+    def read(self, offset: int, size: int) -> bytes:
+        if size <= 0:
+            return b""
+        first_block = offset // self.block_size
+        last_block = (offset + size - 1) // self.block_size
+        missing = [b for b in range(first_block, last_block + 1) if b not in self._blocks]
+        if missing:
+            self._fetch(missing[0], missing[-1])
+        data = b"".join(self._blocks[b] for b in range(first_block, last_block + 1))
+        start = offset - first_block * self.block_size
+        chunk = data[start : start + size]
+        if len(chunk) < size:
+            raise H5RemoteError(f"unexpected end of file reading {size} bytes at {offset}")
+        return chunk
+
+
+class H5Header:
+    """Just enough of an HDF5 file to find the attributes attached to its root group."""
+
+    def __init__(self, reader: RangeReader) -> None:
+        self.reader = reader
+        self.offset_size = 8
+        self.length_size = 8
+        self.base_address = 0
+        self.root_header_address = None
+        self._read_superblock()
+
+    def _uint(self, data: bytes, pos: int, size: int) -> int:
+        return int.from_bytes(data[pos : pos + size], "little")
+
+    def _read_superblock(self) -> None:
+        # the superblock sits at 0 or, after a user block, at the next power of two from 512
+        location = 0
+        while True:
+            head = self.reader.read(location, 8)
+            if head == HDF5_SIGNATURE:
+                break
+            location = 512 if location == 0 else location * 2
+            if location > 64 * 1024:
+                raise H5RemoteError("couldn't find an HDF5 superblock")
+        block = self.reader.read(location, 128)
+        version = block[8]
+        if version in (0, 1):
+            self.offset_size = block[13]
+            self.length_size = block[14]
+            pos = 24 if version == 0 else 28
+            o = self.offset_size
+            self.base_address = self._uint(block, pos, o)
+            # skip the free-space, end of file and driver info addresses to reach the root
+            # group symbol table entry, whose second field is the object header address
+            root_entry = pos + 4 * o
+            self.root_header_address = self._uint(block, root_entry + o, o)
+        elif version in (2, 3):
+            self.offset_size = block[9]
+            self.length_size = block[10]
+            o = self.offset_size
+            self.base_address = self._uint(block, 12, o)
+            self.root_header_address = self._uint(block, 12 + 3 * o, o)
+        else:
+            raise H5RemoteError(f"unsupported superblock version {version}")
+
+    def address(self, relative: int) -> int:
+        return self.base_address + relative
+
+    def _messages_v1(self, address: int, length: int):
+        data = self.reader.read(address, length)
+        pos = 0
+        while pos + 8 <= len(data):
+            msg_type, size, flags = struct.unpack_from("<HHB", data, pos)
+            yield msg_type, flags, data[pos + 8 : pos + 8 + size]
+            pos += 8 + size
+
+    def _messages_v2(self, data: bytes, pos: int, end: int, creation_order: bool):
+        header_size = 6 if creation_order else 4
+        while pos + header_size <= end:
+            msg_type = data[pos]
+            size, flags = struct.unpack_from("<HB", data, pos + 1)
+            pos += header_size
+            yield msg_type, flags, data[pos : pos + size]
+            pos += size
+
+    def root_messages(self):
+        """Yields (type, flags, data) for every message in the root group's object header,
+        following continuation blocks as they're found.
+        """
+        address = self.address(self.root_header_address)
+        prefix = self.reader.read(address, 16)
+        o, l = self.offset_size, self.length_size
+        pending = []
+        if prefix[:4] == b"OHDR":
+            flags = prefix[5]
+            pos = 6
+            if flags & 0x20:
+                pos += 16
+            if flags & 0x10:
+                pos += 4
+            size_width = 1 << (flags & 0x03)
+            head = self.reader.read(address, pos + size_width)
+            chunk_size = self._uint(head, pos, size_width)
+            pos += size_width
+            creation_order = bool(flags & 0x04)
+            chunk = self.reader.read(address, pos + chunk_size)
+            blocks = [(chunk, pos, pos + chunk_size)]
+            while blocks:
+                data, start, end = blocks.pop(0)
+                for msg_type, msg_flags, msg in self._messages_v2(data, start, end, creation_order):
+                    if msg_type == MSG_CONTINUATION:
+                        cont_address = self.address(self._uint(msg, 0, o))
+                        cont_length = self._uint(msg, o, l)
+                        cont = self.reader.read(cont_address, cont_length)
+                        if cont[:4] != b"OCHK":
+                            raise H5RemoteError("bad object header continuation block")
+                        # blocks end with a 4 byte checksum
+                        blocks.append((cont, 4, cont_length - 4))
+                    else:
+                        yield msg_type, msg_flags, msg
+        elif prefix[0] == 1:
+            header_size = self._uint(prefix, 8, 4)
+            pending.append((address + 16, header_size))
+            while pending:
+                block_address, block_length = pending.pop(0)
+                for msg_type, msg_flags, msg in self._messages_v1(block_address, block_length):
+                    if msg_type == MSG_CONTINUATION:
+                        pending.append(
+                            (self.address(self._uint(msg, 0, o)), self._uint(msg, o, l))
+                        )
+                    else:
+                        yield msg_type, msg_flags, msg
+        else:
+            raise H5RemoteError(f"unsupported object header version {prefix[0]}")
+
+    def root_attribute(self, name: str) -> bytes:
+        """Returns the raw value of a string attribute on the root group."""
+        dense = False
+        for msg_type, flags, msg in self.root_messages():
+            if msg_type == MSG_ATTRIBUTE_INFO:
+                heap_address = self._uint(msg, 2 + (2 if msg[1] & 0x01 else 0), self.offset_size)
+                dense = heap_address != (1 << (8 * self.offset_size)) - 1
+            elif msg_type == MSG_ATTRIBUTE and not flags & 0x02:
+                attr_name, datatype, dataspace, value = self._split_attribute(msg)
+                if attr_name == name:
+                    return self._string_value(datatype, dataspace, value)
+        if dense:
+            raise H5RemoteError("root attributes are in dense storage")
+        raise H5RemoteError(f"root group has no {name} attribute")
+
+    def _split_attribute(self, msg: bytes) -> Tuple[str, bytes, bytes, bytes]:
+        version = msg[0]
+        name_size, datatype_size, dataspace_size = struct.unpack_from("<HHH", msg, 2)
+        if version == 1:
+            # version 1 pads each field out to a multiple of 8 bytes
+            align = 8
+            pos = 8
+        elif version in (2, 3):
+            if msg[1] & 0x03:
+                raise H5RemoteError("shared attribute datatypes aren't supported")
+            align = 1
+            pos = 8 if version == 2 else 9
+        else:
+            raise H5RemoteError(f"unsupported attribute message version {version}")
+        name = msg[pos : pos + name_size].rstrip(b"\x00").decode("utf-8", "replace")
+        pos += -(-name_size // align) * align
+        datatype = msg[pos : pos + datatype_size]
+        pos += -(-datatype_size // align) * align
+        dataspace = msg[pos : pos + dataspace_size]
+        pos += -(-dataspace_size // align) * align
+        return name, datatype, dataspace, msg[pos:]
+
+    def _element_count(self, dataspace: bytes) -> int:
+        version, rank = dataspace[0], dataspace[1]
+        if version == 1:
+            pos = 8
+        elif version == 2:
+            if dataspace[3] == 2:
+                return 0
+            pos = 4
+        else:
+            raise H5RemoteError(f"unsupported dataspace version {version}")
+        count = 1
+        for i in range(rank):
+            count *= self._uint(dataspace, pos + i * self.length_size, self.length_size)
+        return count
+
+    def _string_value(self, datatype: bytes, dataspace: bytes, value: bytes) -> bytes:
+        if self._element_count(dataspace) != 1:
+            raise H5RemoteError("expected a scalar string attribute")
+        type_class = datatype[0] & 0x0F
+        size = self._uint(datatype, 4, 4)
+        if type_class == DATATYPE_STRING:
+            return value[:size].rstrip(b"\x00 ")
+        if type_class == DATATYPE_VLEN and datatype[1] & 0x0F == 1:
+            o = self.offset_size
+            length = self._uint(value, 0, 4)
+            collection = self._uint(value, 4, o)
+            index = self._uint(value, 4 + o, 4)
+            return self._global_heap_object(self.address(collection), index)[:length]
+        raise H5RemoteError(f"unsupported attribute datatype class {type_class}")
+
+    def _global_heap_object(self, address: int, index: int) -> bytes:
+        l = self.length_size
+        head = self.reader.read(address, 8 + l)
+        if head[:4] != b"GCOL":
+            raise H5RemoteError("bad global heap collection")
+        collection_size = self._uint(head, 8, l)
+        pos = address + 8 + l
+        end = address + collection_size
+        while pos + 8 + l <= end:
+            object_head = self.reader.read(pos, 8 + l)
+            object_index = self._uint(object_head, 0, 2)
+            object_size = self._uint(object_head, 8, l)
+            if object_index == 0:
+                break
+            if object_index == index:
+                return self.reader.read(pos + 8 + l, object_size)
+            pos += 8 + l + ((object_size + 7) & ~7)
+        raise H5RemoteError(f"global heap object {index} not found")
+
+
+def fetch_root_attribute(
+    url: str,
+    name: str = "model_config",
+    headers: Optional[Dict[str, str]] = None,
+    session: Optional[requests.Session] = None,
+) -> Optional[bytes]:
+    """Pulls a string attribute off the root group of a remote h5 file using range requests.
+    Returns None when the attribute can't be located this way so the caller can fall back to
+    downloading the whole file.
+    """
+    reader = RangeReader(url, headers=headers, session=session)
+    try:
+        value = H5Header(reader).root_attribute(name)
+        logger.info(f"Read {name} from {url} using {reader.fetched} bytes of range requests")
+        return value
+    except (H5RemoteError, IndexError, struct.error, requests.RequestException) as e:
+        logger.info(f"Couldn't read {name} from {url} with range requests: {e}")
+        return None
@@ -0,0 +1,74 @@
+"""
+Pre-flight lookups of what's in a huggingface file without downloading it. A HEAD request on
+the resolve url answers with the file's ETag: the sha256 of the content for LFS files (in
+X-Linked-Etag, next to the redirect to the CDN) and the git blob id for everything else. The
+same hashes are in the siblings of the ?blobs=true model api. Either one can be matched
+against the hashes recorded with a verdict, so a repo whose lastModified moved because of a
+README edit doesn't have its unchanged model file downloaded and analyzed again.
+"""
+import os
+import re
+from typing import Any, Dict, Optional
+
+import requests
+
+HF_ENDPOINT = os.getenv("HF_ENDPOINT", "https://huggingface.co").rstrip("/")
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+GIT_OID_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+HEAD_TIMEOUT = 10
+
+
+def parse_etag(etag: Optional[str]) -> Optional[Dict[str, str]]:
+    """Returns {"sha256": ...} or {"git_oid": ...} for an ETag holding either, else None."""
+    if not etag:
+        return None
+    etag = etag.strip()
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    etag = etag.strip('"').lower()
+    if SHA256_PATTERN.match(etag):
+        return {"sha256": etag}
+    if GIT_OID_PATTERN.match(etag):
+        return {"git_oid": etag}
+    return None
+
+
+def sibling_blob(sibling: Dict[str, Any]) -> Optional[Dict[str, str]]:
+    """Reads the hash out of a sibling from the ?blobs=true model api, if it has one."""
+    lfs = sibling.get("lfs")
+    if isinstance(lfs, dict) and lfs.get("sha256"):
+        return parse_etag(lfs["sha256"])
+    return parse_etag(sibling.get("blobId"))
+
+
+def remote_blob(
+    remote_model: str,
+    filename: str,
+    api_token: str = "",
+    session: Optional[requests.Session] = None,
+    revision: str = "main",
+) -> Optional[Dict[str, str]]:
+    """HEADs a file in a huggingface repo and returns its sha256 or git blob id. Returns None
+    when the hash can't be determined this way, in which case the file has to be downloaded.
+    """
+    link = f"{HF_ENDPOINT}/{remote_model}/resolve/{revision}/{filename}"
+    headers = {"Accept-Encoding": "identity"}
+    if api_token:
+        headers["Authorization"] = f"Bearer {api_token}"
+    try:
+        # LFS files redirect to the CDN, the hash is on the redirect itself
+        response = (session or requests).head(
+            link, headers=headers, allow_redirects=False, timeout=HEAD_TIMEOUT
+        )
+    except requests.RequestException:
+        return None
+    if response.status_code >= 400:
+        return None
+    return parse_etag(response.headers.get("X-Linked-Etag") or response.headers.get("ETag"))
+
+
+def same_file(blob: Optional[Dict[str, str]], verdict: Optional[Dict[str, Any]]) -> bool:
+    """Whether a remote blob is the file a verdict was made from."""
+    if not blob or not verdict:
+        return False
+    return any(verdict.get(kind) == digest for kind, digest in blob.items())
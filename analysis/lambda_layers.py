@@ -0,0 +1,160 @@
+"""
+Single pass extraction of every Lambda layer in a keras model config. Both the .h5
+model_config attribute and the per-layer metadata in keras_metadata.pb files are walked
+with the same extractor, which descends into nested Functional/Sequential models and
+wrapper layers and gives up once a per-model budget of layers or payload bytes is spent.
+"""
+import base64
+import binascii
+import json
+from typing import Any, Dict, List, Optional, Tuple
+from collections.abc import Generator
+
+DEFAULT_MAX_LAYERS = 10000
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+def encoded_payload(function: Any) -> Optional[str]:
+    """Pulls the serialized function out of a Lambda config. Keras stores lambdas as a
+    (code, defaults, closure) tuple, which shows up as {"class_name": "__tuple__", "items": [...]}
+    in keras_metadata.pb and as a plain list in h5 model configs. Named functions are a string.
+    """
+    if isinstance(function, dict):
+        function = function.get("items")
+    if isinstance(function, (list, tuple)):
+        function = function[0] if function else None
+    if isinstance(function, str):
+        return function
+    return None
+
+
+class LambdaExtractor:
+    """Walks layer configs and yields a description of each Lambda layer found. One extractor
+    should be used per model so the layer and byte budgets cover the whole model. A payload
+    bigger than what's left of the byte budget is cut short and flagged code_truncated. The raw
+    config of every Lambda layer yielded is kept in configs, in the same order.
+    """
+
+    def __init__(
+        self, max_layers: int = DEFAULT_MAX_LAYERS, max_bytes: int = DEFAULT_MAX_BYTES
+    ) -> None:
+        self.max_layers = max_layers
+        self.max_bytes = max_bytes
+        self.layers_seen = 0
+        self.bytes_seen = 0
+        self.truncated = False
+        self.configs: List[Dict[str, Any]] = []
+        self._index = -1
+
+    def exhausted(self) -> bool:
+        if self.layers_seen >= self.max_layers or self.bytes_seen >= self.max_bytes:
+            self.truncated = True
+        return self.truncated
+
+    def skip_layer(self) -> None:
+        """Counts a layer that was passed over without being decoded against the layer budget."""
+        self.layers_seen += 1
+
+    def from_model_config(
+        self, model_config: Dict[str, Any]
+    ) -> Generator[Dict[str, Any], None, None]:
+        """Yields the Lambda layers of a full model config, like the h5 model_config attribute."""
+        yield from self.from_layers(nested_layers(model_config))
+
+    def from_layers(self, layers: List[Any]) -> Generator[Dict[str, Any], None, None]:
+        for layer in layers:
+            if self.exhausted():
+                return
+            self._index += 1
+            yield from self.from_layer(layer, self._index)
+
+    def from_layer(
+        self, layer: Any, index: int, nested: bool = True
+    ) -> Generator[Dict[str, Any], None, None]:
+        """Yields the Lambda layers found in a single layer config, itself included. The index
+        is the layer's position in the walk for h5 configs or its node index in a pb file.
+        Pass nested=False for keras_metadata.pb nodes: the layers a node wraps or contains
+        are nodes of their own there, so descending into them would report them twice.
+        """
+        if not isinstance(layer, dict) or self.exhausted():
+            return
+        self.layers_seen += 1
+        config = layer.get("config")
+        if not isinstance(config, dict):
+            config = {}
+        if layer.get("class_name") == "Lambda":
+            code = encoded_payload(config.get("function"))
+            found = {
+                "name": config.get("name", layer.get("name")),
+                "index": index,
+                "function_type": config.get("function_type"),
+                "encoded_code": code,
+            }
+            if code is not None:
+                remaining = self.max_bytes - self.bytes_seen
+                if len(code) > remaining:
+                    # whole base64 quanta, so what's kept still decodes
+                    found["encoded_code"] = code = code[: remaining - remaining % 4]
+                    found["code_truncated"] = True
+                    self.truncated = True
+                self.bytes_seen += len(code)
+            self.configs.append(layer)
+            yield found
+        if not nested:
+            return
+        # Bidirectional, TimeDistributed and friends wrap a single layer
+        if isinstance(config.get("layer"), dict):
+            yield from self.from_layers([config["layer"]])
+        sublayers = nested_layers(layer)
+        if sublayers:
+            yield from self.from_layers(sublayers)
+
+
+def nested_layers(model_config: Any) -> List[Any]:
+    """Returns the layers of a Functional/Sequential config. Older Sequential models store
+    the layer list directly as their config.
+    """
+    if not isinstance(model_config, dict):
+        return []
+    config = model_config.get("config")
+    if isinstance(config, list):
+        return config
+    if isinstance(config, dict) and isinstance(config.get("layers"), list):
+        return config["layers"]
+    return []
+
+
+def summarize(
+    lambda_layers: List[Dict[str, Any]], extractor: LambdaExtractor
+) -> Dict[str, Any]:
+    """Builds the result fields describing the Lambda layers of a model. The first lambda
+    payload is still reported as extracted_encoded_code for anything keyed on it. Named
+    functions aren't code, so a model with only those has no extracted_encoded_code.
+    """
+    summary = {"contains_code": len(lambda_layers) > 0, "lambda_layers": lambda_layers}
+    if extractor.truncated:
+        summary["lambda_layers_truncated"] = True
+    codes = [
+        layer["encoded_code"]
+        for layer in lambda_layers
+        if layer["encoded_code"] and layer["function_type"] == "lambda"
+    ]
+    if codes:
+        summary["extracted_encoded_code"] = codes[0]
+    return summary
+
+
+def layer_regions(
+    lambda_layers: List[Dict[str, Any]], configs: List[Dict[str, Any]]
+) -> Generator[Tuple[str, List[bytes]], None, None]:
+    """Yields each Lambda layer's name with the bytes rules should be evaluated against for it:
+    its config as json and, when there is one, its decoded payload.
+    """
+    for layer, config in zip(lambda_layers, configs):
+        region = [json.dumps(config).encode("utf-8")]
+        if layer["encoded_code"]:
+            try:
+                region.append(base64.b64decode(layer["encoded_code"]))
+            except (binascii.Error, ValueError):
+                pass
+        yield layer["name"], region
@@ -0,0 +1,200 @@
+"""
+Serves a stand-in for the parts of the huggingface hub checkModel.py talks to (the model api,
+and GET and HEAD on resolve urls) so remote mode can be exercised and timed offline. Every
+request takes --latency seconds and --flaky of them are answered with a 429 or 503 first, to
+see the retries at work. Repos hold a keras_metadata.pb that's either benign or has a
+malicious lambda, some of them byte identical forks, and a few are private.
+
+    python local_hub.py --repos 200 --latency 0.2 --concurrency 1 8 32
+    python local_hub.py --serve --port 8800
+
+--serve just runs the hub and prints the repo ids, to point checkModel.py at by hand:
+
+    HF_ENDPOINT=http://127.0.0.1:8800 python checkModel.py -M repos.txt -r results.jsonl
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+FILENAME = "keras_metadata.pb"
+RESOLVE = "/resolve/main/"
+
+
+def git_oid(body):
+    return hashlib.sha1(f"blob {len(body)}\0".encode("utf-8") + body).hexdigest()
+
+
+def stub_repos(count):
+    """Every fourth repo has a malicious lambda, every fifth is a fork of an earlier one and
+    every tenth is private. Returns {repo id: (file body, private)}."""
+    # bench_rules imports checkModel, which reads HF_ENDPOINT when it's imported
+    from bench_rules import SHELL, dense, lambda_layer, model_config, saved_metadata
+
+    repos = {}
+    for i in range(count):
+        layers = [dense("dense", units=8 + i), dense("dense_1")]
+        if i % 4 == 0:
+            layers.append(lambda_layer("lambda", SHELL))
+        nodes = [("_tf_keras_network", model_config(layers))]
+        nodes += [("_tf_keras_layer", layer) for layer in layers]
+        body = saved_metadata(nodes)
+        if i % 5 == 4:
+            body = repos[f"author{(i - 4) % 13}/model-{i - 4}"][0]
+        repos[f"author{i % 13}/model-{i}"] = (body, i % 10 == 9)
+    return repos
+
+
+class StubHub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def answer(self):
+        hub = self.server
+        with hub.lock:
+            hub.active += 1
+            hub.peak = max(hub.peak, hub.active)
+        try:
+            self.respond()
+        finally:
+            with hub.lock:
+                hub.active -= 1
+
+    def respond(self):
+        hub = self.server
+        time.sleep(hub.latency)
+        with hub.lock:
+            hub.requests[self.command] = hub.requests.get(self.command, 0) + 1
+            throttled = hub.random.random() < hub.flaky
+            if throttled:
+                hub.requests["throttled"] = hub.requests.get("throttled", 0) + 1
+        if throttled:
+            return self.send(hub.random.choice([429, 503]), headers={"Retry-After": "0"})
+
+        parts = urlsplit(self.path)
+        if parts.path.rstrip("/") == "/api/models":
+            repo_id = parse_qs(parts.query).get("id", [""])[0]
+            if repo_id not in hub.repos:
+                return self.send(200, b"[]", {"Content-Type": "application/json"})
+            if hub.repos[repo_id][1]:
+                return self.send(401)
+            listing = [{"id": repo_id, "siblings": [{"rfilename": "README.md"}, {"rfilename": FILENAME}]}]
+            return self.send(200, json.dumps(listing).encode("utf-8"), {"Content-Type": "application/json"})
+
+        repo_id, _, filename = unquote(parts.path).lstrip("/").partition(RESOLVE)
+        if repo_id not in hub.repos or filename != FILENAME:
+            return self.send(404)
+        body, private = hub.repos[repo_id]
+        if private:
+            return self.send(401)
+        # small files aren't in LFS, so their ETag is the git blob id
+        self.send(200, body, {"ETag": f'"{git_oid(body)}"', "Content-Type": "application/octet-stream"})
+
+    do_GET = answer
+    do_HEAD = answer
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_stub_hub(port=0, latency=0.0, flaky=0.0, seed=0):
+    """Starts the hub on a local port with no repos yet. Returns the server; fill in
+    server.repos before sending it requests."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHub)
+    server.daemon_threads = True
+    server.repos = {}
+    server.latency = latency
+    server.flaky = flaky
+    server.random = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = {}
+    # the most requests that were being answered at once
+    server.active = 0
+    server.peak = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repos", type=int, default=100, help="repos on the stub hub")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds per request")
+    parser.add_argument("--flaky", type=float, default=0.1, help="fraction of requests throttled")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--per-host", type=int, default=8)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--serve", action="store_true", help="run the hub until interrupted")
+    args = parser.parse_args()
+
+    server = serve_stub_hub(args.port, args.latency, args.flaky)
+    endpoint = f"http://127.0.0.1:{server.server_port}"
+    os.environ["HF_ENDPOINT"] = endpoint
+    server.repos = stub_repos(args.repos)
+    if args.serve:
+        print(f"serving {len(server.repos)} repos on {endpoint}", flush=True)
+        print("\n".join(server.repos), flush=True)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            return
+
+    from checkModel import logger, remote_scan
+    from verdict_cache import CACHE_ENV, CACHE_TABLE_ENV
+
+    logger.setLevel(logging.WARNING)
+    # cached verdicts would skip the very downloads being timed
+    os.environ[CACHE_ENV] = ""
+    os.environ[CACHE_TABLE_ENV] = ""
+    # what each repo's result should say: private ones that they're private, the rest whether
+    # they have a lambda
+    expected = {
+        repo_id: ("private", True) if private else ("contains_code", b"lambda" in body)
+        for repo_id, (body, private) in server.repos.items()
+    }
+    print(f"{len(server.repos)} repos, {args.latency}s per request, {args.flaky:.0%} throttled")
+    for concurrency in args.concurrency:
+        server.requests = {}
+        server.peak = 0
+        with tempfile.TemporaryDirectory() as scratch:
+            results_file = os.path.join(scratch, "results.jsonl")
+            started = time.perf_counter()
+            remote_scan(
+                server.repos,
+                results_file,
+                directory=scratch,
+                clean_up=True,
+                concurrency=concurrency,
+                per_host=args.per_host,
+                backoff=0.05,
+            )
+            elapsed = time.perf_counter() - started
+            with open(results_file) as f:
+                results = {result["id"]: result for result in map(json.loads, f)}
+        wrong = [
+            repo_id for repo_id, (key, value) in expected.items() if results.get(repo_id, {}).get(key) != value
+        ]
+        print(
+            f"concurrency {concurrency:>3}: {elapsed:.2f}s, {len(results)} results, "
+            f"{len(wrong)} wrong, requests {server.requests}, at most {server.peak} at once"
+        )
+        for repo_id in wrong:
+            print(f"        {repo_id}: {results.get(repo_id)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-#!/opt/tensorflow/bin/python3
+#!/usr/bin/env python3
 
 import boto3
 from botocore.exceptions import ClientError
@@ -6,8 +6,17 @@ import json
 from pathlib import Path
 import logging
 import requests
-from tensorflow.python.keras.protobuf.saved_metadata_pb2 import SavedMetadata
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from saved_metadata import scan_nodes
+from lambda_layers import LambdaExtractor, layer_regions, summarize
+from bytecode import analyze_encoded, decode_payload
+from yara_rules import load_rules, rule_scope
+from verdict_cache import file_digests, fingerprint, open_cache, payload_digest
+from hf_blobs import HF_ENDPOINT, remote_blob, same_file, sibling_blob
 import subprocess
+import threading
+import time
 from datetime import datetime
 import os
 
@@ -17,9 +26,24 @@ HUGGINGFACE_TOKEN = os.getenv('HUGGINGFACE_TOKEN')
 MODEL_DIRECTORY='/tmp/models'
 DYNAMO_STATUS_TABLE  = os.getenv('DYNAMO_STATUS_TABLE')
 LOGGING_BUCKET = os.getenv('LOGGING_BUCKET')
+MAX_LAMBDA_LAYERS = int(os.getenv('MAX_LAMBDA_LAYERS', '10000'))
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '8'))
+# matches the monitoring queue's visibility timeout in the cdk stack
+VISIBILITY_TIMEOUT = int(os.getenv('VISIBILITY_TIMEOUT', '3600'))
+HEARTBEAT_SECONDS = int(os.getenv('HEARTBEAT_SECONDS', '120'))
+# how long an empty receive long polls before the worker decides the queue is drained
+RECEIVE_WAIT_SECONDS = int(os.getenv('RECEIVE_WAIT_SECONDS', '20'))
+# a message still in flight after this long stops being extended and goes back to the queue
+HEARTBEAT_MAX_AGE = int(os.getenv('HEARTBEAT_MAX_AGE', '3600'))
+# seconds to connect to huggingface, and to wait on each read of a download
+DOWNLOAD_TIMEOUT = (10, int(os.getenv('DOWNLOAD_TIMEOUT', '60')))
+# results land in a single dynamo item, which tops out at 400KB
+MAX_LAMBDA_BYTES = int(os.getenv('MAX_LAMBDA_BYTES', str(128 * 1024)))
+# verdicts by file sha256, locally and in a dynamo table shared by every worker
+VERDICT_CACHE = os.getenv('VERDICT_CACHE', '/tmp/bhakti-verdicts.sqlite3')
+VERDICT_TABLE = os.getenv('VERDICT_TABLE', '')
 
 logger = logging.getLogger()
-logging.basicConfig(filename='/var/log/bhakti.log', encoding='utf-8', level=logging.DEBUG)
 logger.setLevel(logging.INFO)
 
 def get_api_token(): 
@@ -28,6 +52,15 @@ def get_api_token():
     secret = get_secret_value_response['SecretString']
     return secret
 
+def get_http_session(pool_size=DOWNLOAD_WORKERS):
+    # one keep-alive connection per download thread, reused across models
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    return session
+
+http_session = get_http_session()
+
 def download_metadata_file(msg_body, token): 
     model = msg_body['id']
     filename = ''
@@ -38,7 +71,7 @@ def download_metadata_file(msg_body, token):
     
     downloadLoc = Path(f"{MODEL_DIRECTORY}/{model}/{filename}")
     downloadLoc.parent.mkdir(parents=True, exist_ok=True)    
-    downloadLink = f"https://huggingface.co/{model}/resolve/main/{filename}"
+    downloadLink = f"{HF_ENDPOINT}/{model}/resolve/main/{filename}"
     logger.info((f'TRYING: {downloadLink}'))
 
     headers = {
@@ -46,14 +79,15 @@ def download_metadata_file(msg_body, token):
     }
 
     try: 
-        response = requests.get(downloadLink, headers=headers)
-        if response.status_code == 401:
-            downloadLoc = describe_no_access(downloadLoc)
-            logger.info((f"Code 401: {downloadLoc}"))
-        elif response.status_code == 200: 
-            with open(downloadLoc, "wb") as resultFile:
-                resultFile.write(response.content)
-                logger.info((f'wrote file to {downloadLoc}'))
+        with http_session.get(downloadLink, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status_code == 401:
+                downloadLoc = describe_no_access(downloadLoc)
+                logger.info((f"Code 401: {downloadLoc}"))
+            elif response.status_code == 200: 
+                with open(downloadLoc, "wb") as resultFile:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        resultFile.write(chunk)
+                    logger.info((f'wrote file to {downloadLoc}'))
 
     except Exception as e:
         with open(f'{downloadLoc}-FAILED', 'w') as failed:
@@ -69,116 +103,370 @@ def describe_no_access(location):
         logger.info(("couldn't access model"))
     return f'{location}-GATED'
 
+def get_verdict_cache():
+    rules = load_rules()
+    settings = fingerprint(MAX_LAMBDA_LAYERS, MAX_LAMBDA_BYTES, rule_scope(), rules.digest if rules else None)
+    return open_cache(settings, path=VERDICT_CACHE, table=VERDICT_TABLE, region=AWS_REGION)
+
+def analyze_payload(encoded_code):
+    # the same lambda shows up in plenty of otherwise different models
+    cache = open_cache(fingerprint(), path=VERDICT_CACHE, table=VERDICT_TABLE, region=AWS_REGION)
+    try:
+        digest = payload_digest(decode_payload(encoded_code))
+    except ValueError as e:
+        logger.info((f'extracted code is not valid base64: {e}'))
+        return {'errors': [f'could not decode payload: {e}']}
+    bytecode = cache.get('bytecode', digest) if cache is not None else None
+    if bytecode is None:
+        bytecode = analyze_encoded(encoded_code)
+        if cache is not None:
+            cache.put('bytecode', digest, bytecode)
+    return bytecode
+
 def check_for_code(local_file):
-    metadata = {}
-    saved_metadata = SavedMetadata()
+    cache = get_verdict_cache()
+    try:
+        digest, git_oid = file_digests(local_file)
+    except OSError as e:
+        logger.info((f'We had an error reading {local_file} : {e}'))
+        return {}
+    if cache is not None:
+        cached = cache.get_file(sha256=digest)
+        if completed(cached):
+            logger.info((f'{local_file} is byte identical to a model we already analyzed, sha256 {digest}'))
+            return cached
+
+    metadata = {'sha256': digest, 'git_oid': git_oid}
     logger.info((f"******* Checking {local_file} for keras Lambda Layer *********"))
+    extractor = LambdaExtractor(max_layers=MAX_LAMBDA_LAYERS, max_bytes=MAX_LAMBDA_BYTES)
     try:
-        with open(local_file, 'rb') as f:
-            saved_metadata.ParseFromString(f.read())
-        lambda_code = [layer["config"]["function"]["items"][0]
-            for layer in [json.loads(node.metadata)
-                for node in saved_metadata.nodes
-                if node.identifier == "_tf_keras_layer"]
-            if layer["class_name"] == "Lambda"]
-        for code in lambda_code:
-            logger.info((f"found code in {local_file}: {code}"))
-            logger.info((f"CODE: {code}"))
-        code = lambda_code[0]
-        metadata['extracted_encoded_code'] = code
-        metadata['contains_code'] = True
-        return metadata
-    # If we don't find a lambda layer, the above check will give an IndexError that we can assume
-    # that the model does not contain a Lambda layer
-    except IndexError as ie:
-        metadata['contains_code'] = False
-        logger.info(("didn't find code"))
-        return metadata
+        lambda_layers = []
+        # only layers whose metadata mentions "Lambda" ever get json decoded, but every node
+        # walked counts against the layer budget
+        for index, node_metadata in scan_nodes(local_file):
+            if extractor.exhausted():
+                logger.info((f'stopped early, {local_file} hit the extraction limit'))
+                break
+            if node_metadata is None:
+                extractor.skip_layer()
+                continue
+            lambda_layers.extend(extractor.from_layer(json.loads(node_metadata), index, nested=False))
+        for layer in lambda_layers:
+            logger.info((f"found code in {local_file} layer {layer['name']}"))
+            logger.info((f"CODE: {layer['encoded_code']}"))
+        if not lambda_layers:
+            logger.info(("didn't find code"))
+        metadata.update(summarize(lambda_layers, extractor))
+        for layer in lambda_layers:
+            # named functions aren't code
+            if layer['encoded_code'] and layer['function_type'] == 'lambda':
+                bytecode = analyze_payload(layer['encoded_code'])
+                # the payload itself is already in the item, keep it under dynamo's 400KB item limit
+                bytecode.pop('constants', None)
+                layer['bytecode'] = bytecode
+        rules = load_rules()
+        if rules is not None:
+            # signature verdicts come along with the analysis instead of from a separate yara pass
+            if rule_scope() == 'lambda':
+                matches = rules.match_regions(layer_regions(lambda_layers, extractor.configs))
+            else:
+                matches = rules.match_file(local_file)
+            metadata['yara_matches'] = [match['rule'] for match in matches]
+        if 'extracted_encoded_code' in metadata:
+            # the payload is stored once per item, the layer it came from doesn't carry a copy
+            for layer in lambda_layers:
+                if layer['encoded_code'] == metadata['extracted_encoded_code']:
+                    del layer['encoded_code']
+                    break
     except Exception as e:
-        logger.info((f'We had a non-index error analyzing {local_file} : {e}'))
-        return metadata
+        # without the digests too, so the partial result can't pass for this file's verdict
+        logger.info((f'We had an error analyzing {local_file} : {e}'))
+        return {}
+    if cache is not None:
+        cache.put_file(digest, git_oid, metadata)
+    return metadata
 
-def update_dynamo(result):
-    result['model_type'] = 'protobuf' 
-    model = result["repo"]
+dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
+status_table = dynamodb.Table(DYNAMO_STATUS_TABLE)
 
-    dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
-    table = dynamodb.Table(DYNAMO_STATUS_TABLE)
-    
-    response = table.query(
+def count_versions(model):
+    # rows written before v0 carried a version count have to be counted the slow way
+    response = status_table.query(
         Select='COUNT',
         KeyConditionExpression='repo = :repo',
         ExpressionAttributeValues={':repo': model}
     )
+    return response['Count']
 
-    if response['Count'] > 0:
-        #get and preserve prior analysis
-        old_analysis = table.get_item(Key={'repo': model, 'version': 'v0'})
-        version = f"v{response['Count']}"
-        old_analysis['Item']['version'] = version
-        table.put_item(
-            Item = old_analysis['Item']
-        )
+def completed(analysis):
+    # an analysis that failed part way, or was written before it could, has no verdict yet
+    return analysis is not None and 'contains_code' in analysis
 
-        #update table with new data
-        result['version'] = 'v0'
-        addition_response = table.delete_item(Key={'repo': model, 'version': 'v0'})
-        table.put_item(
-            Item = result
-        )
-        logger.info((f'Added {result["repo"]} got code {addition_response["ResponseMetadata"]["HTTPStatusCode"]}'))
-
-    else:
-        logger.info((f'New model {result["repo"]} analyzed, adding to metadata store'))    
+def update_dynamo(result, attempts=5):
+    """Makes result the v0 row for its repo and archives the row it replaces as v{n}. Each row
+    for a repo counts its versions, so the archive and the new v0 go out in one transaction
+    conditioned on v0 not having changed since we read it. If another worker gets there
+    first we re-read and try again, unless it already stored a newer analysis than ours.
+    """
+    result['model_type'] = 'protobuf' 
+    model = result["repo"]
+    client = dynamodb.meta.client
+
+    for attempt in range(attempts):
+        current = status_table.get_item(Key={'repo': model, 'version': 'v0'}, ConsistentRead=True).get('Item')
         result['version'] = 'v0'
-        addition_response = table.put_item(
-            Item = result
-        )
-        logger.info((f'Added {result["repo"]} got code {addition_response["ResponseMetadata"]["HTTPStatusCode"]}'))
-
-sqs = boto3.resource('sqs', region_name=AWS_REGION)
-bhakti_queue = sqs.get_queue_by_name(
-    QueueName=SQS_QUEUE
-)
-api_token = get_api_token()
-
-scanning = True
-while scanning: 
-    sqs_messages = bhakti_queue.receive_messages(
-            MaxNumberOfMessages=1,
-            AttributeNames=["All"],
-            MessageAttributeNames=["All"],
-            WaitTimeSeconds=20,
-        )
-    if len(sqs_messages) == 0:
-        scanning = False
-    for sqs_message in sqs_messages:
-        body = sqs_message.body
-        msg_body = json.loads(body)
-        logger.info((f'SQS GIVING US {msg_body}'))
-        model = msg_body['id']
-
-        local_file = download_metadata_file(msg_body, api_token)
-        logger.info((local_file))
-        sqs_message.delete()
+
+        if current is None:
+            logger.info((f'New model {result["repo"]} analyzed, adding to metadata store'))    
+            result['version_count'] = 1
+            writes = [{'Put': {
+                'TableName': DYNAMO_STATUS_TABLE,
+                'Item': result,
+                'ConditionExpression': 'attribute_not_exists(repo)',
+            }}]
+        else:
+            if current.get('modified_date', '') > result['modified_date']:
+                logger.info((f'{model} already has a newer analysis than ours, skipping'))
+                return
+            if (result.get('sha256') and current.get('sha256') == result['sha256']
+                    and current.get('keras_filenam') == result['keras_filenam'] and completed(current)):
+                # the repo changed but its model file didn't, so the verdict hasn't either
+                logger.info((f'{model} has the same model file as before, moving v0 forward'))
+                try:
+                    status_table.update_item(
+                        Key={'repo': model, 'version': 'v0'},
+                        UpdateExpression='SET modified_date = :date',
+                        ConditionExpression='modified_date < :date',
+                        ExpressionAttributeValues={':date': result['modified_date']},
+                    )
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                        raise
+                return
+            versions = int(current.get('version_count') or count_versions(model))
+            archived = dict(current)
+            archived['version'] = f'v{versions}'
+            result['version_count'] = versions + 1
+            if 'version_count' in current:
+                unchanged = {
+                    'ConditionExpression': 'version_count = :versions',
+                    'ExpressionAttributeValues': {':versions': current['version_count']},
+                }
+            else:
+                unchanged = {'ConditionExpression': 'attribute_not_exists(version_count)'}
+            writes = [
+                {'Put': {
+                    'TableName': DYNAMO_STATUS_TABLE,
+                    'Item': archived,
+                    'ConditionExpression': 'attribute_not_exists(repo)',
+                }},
+                {'Put': dict(TableName=DYNAMO_STATUS_TABLE, Item=result, **unchanged)},
+            ]
+
+        try:
+            addition_response = client.transact_write_items(TransactItems=writes)
+            logger.info((f'Added {result["repo"]} got code {addition_response["ResponseMetadata"]["HTTPStatusCode"]}'))
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            logger.info((f'{model} was updated by another worker, retrying ({attempt + 1}/{attempts})'))
+    raise RuntimeError(f'Gave up updating {model} after {attempts} conflicting writes')
+
+def current_analysis(msg_body):
+    return status_table.get_item(
+        Key={'repo': msg_body['id'], 'version': 'v0'},
+        ProjectionExpression='modified_date, keras_filenam, sha256, git_oid',
+        ConsistentRead=True,
+    ).get('Item')
+
+def already_analyzed(msg_body, current):
+    """SQS only deduplicates within five minutes, so a revision can still be delivered again
+    after that. If v0 already holds an analysis of this revision of the same keras file
+    there's nothing left to do.
+    """
+    if current is None:
+        return False
+    return (current.get('modified_date', '') >= msg_body['lastModified']
+            and current.get('keras_filenam') == msg_body.get('keras_filename'))
+
+def known_verdict(msg_body, token, current):
+    """Pre-flight check before downloading: asks huggingface for the keras file's sha256 or git
+    blob id and returns a verdict we already have for that exact file, either the repo's own
+    v0 when only something else in the repo changed or a cached verdict from another repo.
+    Returns None when the file has to be downloaded and analyzed.
+    """
+    filename = msg_body.get('keras_filename')
+    sibling = next((file for file in msg_body.get('siblings', []) if file['rfilename'] == filename), {})
+    blob = sibling_blob(sibling) or remote_blob(msg_body['id'], filename, token, session=http_session)
+    if blob is None:
+        return None
+    if current is not None and current.get('keras_filenam') == filename and same_file(blob, current):
+        stored = status_table.get_item(Key={'repo': msg_body['id'], 'version': 'v0'}, ConsistentRead=True).get('Item')
+        if completed(stored):
+            logger.info((f'{msg_body["id"]}/{filename} hasn\'t changed since the last analysis'))
+            return stored
+    cache = get_verdict_cache()
+    verdict = cache.get_file(**blob) if cache is not None else None
+    if not completed(verdict):
+        return None
+    logger.info((f'{msg_body["id"]}/{filename} is byte identical to a model we already analyzed'))
+    return verdict
+
+def fetch_model(msg_body, token):
+    # returns None when the revision has already been analyzed, the verdict when the pre-flight
+    # check already knows the file, and otherwise downloads it and returns the local file
+    current = current_analysis(msg_body)
+    if already_analyzed(msg_body, current):
+        logger.info((f'{msg_body["id"]} at {msg_body["lastModified"]} was already analyzed, skipping'))
+        return None
+    verdict = known_verdict(msg_body, token, current)
+    if verdict is not None:
+        return verdict
+    return download_metadata_file(msg_body, token)
+
+def analyze_message(msg_body, local_file):
+    model = msg_body['id']
+    result = {}
+    if isinstance(local_file, dict):
+        result = dict(local_file)
+    elif str(local_file).endswith('-GATED'):
+        logger.info((f'{model} is not publicly available'))
+        result['private'] = True
+    else:       
+        result = check_for_code(local_file)
+    result['repo'] = model
+    result['modified_date'] = msg_body['lastModified']
+    result['keras_filenam'] = msg_body['keras_filename']
         
-        result = {}
-        if str(local_file).endswith('-GATED'):
-            logger.info((f'{model} is not publicly available'))
-            result['private'] = True
-        else:       
-            result = check_for_code(local_file)
-        result['repo'] = model
-        result['modified_date'] = msg_body['lastModified']
-        result['keras_filenam'] = msg_body['keras_filename']
-            
-        logger.info((f'RESULTS {result}'))
-        update_dynamo(result)
-
-try:
-    s3 = boto3.client('s3', region_name=AWS_REGION)
-    s3.put_object(Bucket = LOGGING_BUCKET, Key=f"{int(round(datetime.timestamp(datetime.now())))}-bhakti.log", Body='/var/log/bhakti.log')
-except Exception as e:
-    print('unable to upload log to s3')
-
-subprocess.call(["shutdown"])
\ No newline at end of file
+    logger.info((f'RESULTS {result}'))
+    update_dynamo(result)
+
+class VisibilityHeartbeat:
+    """Keeps pushing out the visibility timeout of every message we're still working on, so
+    slow models aren't handed to another worker. If this instance dies the heartbeat dies with
+    it and the messages reappear on the queue once their current timeout lapses. A message
+    still in flight after max_age is given up on, so it's redelivered and eventually lands in
+    the dead letter queue instead of staying invisible for good.
+    """
+    def __init__(self, queue, interval=HEARTBEAT_SECONDS, timeout=VISIBILITY_TIMEOUT, max_age=HEARTBEAT_MAX_AGE):
+        self.queue = queue
+        self.interval = interval
+        self.timeout = timeout
+        self.max_age = max_age
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def track(self, sqs_message):
+        with self.lock:
+            self.in_flight[sqs_message.message_id] = (sqs_message.receipt_handle, time.monotonic())
+
+    def release(self, sqs_message):
+        with self.lock:
+            self.in_flight.pop(sqs_message.message_id, None)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            now = time.monotonic()
+            with self.lock:
+                for message_id, (receipt, started) in list(self.in_flight.items()):
+                    if now - started > self.max_age:
+                        logger.error((f'{message_id} has been in flight for over {self.max_age}s, no longer extending it'))
+                        del self.in_flight[message_id]
+                entries = [
+                    {'Id': message_id, 'ReceiptHandle': receipt, 'VisibilityTimeout': self.timeout}
+                    for message_id, (receipt, started) in self.in_flight.items()
+                ]
+            for i in range(0, len(entries), 10):
+                try:
+                    response = self.queue.change_message_visibility_batch(Entries=entries[i:i + 10])
+                    for failure in response.get('Failed', []):
+                        logger.error((f'Could not extend visibility of {failure["Id"]}: {failure.get("Message")}'))
+                except ClientError as e:
+                    logger.error((f'Could not extend message visibility: {e}'))
+
+def flush_deletes(queue, sqs_messages):
+    # messages are only deleted once their analysis has made it into dynamo
+    for i in range(0, len(sqs_messages), 10):
+        batch = sqs_messages[i:i + 10]
+        response = queue.delete_messages(Entries=[
+            {'Id': sqs_message.message_id, 'ReceiptHandle': sqs_message.receipt_handle}
+            for sqs_message in batch
+        ])
+        for failure in response.get('Failed', []):
+            logger.error((f'Could not delete message {failure["Id"]}: {failure.get("Message")}'))
+    sqs_messages.clear()
+
+def main():
+    logging.basicConfig(filename='/var/log/bhakti.log', encoding='utf-8', level=logging.DEBUG)
+    logger.setLevel(logging.INFO)
+    sqs = boto3.resource('sqs', region_name=AWS_REGION)
+    bhakti_queue = sqs.get_queue_by_name(
+        QueueName=SQS_QUEUE
+    )
+    api_token = get_api_token()
+
+    # Downloads run DOWNLOAD_WORKERS at a time on their own threads while this thread keeps the
+    # download pool fed from sqs, ten messages per receive, and analyzes whichever file lands first.
+    heartbeat = VisibilityHeartbeat(bhakti_queue)
+    finished = []
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as downloads:
+        pending = {}
+        scanning = True
+        while scanning or pending:
+            if scanning and len(pending) < DOWNLOAD_WORKERS:
+                sqs_messages = bhakti_queue.receive_messages(
+                        MaxNumberOfMessages=min(10, DOWNLOAD_WORKERS * 2 - len(pending)),
+                        AttributeNames=["All"],
+                        MessageAttributeNames=["All"],
+                        # only long poll once there's nothing left to work on
+                        WaitTimeSeconds=0 if pending else RECEIVE_WAIT_SECONDS,
+                    )
+                if len(sqs_messages) == 0 and not pending:
+                    scanning = False
+                for sqs_message in sqs_messages:
+                    heartbeat.track(sqs_message)
+                    msg_body = json.loads(sqs_message.body)
+                    logger.info((f'SQS GIVING US {msg_body}'))
+                    download = downloads.submit(fetch_model, msg_body, api_token)
+                    pending[download] = (sqs_message, msg_body)
+                if sqs_messages and len(pending) < DOWNLOAD_WORKERS:
+                    continue
+            if not pending:
+                flush_deletes(bhakti_queue, finished)
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for download in done:
+                sqs_message, msg_body = pending.pop(download)
+                try:
+                    local_file = download.result()
+                    logger.info((local_file))
+                    if local_file is not None:
+                        analyze_message(msg_body, local_file)
+                    finished.append(sqs_message)
+                except Exception as e:
+                    # left on the queue to be retried once its visibility timeout runs out
+                    logger.error((f'Failed to process {msg_body["id"]}, leaving it on the queue: {e}'))
+                heartbeat.release(sqs_message)
+            if len(finished) >= 10:
+                flush_deletes(bhakti_queue, finished)
+        flush_deletes(bhakti_queue, finished)
+    heartbeat.stop()
+
+    try:
+        s3 = boto3.client('s3', region_name=AWS_REGION)
+        s3.put_object(Bucket = LOGGING_BUCKET, Key=f"{int(round(datetime.timestamp(datetime.now())))}-bhakti.log", Body='/var/log/bhakti.log')
+    except Exception as e:
+        print('unable to upload log to s3')
+
+    subprocess.call(["shutdown"])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,595 @@
+"""
+Evaluates the rules in yara/*.yara without YARA. Every literal, wide and base64 variant of
+every rule's strings is compiled into a single regex alternation, so a buffer is scanned
+exactly once by re no matter how many rules are loaded, and the rule conditions are then
+decided from the set of strings that turned up.
+
+Only the subset of YARA the bhakti rules need is understood: text and plain hex strings with
+the ascii, wide, fullword, base64 and base64wide modifiers, and conditions built out of string
+identifiers, and/or/not, parentheses, true/false and "any/all/none/N of them|($a, $b*)".
+Anything else raises a RuleError when the rules are loaded rather than silently not matching.
+
+Rules in a subdirectory named after a scope, like yara/lambda, are only loaded in that scope
+and replace the top level rule of the same name. They hold variants that only make sense
+against a single Lambda layer, such as plain names that would match ordinary bytes anywhere
+in a whole file, and a yara run over yara/*.yara never picks them up.
+"""
+import base64
+import hashlib
+import mmap
+import os
+import re
+from collections import deque
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, Union
+from collections.abc import Generator
+
+RULES_ENV = "BHAKTI_RULES"
+SCOPE_ENV = "BHAKTI_RULE_SCOPE"
+# "lambda" evaluates rules per Lambda layer, "file" against the whole file like a yara run
+RULE_SCOPES = ("lambda", "file")
+RULE_SUFFIXES = (".yara", ".yar")
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+Condition = Callable[[FrozenSet[str]], bool]
+
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r", '"': '"', "\\": "\\"}
+WORD_BYTES = frozenset(b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_")
+STRING_MODIFIERS = {"ascii", "wide", "fullword", "base64", "base64wide"}
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<space>\s+|//[^\n]*|/\*.*?\*/)
+    |(?P<text>"(?:[^"\\\n]|\\.)*")
+    |(?P<hex>\{[0-9A-Fa-f\s]*\})
+    |(?P<string_id>[$#@!][A-Za-z0-9_]*\*?)
+    |(?P<number>\d+)
+    |(?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    |(?P<symbol>[{}():=,])
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+class RuleError(Exception):
+    """Raised for rule files using syntax this engine doesn't support."""
+
+
+def tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = TOKEN_PATTERN.match(text, pos)
+        if not match:
+            raise RuleError(f"unsupported syntax near {text[pos:pos + 30]!r}")
+        pos = match.end()
+        if match.lastgroup != "space":
+            tokens.append((match.lastgroup, match.group()))
+    return tokens
+
+
+def unescape(literal: str) -> bytes:
+    out = bytearray()
+    chars = iter(literal[1:-1])
+    for char in chars:
+        if char != "\\":
+            out += char.encode("utf-8")
+            continue
+        escaped = next(chars)
+        if escaped == "x":
+            out.append(int(next(chars) + next(chars), 16))
+        elif escaped in ESCAPES:
+            out += ESCAPES[escaped].encode("utf-8")
+        else:
+            raise RuleError(f"unsupported escape \\{escaped}")
+    return bytes(out)
+
+
+def wide(data: bytes) -> bytes:
+    return bytes(byte for char in data for byte in (char, 0))
+
+
+def base64_variants(data: bytes) -> List[bytes]:
+    """The three base64 encodings of data, one per alignment within a 3 byte group, trimmed to
+    the characters that don't depend on the bytes around it. This is what YARA's base64
+    modifier searches for.
+    """
+    variants = []
+    for offset in range(3):
+        encoded = base64.b64encode(b"\x00" * offset + data).rstrip(b"=")
+        stable_end = (8 * (offset + len(data))) // 6
+        stable_start = (8 * offset + 5) // 6
+        variant = encoded[stable_start:stable_end]
+        if variant:
+            variants.append(variant)
+    return variants
+
+
+class RuleString:
+    def __init__(self, identifier: str, value: bytes, modifiers: Set[str]) -> None:
+        self.identifier = identifier
+        self.fullword = "fullword" in modifiers
+        self.variants: List[bytes] = []
+        if "base64" in modifiers:
+            self.variants.extend(base64_variants(value))
+        if "base64wide" in modifiers:
+            self.variants.extend(wide(variant) for variant in base64_variants(value))
+        if not modifiers & {"base64", "base64wide"}:
+            if "ascii" in modifiers or "wide" not in modifiers:
+                self.variants.append(value)
+            if "wide" in modifiers:
+                self.variants.append(wide(value))
+
+
+class Rule:
+    def __init__(
+        self,
+        name: str,
+        tags: List[str],
+        meta: Dict[str, Any],
+        strings: Dict[str, RuleString],
+        condition: Condition,
+    ) -> None:
+        self.name = name
+        self.tags = tags
+        self.meta = meta
+        self.strings = strings
+        self.condition = condition
+
+
+class RuleParser:
+    """Recursive descent over the tokens of one rule file."""
+
+    def __init__(self, text: str, source: str = "<rules>") -> None:
+        self.tokens = tokenize(text)
+        self.pos = 0
+        self.source = source
+
+    def peek(self, offset: int = 0) -> Tuple[str, str]:
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return ("eof", "")
+
+    def take(self, value: Optional[str] = None) -> str:
+        kind, token = self.peek()
+        if kind == "eof" or (value is not None and token != value):
+            raise RuleError(f"{self.source}: expected {value or 'a token'}, found {token or 'end of file'!r}")
+        self.pos += 1
+        return token
+
+    def rules(self) -> List[Rule]:
+        rules = []
+        while self.peek()[0] != "eof":
+            if self.peek()[1] in ("private", "global"):
+                raise RuleError(f"{self.source}: {self.peek()[1]} rules aren't supported")
+            if self.peek()[1] in ("import", "include"):
+                raise RuleError(f"{self.source}: {self.peek()[1]} isn't supported")
+            rules.append(self.rule())
+        return rules
+
+    def rule(self) -> Rule:
+        self.take("rule")
+        name = self.take()
+        tags = []
+        if self.peek()[1] == ":":
+            self.take(":")
+            while self.peek()[1] != "{":
+                tags.append(self.take())
+        self.take("{")
+        meta: Dict[str, Any] = {}
+        strings: Dict[str, RuleString] = {}
+        condition = None
+        while self.peek()[1] != "}":
+            section = self.take()
+            self.take(":")
+            if section == "meta":
+                meta = self.meta()
+            elif section == "strings":
+                strings = self.strings()
+            elif section == "condition":
+                condition = self.condition(strings)
+            else:
+                raise RuleError(f"{self.source}: unknown section {section!r} in rule {name}")
+        self.take("}")
+        if condition is None:
+            raise RuleError(f"{self.source}: rule {name} has no condition")
+        return Rule(name, tags, meta, strings, condition)
+
+    def meta(self) -> Dict[str, Any]:
+        meta: Dict[str, Any] = {}
+        while self.peek(1)[1] == "=":
+            key = self.take()
+            self.take("=")
+            kind, token = self.peek()
+            self.pos += 1
+            if kind == "text":
+                meta[key] = unescape(token).decode("utf-8")
+            elif kind == "number":
+                meta[key] = int(token)
+            else:
+                meta[key] = token == "true"
+        return meta
+
+    def strings(self) -> Dict[str, RuleString]:
+        strings: Dict[str, RuleString] = {}
+        while self.peek()[0] == "string_id" and self.peek(1)[1] == "=":
+            identifier = self.take()
+            self.take("=")
+            kind, token = self.peek()
+            self.pos += 1
+            if kind == "text":
+                value = unescape(token)
+            elif kind == "hex":
+                value = bytes.fromhex(token[1:-1])
+            else:
+                raise RuleError(f"{self.source}: only text and plain hex strings are supported ({identifier})")
+            if not value:
+                # yara refuses these too, they'd match at every offset
+                raise RuleError(f"{self.source}: {identifier} is an empty string")
+            modifiers = set()
+            while self.peek()[1] in STRING_MODIFIERS:
+                modifiers.add(self.take())
+                if self.peek()[1] == "(":
+                    raise RuleError(f"{self.source}: custom base64 alphabets aren't supported ({identifier})")
+            if self.peek()[0] == "word" and self.peek(1)[1] != ":":
+                raise RuleError(f"{self.source}: unsupported modifier {self.peek()[1]!r} on {identifier}")
+            strings[identifier] = RuleString(identifier, value, modifiers)
+        return strings
+
+    def condition(self, strings: Dict[str, RuleString]) -> Condition:
+        self.known = set(strings)
+        return self.or_expression()
+
+    def or_expression(self) -> Condition:
+        terms = [self.and_expression()]
+        while self.peek()[1] == "or":
+            self.take("or")
+            terms.append(self.and_expression())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda found: any(term(found) for term in terms)
+
+    def and_expression(self) -> Condition:
+        terms = [self.not_expression()]
+        while self.peek()[1] == "and":
+            self.take("and")
+            terms.append(self.not_expression())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda found: all(term(found) for term in terms)
+
+    def not_expression(self) -> Condition:
+        if self.peek()[1] == "not":
+            self.take("not")
+            term = self.not_expression()
+            return lambda found: not term(found)
+        return self.primary()
+
+    def primary(self) -> Condition:
+        kind, token = self.peek()
+        if token == "(":
+            self.take("(")
+            term = self.or_expression()
+            self.take(")")
+            return term
+        if token in ("true", "false"):
+            self.take()
+            value = token == "true"
+            return lambda found: value
+        if kind == "string_id" and token.startswith("$") and not token.endswith("*"):
+            self.take()
+            if token not in self.known:
+                raise RuleError(f"{self.source}: condition uses undefined string {token}")
+            if self.peek()[1] in ("at", "in"):
+                raise RuleError(f"{self.source}: string offsets aren't supported ({token} {self.peek()[1]})")
+            return lambda found: token in found
+        if token in ("any", "all", "none") or kind == "number":
+            return self.quantifier()
+        raise RuleError(f"{self.source}: unsupported condition near {token!r}")
+
+    def quantifier(self) -> Condition:
+        quantity = self.take()
+        self.take("of")
+        if self.peek()[1] == "them":
+            self.take("them")
+            members = sorted(self.known)
+        else:
+            self.take("(")
+            members = []
+            while True:
+                pattern = self.take()
+                if pattern.endswith("*"):
+                    members.extend(sorted(s for s in self.known if s.startswith(pattern[:-1])))
+                elif pattern in self.known:
+                    members.append(pattern)
+                else:
+                    raise RuleError(f"{self.source}: condition uses undefined string {pattern}")
+                if self.peek()[1] != ",":
+                    break
+                self.take(",")
+            self.take(")")
+        if quantity == "any":
+            needed = 1
+        elif quantity == "all":
+            needed = len(members)
+        elif quantity == "none":
+            return lambda found: not any(member in found for member in members)
+        else:
+            needed = int(quantity)
+        return lambda found: sum(member in found for member in members) >= needed
+
+
+class AhoCorasick:
+    """Byte level Aho-Corasick automaton. Patterns are added with a value that's reported
+    along with the start offset of every occurrence found by search. Scanning with it is a
+    python loop over the bytes, so it's only used when the patterns won't compile into a
+    LiteralScanner.
+    """
+
+    def __init__(self) -> None:
+        self.goto: List[Dict[int, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[List[Tuple[Any, int]]] = [[]]
+        self.first_bytes: Optional["re.Pattern[bytes]"] = None
+
+    def add(self, pattern: bytes, value: Any) -> None:
+        node = 0
+        for byte in pattern:
+            child = self.goto[node].get(byte)
+            if child is None:
+                child = len(self.goto)
+                self.goto[node][byte] = child
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            node = child
+        self.out[node].append((value, len(pattern)))
+
+    def build(self) -> "AhoCorasick":
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for byte, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and byte not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(byte, 0) if node else 0
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+        # lets the scan jump straight to the next byte that can start a pattern
+        starts = b"".join(re.escape(bytes([byte])) for byte in sorted(self.goto[0]))
+        self.first_bytes = re.compile(b"[" + starts + b"]") if starts else None
+        return self
+
+    def search(
+        self, buf: Buffer, start: int = 0, end: Optional[int] = None
+    ) -> Generator[Tuple[Any, int], None, None]:
+        if end is None:
+            end = len(buf)
+        if self.first_bytes is None:
+            return
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        node = 0
+        pos = start
+        while pos < end:
+            if node == 0:
+                match = self.first_bytes.search(buf, pos, end)
+                if match is None:
+                    return
+                pos = match.start()
+            byte = buf[pos]
+            while node and byte not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(byte, 0)
+            pos += 1
+            for value, length in out[node]:
+                yield value, pos - length
+
+
+class LiteralScanner:
+    """Same interface as AhoCorasick, but the scan runs in re: the patterns are compiled into
+    one alternation and only the offsets it stops at are looked at in python. An alternation
+    reports one pattern per offset and skips past what it matched, so the search restarts a
+    byte after each hit and checks every pattern starting at the offset it found.
+    """
+
+    def __init__(self) -> None:
+        self.patterns: Dict[bytes, List[Any]] = {}
+        self.by_first_byte: Dict[int, List[Tuple[bytes, List[Any]]]] = {}
+        self.alternation: Optional["re.Pattern[bytes]"] = None
+
+    def add(self, pattern: bytes, value: Any) -> None:
+        self.patterns.setdefault(pattern, []).append(value)
+
+    def build(self) -> "LiteralScanner":
+        for pattern, values in self.patterns.items():
+            self.by_first_byte.setdefault(pattern[0], []).append((pattern, values))
+        if self.patterns:
+            # longest first, so a pattern isn't cut short by one of its prefixes
+            literals = sorted(self.patterns, key=len, reverse=True)
+            self.alternation = re.compile(b"|".join(map(re.escape, literals)))
+        return self
+
+    def search(
+        self, buf: Buffer, start: int = 0, end: Optional[int] = None
+    ) -> Generator[Tuple[Any, int], None, None]:
+        if end is None:
+            end = len(buf)
+        if self.alternation is None:
+            return
+        pos = start
+        while pos < end:
+            match = self.alternation.search(buf, pos, end)
+            if match is None:
+                return
+            offset = match.start()
+            for pattern, values in self.by_first_byte[buf[offset]]:
+                if offset + len(pattern) <= end and buf[offset : offset + len(pattern)] == pattern:
+                    for value in values:
+                        yield value, offset
+            pos = offset + 1
+
+
+class RuleSet:
+    """A set of rules compiled into one scanner."""
+
+    def __init__(self, rules: List[Rule], digest: str = "") -> None:
+        self.rules = rules
+        # identifies the rule text the set was compiled from, for caching verdicts
+        self.digest = digest
+        self.fullword: Set[Tuple[int, str]] = set()
+        for index, rule in enumerate(rules):
+            for identifier, rule_string in rule.strings.items():
+                if rule_string.fullword:
+                    self.fullword.add((index, identifier))
+        try:
+            self.scanner: Union[LiteralScanner, AhoCorasick] = self.compile(LiteralScanner())
+        except (re.error, OverflowError, RecursionError):
+            # more literals than re will compile into one pattern
+            self.scanner = self.compile(AhoCorasick())
+        self.total_strings = sum(len(rule.strings) for rule in rules)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def compile(self, scanner: Any) -> Any:
+        for index, rule in enumerate(self.rules):
+            for identifier, rule_string in rule.strings.items():
+                for variant in rule_string.variants:
+                    scanner.add(variant, (index, identifier, len(variant)))
+        return scanner.build()
+
+    def found_strings(
+        self, buf: Buffer, start: int = 0, end: Optional[int] = None
+    ) -> Set[Tuple[int, str]]:
+        """Single pass over buf collecting which strings of which rules occur in it."""
+        end = len(buf) if end is None else end
+        found: Set[Tuple[int, str]] = set()
+        for (index, identifier, length), offset in self.scanner.search(buf, start, end):
+            key = (index, identifier)
+            if key in found:
+                continue
+            if key in self.fullword and not is_fullword(buf, offset, offset + length, start, end):
+                continue
+            found.add(key)
+            if len(found) == self.total_strings:
+                break
+        return found
+
+    def evaluate(self, found: Set[Tuple[int, str]]) -> List[Dict[str, Any]]:
+        matches = []
+        for index, rule in enumerate(self.rules):
+            strings = frozenset(identifier for rule_index, identifier in found if rule_index == index)
+            if rule.condition(strings):
+                matches.append({"rule": rule.name, "strings": sorted(strings)})
+        return matches
+
+    def match(self, buf: Buffer, start: int = 0, end: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Returns the name and matched strings of every rule whose condition holds for buf."""
+        return self.evaluate(self.found_strings(buf, start, end))
+
+    def match_regions(
+        self, regions: Iterable[Tuple[str, Iterable[Buffer]]]
+    ) -> List[Dict[str, Any]]:
+        """Evaluates the rules separately against each region, a name and the buffers that make
+        it up, so strings only count towards a rule when they turn up in the same region.
+        Returns the rules that fired in any region along with the regions they fired in.
+        """
+        fired: Dict[str, Dict[str, Any]] = {}
+        for name, buffers in regions:
+            found: Set[Tuple[int, str]] = set()
+            for buf in buffers:
+                found |= self.found_strings(buf)
+            for match in self.evaluate(found):
+                merged = fired.setdefault(match["rule"], {"rule": match["rule"], "strings": [], "regions": []})
+                merged["strings"] = sorted(set(merged["strings"]) | set(match["strings"]))
+                merged["regions"].append(name)
+        return [fired[rule.name] for rule in self.rules if rule.name in fired]
+
+    def match_file(self, path: Union[Path, str]) -> List[Dict[str, Any]]:
+        with open(path, "rb") as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files can't be mapped
+                return self.match(b"")
+        with mm:
+            return self.match(mm)
+
+
+def is_fullword(buf: Buffer, start: int, end: int, lower: int, upper: int) -> bool:
+    if start > lower and buf[start - 1] in WORD_BYTES:
+        return False
+    if end < upper and buf[end] in WORD_BYTES:
+        return False
+    return True
+
+
+def parse_rules(text: str, source: str = "<rules>") -> List[Rule]:
+    return RuleParser(text, source).rules()
+
+
+def rule_files(path: Union[Path, str]) -> List[Path]:
+    path = Path(path)
+    if path.is_dir():
+        return sorted(p for p in path.iterdir() if p.suffix in RULE_SUFFIXES)
+    return [path]
+
+
+def compile_rules(
+    paths: Iterable[Union[Path, str]], scoped_paths: Iterable[Union[Path, str]] = ()
+) -> RuleSet:
+    """Compiles the rules in paths, with the rules in scoped_paths replacing any of the same
+    name."""
+    sha = hashlib.sha256()
+
+    def read(paths: Iterable[Union[Path, str]]) -> List[Rule]:
+        rules = []
+        for path in paths:
+            for rule_file in rule_files(path):
+                text = rule_file.read_text()
+                sha.update(text.encode("utf-8"))
+                rules.extend(parse_rules(text, str(rule_file)))
+        return rules
+
+    rules = read(paths)
+    scoped = {rule.name: rule for rule in read(scoped_paths)}
+    rules = [scoped.pop(rule.name, rule) for rule in rules] + list(scoped.values())
+    return RuleSet(rules, sha.hexdigest())
+
+
+def default_rules_dir() -> Optional[Path]:
+    """BHAKTI_RULES if it's set, otherwise a yara directory next to the analysis scripts or
+    at the root of the repo."""
+    if os.getenv(RULES_ENV):
+        return Path(os.environ[RULES_ENV])
+    here = Path(__file__).resolve().parent
+    for candidate in (here / "yara", here.parent / "yara"):
+        if candidate.is_dir():
+            return candidate
+    return None
+
+
+def rule_scope() -> str:
+    scope = os.getenv(SCOPE_ENV, RULE_SCOPES[0])
+    if scope not in RULE_SCOPES:
+        raise RuleError(f"{SCOPE_ENV} should be one of {', '.join(RULE_SCOPES)}, not {scope!r}")
+    return scope
+
+
+def load_rules(path: Optional[str] = None, scope: Optional[str] = None) -> Optional[RuleSet]:
+    """Compiles the rules in path, or the default rules directory, for scope, or the current
+    rule_scope(), once per process. Returns None when there are no rules to load."""
+    return _load_rules(path, scope or rule_scope())
+
+
+@lru_cache(maxsize=None)
+def _load_rules(path: Optional[str], scope: str) -> Optional[RuleSet]:
+    rules_path = Path(path) if path else default_rules_dir()
+    if rules_path is None or not rules_path.exists():
+        return None
+    scoped_path = rules_path / scope
+    return compile_rules([rules_path], [scoped_path] if scoped_path.is_dir() else [])
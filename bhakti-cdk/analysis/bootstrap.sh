@@ -0,0 +1,24 @@
+#!/bin/bash
+# Sets up a minimal python environment for the monitoring worker and runs it. The worker only
+# parses model metadata, so nothing here needs a GPU or Tensorflow and any recent Amazon Linux
+# image works, x86 or Graviton. Runs from the unzipped analysis scripts as part of user data.
+
+ANALYSIS_DIR="$(cd "$(dirname "$0")" && pwd)"
+VENV=/opt/bhakti
+
+give_up() {
+    echo "bhakti bootstrap failed: $1" >> /var/log/bhakti.log
+    # instances are launched to terminate on shutdown, don't leave a broken one running
+    shutdown -h now
+    exit 1
+}
+
+if [ ! -x "$VENV/bin/python" ]; then
+    if ! python3 -m venv "$VENV" 2>/dev/null; then
+        (dnf install -y python3 python3-pip || yum install -y python3 python3-pip) || give_up "could not install python3"
+        python3 -m venv "$VENV" || give_up "could not create $VENV"
+    fi
+    "$VENV/bin/pip" install --quiet -r "$ANALYSIS_DIR/requirements-worker.txt" || give_up "could not install requirements"
+fi
+
+exec "$VENV/bin/python" "$ANALYSIS_DIR/monitoring_ec2_check.py"
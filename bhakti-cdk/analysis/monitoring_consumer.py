@@ -0,0 +1,67 @@
+"""
+SQS triggered Lambda consumer for the monitoring queue. Runs the same download, check_for_code
+and dynamo update as monitoring_ec2_check.py, one batch of queued models per invocation, so a
+new model is analyzed seconds after it's enqueued rather than after an instance boots.
+
+Messages that fail are reported back as batch item failures and stay on the queue for the
+next attempt; everything else in the batch is deleted by the event source mapping.
+"""
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from monitoring_ec2_check import DOWNLOAD_WORKERS, analyze_message, fetch_model, get_api_token
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+api_token = None
+
+
+def remove_download(local_file):
+    # warm containers share /tmp, so don't let downloads pile up between invocations
+    if local_file is None or isinstance(local_file, dict):
+        return
+    for path in (Path(local_file), Path(f'{local_file}-FAILED'), Path(f'{local_file}-GATED')):
+        if path.is_file():
+            os.remove(path)
+
+
+def handler(event, context):
+    global api_token
+    if api_token is None:
+        api_token = get_api_token()
+
+    records = event.get('Records', [])
+    failed = []
+    # a FIFO queue has to get back every message after a failure in the same message group,
+    # otherwise the group would be delivered out of order on the retry
+    broken_groups = set()
+    downloaded = []
+    # downloads overlap on the pool, analysis and the dynamo writes stay on this thread in order
+    with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_WORKERS, len(records)))) as downloads:
+        pending = []
+        for record in records:
+            msg_body = json.loads(record['body'])
+            logger.info((f'SQS GIVING US {msg_body}'))
+            pending.append((record, msg_body, downloads.submit(fetch_model, msg_body, api_token)))
+        for record, msg_body, download in pending:
+            group = record.get('attributes', {}).get('MessageGroupId')
+            try:
+                if group is not None and group in broken_groups:
+                    raise RuntimeError(f'an earlier message in group {group} failed')
+                local_file = download.result()
+                downloaded.append(local_file)
+                if local_file is not None:
+                    analyze_message(msg_body, local_file)
+            except Exception as e:
+                logger.error((f'Failed to process {msg_body.get("id")}, leaving it on the queue: {e}'))
+                failed.append({'itemIdentifier': record['messageId']})
+                if group is not None:
+                    broken_groups.add(group)
+
+    for local_file in downloaded:
+        remove_download(local_file)
+    return {'batchItemFailures': failed}
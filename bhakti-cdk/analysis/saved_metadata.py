@@ -0,0 +1,125 @@
+"""
+Pure python reader for the SavedMetadata protobuf stored in keras_metadata.pb files, so that
+we don't have to import all of Tensorflow just to read a handful of strings. Only the framing
+of the messages in tensorflow/python/keras/protobuf/saved_metadata.proto is walked:
+
+    message SavedMetadata { repeated SavedObject nodes = 1; }
+    message SavedObject {
+        int32 node_id = 2;
+        string node_path = 3;
+        string identifier = 4;
+        string metadata = 5;
+        VersionDef version = 6;
+    }
+"""
+import mmap
+from pathlib import Path
+from typing import Optional, Tuple, Union
+from collections.abc import Generator
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+LAYER_IDENTIFIER = b"_tf_keras_layer"
+LAMBDA_MARKER = b'"Lambda"'
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
+class DecodeError(Exception):
+    """Raised when a buffer isn't valid protobuf wire format."""
+
+
+def read_varint(buf: Buffer, pos: int, end: int) -> Tuple[int, int]:
+    """Reads a base 128 varint starting at pos. Returns the value and the position after it."""
+    result = 0
+    shift = 0
+    while pos < end:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise DecodeError("varint is too long")
+    raise DecodeError("truncated varint")
+
+
+def iter_fields(
+    buf: Buffer, start: int = 0, end: Optional[int] = None
+) -> Generator[Tuple[int, int, Union[int, Tuple[int, int]]], None, None]:
+    """Walks the fields of a single message between start and end. Yields the field number,
+    the wire type and either the integer value or, for length delimited fields, the (start, end)
+    offsets of the payload so callers can decide whether it's worth copying.
+    """
+    if end is None:
+        end = len(buf)
+    pos = start
+    while pos < end:
+        key, pos = read_varint(buf, pos, end)
+        field_number = key >> 3
+        wire_type = key & 0x7
+        if field_number == 0:
+            raise DecodeError("invalid field number 0")
+        if wire_type == WIRE_VARINT:
+            value, pos = read_varint(buf, pos, end)
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            length, pos = read_varint(buf, pos, end)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == WIRE_FIXED64:
+            value = int.from_bytes(buf[pos : pos + 8], "little")
+            pos += 8
+        elif wire_type == WIRE_FIXED32:
+            value = int.from_bytes(buf[pos : pos + 4], "little")
+            pos += 4
+        else:
+            raise DecodeError(f"unsupported wire type {wire_type}")
+        if pos > end:
+            raise DecodeError("field runs past the end of the message")
+        yield field_number, wire_type, value
+
+
+def scan_nodes(
+    local_file: Union[Path, str], marker: bytes = LAMBDA_MARKER
+) -> Generator[Tuple[int, Optional[bytes]], None, None]:
+    """Streams over an mmap of a keras_metadata.pb file without parsing the whole message.
+    Only the wire format framing of each node is walked; nodes that aren't keras layers are
+    skipped by offset and layer metadata is only copied out when it contains the marker.
+    Yields the index of every node along with its raw json metadata for Lambda candidates,
+    or None for the rest, so callers can stop a walk over a huge number of nodes early.
+    """
+    with open(local_file, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can't be mapped and can't contain any layers either
+            return
+    with mm:
+        index = -1
+        for field_number, wire_type, value in iter_fields(mm):
+            if field_number != 1 or wire_type != WIRE_LENGTH_DELIMITED:
+                continue
+            index += 1
+            identifier = None
+            metadata = None
+            for node_field, node_wire_type, span in iter_fields(mm, *value):
+                if node_wire_type != WIRE_LENGTH_DELIMITED:
+                    continue
+                if node_field == 4:
+                    identifier = span
+                elif node_field == 5:
+                    metadata = span
+            if (
+                identifier is None
+                or metadata is None
+                or identifier[1] - identifier[0] != len(LAYER_IDENTIFIER)
+                or mm[identifier[0] : identifier[1]] != LAYER_IDENTIFIER
+                or mm.find(marker, *metadata) == -1
+            ):
+                yield index, None
+                continue
+            yield index, mm[metadata[0] : metadata[1]]
@@ -0,0 +1,219 @@
+"""
+Content addressed cache of analysis verdicts. Forks and re-uploads on huggingface carry byte
+identical keras_metadata.pb and h5 files, and the same Lambda payload turns up in many
+different models, so verdicts are stored under the sha256 of the model file or of the decoded
+payload and reused instead of parsing the same bytes again.
+
+Verdicts live in a local SQLite database and, optionally, a DynamoDB table shared by every
+worker. Keys also carry a fingerprint of whatever else the verdict depends on (extraction
+limits, rules, python version), so changing any of those never serves a stale verdict. The
+cache is an optimization only: any error talking to either store is logged and treated as a
+miss.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple, Union
+
+CACHE_ENV = "BHAKTI_CACHE"
+CACHE_TABLE_ENV = "BHAKTI_CACHE_TABLE"
+DEFAULT_CACHE = Path.home() / ".cache" / "bhakti" / "verdicts.sqlite3"
+# bump when the shape of cached verdicts changes
+CACHE_VERSION = 3
+CHUNK_SIZE = 1024 * 1024
+# leaves room under dynamo's 400KB item limit for the other attributes
+MAX_SHARED_BYTES = 350 * 1024
+SHARED_TTL_SECONDS = 90 * 24 * 60 * 60
+
+logger = logging.getLogger()
+
+
+def file_digests(path: Union[Path, str], chunk_size: int = CHUNK_SIZE) -> Tuple[str, str]:
+    """sha256 and git blob id of a file, read a chunk at a time so large h5 files never sit in
+    memory. Huggingface reports the sha256 of LFS files and the git blob id of everything
+    else, so having both lets a remote file be matched to a verdict without downloading it.
+    """
+    sha = hashlib.sha256()
+    oid = hashlib.sha1(f"blob {os.path.getsize(path)}\0".encode("utf-8"))
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+            oid.update(chunk)
+    return sha.hexdigest(), oid.hexdigest()
+
+
+def payload_digest(payload: bytes) -> str:
+    return hashlib.sha256(payload).hexdigest()
+
+
+def fingerprint(*settings: Any) -> str:
+    """Short hash of the settings a verdict depends on besides the content itself."""
+    text = json.dumps(
+        [CACHE_VERSION, list(sys.version_info[:2]), *settings], sort_keys=True, default=str
+    )
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class LocalStore:
+    """Verdicts in a SQLite database. WAL mode lets batch mode's worker processes read while
+    one of them writes. The worker's download threads and its main thread share the one
+    connection, so it's used under a lock."""
+
+    def __init__(self, path: Union[Path, str]) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            str(path), timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts "
+            "(key TEXT PRIMARY KEY, verdict TEXT NOT NULL, created REAL NOT NULL)"
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT verdict FROM verdicts WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, verdict: str) -> None:
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO verdicts (key, verdict, created) VALUES (?, ?, ?)",
+                (key, verdict, time.time()),
+            )
+
+
+class SharedStore:
+    """Verdicts in a DynamoDB table keyed by digest, with an expires ttl attribute."""
+
+    def __init__(self, table_name: str, region: Optional[str] = None) -> None:
+        import boto3
+
+        self.table = boto3.resource("dynamodb", region_name=region).Table(table_name)
+
+    def get(self, key: str) -> Optional[str]:
+        item = self.table.get_item(Key={"digest": key}).get("Item")
+        return item["verdict"] if item else None
+
+    def put(self, key: str, verdict: str) -> None:
+        if len(verdict) > MAX_SHARED_BYTES:
+            return
+        self.table.put_item(
+            Item={
+                "digest": key,
+                "verdict": verdict,
+                "expires": int(time.time()) + SHARED_TTL_SECONDS,
+            }
+        )
+
+
+class VerdictCache:
+    """Looks verdicts up locally, then in the shared store, copying shared hits locally."""
+
+    def __init__(
+        self,
+        local: Optional[LocalStore],
+        shared: Optional[SharedStore],
+        settings: str = "",
+    ) -> None:
+        self.local = local
+        self.shared = shared
+        self.settings = settings
+
+    def key(self, kind: str, digest: str) -> str:
+        return f"{kind}:{digest}:{self.settings}"
+
+    def get(self, kind: str, digest: str) -> Optional[Dict[str, Any]]:
+        key = self.key(kind, digest)
+        verdict = None
+        if self.local is not None:
+            try:
+                verdict = self.local.get(key)
+            except sqlite3.Error as e:
+                logger.error(f"!!! Couldn't read the local verdict cache: {e}")
+        if verdict is None and self.shared is not None:
+            try:
+                verdict = self.shared.get(key)
+            except Exception as e:
+                logger.error(f"!!! Couldn't read the shared verdict cache: {e}")
+            if verdict is not None and self.local is not None:
+                try:
+                    self.local.put(key, verdict)
+                except sqlite3.Error as e:
+                    logger.error(f"!!! Couldn't write the local verdict cache: {e}")
+        return json.loads(verdict) if verdict is not None else None
+
+    def get_file(
+        self, sha256: Optional[str] = None, git_oid: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Looks up a model file's verdict by its sha256 or, failing that, its git blob id."""
+        if sha256 is None and git_oid is not None:
+            alias = self.get("oid", git_oid)
+            sha256 = alias["sha256"] if alias else None
+        return self.get("file", sha256) if sha256 else None
+
+    def put_file(self, sha256: str, git_oid: str, verdict: Dict[str, Any]) -> None:
+        self.put("file", sha256, verdict)
+        self.put("oid", git_oid, {"sha256": sha256})
+
+    def put(self, kind: str, digest: str, verdict: Dict[str, Any]) -> None:
+        key = self.key(kind, digest)
+        text = json.dumps(verdict, sort_keys=True)
+        if self.local is not None:
+            try:
+                self.local.put(key, text)
+            except sqlite3.Error as e:
+                logger.error(f"!!! Couldn't write the local verdict cache: {e}")
+        if self.shared is not None:
+            try:
+                self.shared.put(key, text)
+            except Exception as e:
+                logger.error(f"!!! Couldn't write the shared verdict cache: {e}")
+
+
+_stores: Dict[Tuple[int, str, str, str], Tuple[Optional[LocalStore], Optional[SharedStore]]] = {}
+
+
+def open_cache(
+    settings: str = "",
+    path: Optional[str] = None,
+    table: Optional[str] = None,
+    region: Optional[str] = None,
+) -> Optional[VerdictCache]:
+    """Returns a cache over the SQLite database at path and the DynamoDB table, defaulting to
+    BHAKTI_CACHE (or ~/.cache/bhakti/verdicts.sqlite3) and BHAKTI_CACHE_TABLE. An empty path
+    or table turns that store off; returns None when both are off. Stores are opened once per
+    process, since SQLite connections can't be shared with forked pool workers.
+    """
+    if path is None:
+        path = os.getenv(CACHE_ENV, str(DEFAULT_CACHE))
+    if table is None:
+        table = os.getenv(CACHE_TABLE_ENV, "")
+    if not path and not table:
+        return None
+    opened = (os.getpid(), path, table, region or "")
+    if opened not in _stores:
+        local = shared = None
+        try:
+            local = LocalStore(path) if path else None
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"!!! Couldn't open the verdict cache at {path}: {e}")
+        try:
+            shared = SharedStore(table, region) if table else None
+        except Exception as e:
+            logger.error(f"!!! Couldn't open the shared verdict cache {table}: {e}")
+        _stores[opened] = (local, shared)
+    local, shared = _stores[opened]
+    if local is None and shared is None:
+        return None
+    return VerdictCache(local, shared, settings)
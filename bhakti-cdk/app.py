@@ -25,15 +25,26 @@ if not sg_id:
 
 shared_resources = BhaktiShared(app, "BhaktiShared", sg_id=sg_id, env=env)
 if deploy_type == 'monitoring':
+    # 0 is a valid setting, it only queues candidates
+    max_workers = app.node.try_get_context("max_workers")
     MonitoringStack(app, "MonitoringStack", 
         hf_token=shared_resources.hf_token,
         script_asset=shared_resources.script_asset, 
+        messages_per_worker=int(app.node.try_get_context("messages_per_worker") or 500),
+        max_workers=int(max_workers if max_workers is not None else 4),
+        instance_type=app.node.try_get_context("instance_type") or "c7g.large",
+        machine_image_id=app.node.try_get_context("machine_image_id"),
+        use_spot=str(app.node.try_get_context("use_spot") or "true").lower() == "true",
+        consumer=app.node.try_get_context("consumer") or "ec2",
         env=env,)
 elif deploy_type == 'instance_profile':
     InstanceProfiles(app, "InstanceProfileStack", 
         hf_token=shared_resources.hf_token, 
         script_asset=shared_resources.script_asset, 
         sg_id=shared_resources.sg,  
+        instance_type=app.node.try_get_context("instance_type") or "g4dn.xlarge",
+        machine_image_id=app.node.try_get_context("machine_image_id"),
+        use_spot=str(app.node.try_get_context("use_spot") or "false").lower() == "true",
         env=env,
     )
 
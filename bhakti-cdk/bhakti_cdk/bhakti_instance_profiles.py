@@ -16,9 +16,23 @@ class InstanceProfiles(Stack):
         hf_token: aws_secretsmanager.Secret,
         sg_id: ec2.SecurityGroup, 
         script_asset: assets.Asset, 
+        instance_type: str = "g4dn.xlarge",
+        machine_image_id: Optional[str] = None,
+        use_spot: bool = False,
         **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        # manual analysis may want to actually load models, so this defaults to the Deep Learning AMI on a GPU.
+        # Metadata scanning doesn't need either, pass a CPU instance type and an AMI for it to save some money.
+        if machine_image_id:
+            machine_image = ec2.MachineImage.generic_linux({self.region: machine_image_id})
+        else:
+            machine_image = ec2.MachineImage.lookup(name='Deep*',filters={'image-id':['ami-0b28c78d9f575dfa1']}, owners=["amazon"])
+        spot_options = ec2.LaunchTemplateSpotOptions(
+            request_type=ec2.SpotRequestType.ONE_TIME,
+            interruption_behavior=ec2.SpotInstanceInterruption.TERMINATE,
+        ) if use_spot else None
+
         # Add any AWS access you need on your EC2 instance as PolicyStatements in this PolicyDocument
         bhakti_access = iam.PolicyDocument(
             statements=[iam.PolicyStatement(
@@ -78,8 +92,9 @@ class InstanceProfiles(Stack):
             bhakti_analysis = ec2.LaunchTemplate(
             self, "ec2_template",
             launch_template_name="bhakti_model_analysis",
-            machine_image=ec2.MachineImage.lookup(name='Deep*',filters={'image-id':['ami-0b28c78d9f575dfa1']}, owners=["amazon"]),
-            instance_type=ec2.InstanceType.of(ec2.InstanceClass.G4DN, ec2.InstanceSize.XLARGE),
+            machine_image=machine_image,
+            instance_type=ec2.InstanceType(instance_type),
+            spot_options=spot_options,
             key_pair=bhakti_keypair,
             user_data=bhakti_user_data,
             role=bhakti_role,
@@ -90,8 +105,9 @@ class InstanceProfiles(Stack):
             bhakti_analysis = ec2.LaunchTemplate(
             self, "ec2_template",
             launch_template_name="bhakti_model_analysis",
-            machine_image=ec2.MachineImage.lookup(name='Deep*',filters={'image-id':['ami-0b28c78d9f575dfa1']}, owners=["amazon"]),
-            instance_type=ec2.InstanceType.of(ec2.InstanceClass.G4DN, ec2.InstanceSize.XLARGE),
+            machine_image=machine_image,
+            instance_type=ec2.InstanceType(instance_type),
+            spot_options=spot_options,
             key_pair=bhakti_keypair,
             user_data=bhakti_user_data,
             role=bhakti_role,
@@ -11,13 +11,82 @@ from aws_cdk import (
     aws_lambda,
     aws_events,
     aws_events_targets,
+    aws_ec2 as ec2,
+    aws_lambda_event_sources,
+    Size,
 )
 from constructs import Construct
+from typing import Optional
+
+CONSUMER_TIMEOUT_SECONDS = 600
+# AWS recommends six times the function timeout, so batches retried while the consumer is
+# throttled aren't redelivered while still in flight
+QUEUE_VISIBILITY_SECONDS = 6 * CONSUMER_TIMEOUT_SECONDS
+
+
+class AnalysisConsumer(Construct):
+    """Analyzes queued models with an SQS triggered lambda instead of booting an EC2 worker.
+    Runs the same code as the EC2 worker (analysis/monitoring_consumer.py) a batch at a time.
+    """
+
+    def __init__(self, scope: Construct, construct_id: str, queue: sqs.Queue, status_table: aws_dynamodb.TableV2,
+                 verdict_table: aws_dynamodb.TableV2, hf_token: aws_secretsmanager.Secret, log_group: logs.LogGroup,
+                 batch_size: int = 10) -> None:
+        super().__init__(scope, construct_id)
+
+        self.function = aws_lambda.Function(
+            self,
+            "analysis_consumer_lambda",
+            code=aws_lambda.Code.from_asset(
+                "analysis",
+                bundling={
+                    "image":aws_lambda.Runtime.PYTHON_3_12.bundling_image,
+                    "command": [
+                        'bash','-c',
+                        'pip install -r requirements-worker.txt -t /asset-output && cp -au . /asset-output'
+                    ],
+                },
+            ),
+            handler="monitoring_consumer.handler",
+            # has to finish well inside the queue's visibility timeout
+            timeout=Duration.seconds(CONSUMER_TIMEOUT_SECONDS),
+            runtime=aws_lambda.Runtime.PYTHON_3_12,
+            memory_size=1024,
+            ephemeral_storage_size=Size.gibibytes(2),
+            log_group=log_group,
+            environment={
+                'SQS_QUEUE' : queue.queue_name,
+                'AWS_REG' : Stack.of(self).region,
+                'HUGGINGFACE_TOKEN' : hf_token.secret_name,
+                'DYNAMO_STATUS_TABLE' : status_table.table_name,
+                'VERDICT_TABLE' : verdict_table.table_name,
+            }
+        )
+        status_table.grant_read_write_data(self.function)
+        verdict_table.grant_read_write_data(self.function)
+        hf_token.grant_read(self.function)
+        # FIFO event sources don't support batching windows, batches go out as soon as they're available
+        self.function.add_event_source(aws_lambda_event_sources.SqsEventSource(
+            queue,
+            batch_size=batch_size,
+            report_batch_item_failures=True,
+        ))
 
 class MonitoringStack(Stack):
 
-    def __init__(self, scope: Construct, construct_id: str, hf_token: aws_secretsmanager.Secret, script_asset: assets.Asset, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, hf_token: aws_secretsmanager.Secret, script_asset: assets.Asset,
+                 messages_per_worker: int = 500, max_workers: int = 4,
+                 instance_type: str = "c7g.large", machine_image_id: Optional[str] = None, use_spot: bool = True,
+                 consumer: str = "ec2", **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
+        # the worker only parses metadata, so it runs on a plain Amazon Linux image on whatever
+        # cpu the instance type has, unless you hand it a specific AMI
+        if not machine_image_id:
+            if ec2.InstanceType(instance_type).architecture == ec2.InstanceArchitecture.ARM_64:
+                cpu_type = ec2.AmazonLinuxCpuType.ARM_64
+            else:
+                cpu_type = ec2.AmazonLinuxCpuType.X86_64
+            machine_image_id = ec2.MachineImage.latest_amazon_linux2023(cpu_type=cpu_type).get_image(self).image_id
         huggingface_token = hf_token
         bhakti_log_group = logs.LogGroup(self, 'bhakti_logs')
 
@@ -37,17 +106,43 @@ class MonitoringStack(Stack):
                 name='extracted_encoded_code', 
                 type=aws_dynamodb.AttributeType.STRING))
 
+        # analysis verdicts keyed by the sha256 of a model file or lambda payload, shared by
+        # every worker so byte identical models across repos are only analyzed once
+        verdict_table = aws_dynamodb.TableV2(self, 'verdict_table',
+            partition_key=aws_dynamodb.Attribute(
+                name='digest',
+                type=aws_dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute='expires',
+        )
+
         bhakti_analysis_bucket = s3.Bucket(
             self, 'bhakti_analysis_bucket',
             block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
         )
 
+        # models that repeatedly fail analysis are parked here instead of blocking the queue
+        monitoring_dead_letter_queue = sqs.Queue(
+            self,
+            "monitoring_dead_letter_queue",
+            queue_name="bhakti_monitoring_dead_letter_queue.fifo",
+            retention_period=Duration.days(14),
+            fifo=True,
+        )
+
         monitoring_queue = sqs.Queue(
             self,
             "monitoring_queue",
             queue_name="bhakti_monitoring_queue.fifo",
-            visibility_timeout=Duration.seconds(660),
+            visibility_timeout=Duration.seconds(QUEUE_VISIBILITY_SECONDS),
             fifo=True,
+            # high throughput FIFO: dedup and throughput limits apply per message group
+            deduplication_scope=sqs.DeduplicationScope.MESSAGE_GROUP,
+            fifo_throughput_limit=sqs.FifoThroughputLimit.PER_MESSAGE_GROUP_ID,
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=3,
+                queue=monitoring_dead_letter_queue,
+            ),
         )
 
         bhakti_automated_role = iam.Role(
@@ -59,13 +154,17 @@ class MonitoringStack(Stack):
         monitoring_execution = iam.PolicyDocument(
             statements=[
                 iam.PolicyStatement(
-                    actions=["dynamodb:GetItem", "dynamodb:Query", "dynamodb:DeleteItem", "dynamodb:PutItem"],
+                    actions=["dynamodb:GetItem", "dynamodb:BatchGetItem", "dynamodb:Query", "dynamodb:DeleteItem", "dynamodb:PutItem"],
                     resources=[status_table.table_arn],
                 ),
                 iam.PolicyStatement(
-                    actions=["sqs:SendMessage", "sqs:GetQueueUrl"],
+                    actions=["sqs:SendMessage", "sqs:GetQueueUrl", "sqs:GetQueueAttributes"],
                     resources=[monitoring_queue.queue_arn],
                 ),
+                iam.PolicyStatement(
+                    actions=["ec2:DescribeInstances"],
+                    resources=["*"],
+                ),
                 iam.PolicyStatement(
                     actions=["secretsmanager:GetSecretValue", "secretsmanager:DescribeSecret"],
                     resources=[huggingface_token.secret_arn],
@@ -82,14 +181,21 @@ class MonitoringStack(Stack):
                     actions=["ec2:RunInstances", "ec2:CreateTags"],
                     resources=[
                         f"arn:aws:ec2:{self.region}:{self.account}:instance/*",
-                        f"arn:aws:ec2:{self.region}:{self.account}:image/ami-0b28c78d9f575dfa1",
+                        f"arn:aws:ec2:{self.region}:{self.account}:image/{machine_image_id}",
                         f"arn:aws:ec2:{self.region}:{self.account}:network-interface/*",
                         f"arn:aws:ec2:{self.region}:{self.account}:security-group/*",
                         f"arn:aws:ec2:{self.region}:{self.account}:subnet/subnet-*",
                         f"arn:aws:ec2:{self.region}:{self.account}:volume/*",
-                        f"arn:aws:ec2:{self.region}::image/ami-0b28c78d9f575dfa1",
+                        f"arn:aws:ec2:{self.region}::image/{machine_image_id}",
+                        # spot launches also create a one-time spot request
+                        f"arn:aws:ec2:{self.region}:{self.account}:spot-instances-request/*",
                     ],
                 ),
+                iam.PolicyStatement(
+                    actions=["iam:CreateServiceLinkedRole"],
+                    resources=["*"],
+                    conditions={"StringEquals": {"iam:AWSServiceName": "spot.amazonaws.com"}},
+                ),
             ]
         )
         monitoring_execution_policy = iam.Policy(
@@ -101,9 +207,13 @@ class MonitoringStack(Stack):
         bhakti_analysis_policy_statement = iam.PolicyDocument(
             statements=[
                 iam.PolicyStatement(
-                    actions=["dynamodb:GetItem", "dynamodb:Query", "dynamodb:DeleteItem", "dynamodb:PutItem"],
+                    actions=["dynamodb:GetItem", "dynamodb:Query", "dynamodb:DeleteItem", "dynamodb:PutItem", "dynamodb:UpdateItem"],
                     resources=[status_table.table_arn],
                 ),
+                iam.PolicyStatement(
+                    actions=["dynamodb:GetItem", "dynamodb:PutItem"],
+                    resources=[verdict_table.table_arn],
+                ),
                 iam.PolicyStatement(
                     actions=["s3:getItem"],
                     resources=[f"{asset_bucket.bucket_arn}/*"]
@@ -117,7 +227,7 @@ class MonitoringStack(Stack):
                     resources=[hf_token.secret_arn]
                 ),
                 iam.PolicyStatement(
-                    actions=["sqs:GetQueueUrl", "sqs:ReceiveMessage", "sqs:DeleteMessage"],
+                    actions=["sqs:GetQueueUrl", "sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:ChangeMessageVisibility"],
                     resources=[monitoring_queue.queue_arn]
                 )
             ]
@@ -132,19 +242,42 @@ class MonitoringStack(Stack):
             roles=[bhakti_automated_role.role_name]   
         )
 
+        monitoring_code = aws_lambda.Code.from_asset(
+            "lambda",
+            bundling={
+                "image":aws_lambda.Runtime.PYTHON_3_12.bundling_image,
+                "command": [
+                    'bash','-c',
+                    'pip install -r requirements.txt -t /asset-output && cp -au . /asset-output'
+                ],
+            },
+        )
+
+        # each shard fetches, filters and enqueues one partition of the pages the monitoring lambda planned
+        crawl_shard_lambda = aws_lambda.Function(
+            self,
+            "crawl_shard_lambda",
+            code=monitoring_code,
+            handler="monitoring_lambda.shard_handler",
+            timeout=Duration.seconds(900),
+            runtime=aws_lambda.Runtime.PYTHON_3_12,
+            memory_size=1024,
+            log_group=bhakti_log_group,
+            environment={
+                'DYNAMO_TABLE' : status_table.table_name,
+                'WORKING_QUEUE' : monitoring_queue.queue_name,
+                'HF_TOKEN' : huggingface_token.secret_name,
+                'AWS_REG' : self.region,
+                'MESSAGE_GROUPING' : 'buckets',
+                'MESSAGE_GROUP_BUCKETS' : '16',
+            }
+        )
+        crawl_shard_lambda.role.attach_inline_policy(monitoring_execution_policy)
+
         monitoring_lambda = aws_lambda.Function(
             self,
             "monitoring_lambda",
-            code=aws_lambda.Code.from_asset(
-                "lambda",
-                bundling={
-                    "image":aws_lambda.Runtime.PYTHON_3_12.bundling_image,
-                    "command": [
-                        'bash','-c',
-                        'pip install -r requirements.txt -t /asset-output && cp -au . /asset-output'
-                    ],
-                },
-            ),
+            code=monitoring_code,
             handler="monitoring_lambda.handler",
             timeout=Duration.seconds(900),
             runtime=aws_lambda.Runtime.PYTHON_3_12,
@@ -159,10 +292,22 @@ class MonitoringStack(Stack):
                 'LOGGING_BUCKET' : bhakti_analysis_bucket.bucket_name,
                 'ANALYSIS_BUCKET' : script_asset.s3_bucket_name,
                 'ANALYSIS_PATH' : script_asset.s3_object_key,
+                'VERDICT_TABLE' : verdict_table.table_name,
+                'CRAWL_SHARD_FUNCTION' : crawl_shard_lambda.function_name,
+                'CRAWL_SHARDS' : '8',
+                'MESSAGES_PER_WORKER' : str(messages_per_worker),
+                # the lambda consumer drains the queue by itself, no workers to launch
+                'MAX_WORKERS' : str(max_workers if consumer == "ec2" else 0),
+                'EC2_AMI' : machine_image_id,
+                'INSTANCE_TYPE' : instance_type,
+                'USE_SPOT' : str(use_spot).lower(),
+                'MESSAGE_GROUPING' : 'buckets',
+                'MESSAGE_GROUP_BUCKETS' : '16',
             }
         )
 
         monitoring_lambda.role.attach_inline_policy(monitoring_execution_policy)
+        crawl_shard_lambda.grant_invoke(monitoring_lambda)
         script_asset.grant_read(bhakti_automated_role)
 
         keras_monitoring_event_rule = aws_events.Rule(
@@ -176,3 +321,11 @@ class MonitoringStack(Stack):
 
         keras_monitoring_event_rule.add_target(aws_events_targets.LambdaFunction(monitoring_lambda))
 
+        if consumer == "lambda":
+            AnalysisConsumer(self, "analysis_consumer",
+                queue=monitoring_queue,
+                status_table=status_table,
+                verdict_table=verdict_table,
+                hf_token=huggingface_token,
+                log_group=bhakti_log_group,
+            )
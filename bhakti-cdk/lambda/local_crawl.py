@@ -0,0 +1,135 @@
+"""
+Runs the sharded monitoring crawl on one machine, with each shard on its own thread instead
+of its own lambda invocation. By default it serves a stub Hugging Face listing with some
+per-request latency and swaps the status table and queue for in-memory stand-ins, so the
+effect of the shard count on the crawl's wall time can be measured offline:
+
+    python local_crawl.py --models 20000 --latency 0.2 --shards 1 4 16
+
+Pass --hf-endpoint to crawl a real listing, and --aws to talk to real (or localstack/moto
+server, via AWS_ENDPOINT_URL) DynamoDB and SQS using the usual DYNAMO_TABLE and
+WORKING_QUEUE variables.
+"""
+import json
+import os
+import threading
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('CRAWL_SHARD_FUNCTION', 'local')
+
+import monitoring_lambda  # noqa: E402
+
+PAGE_SIZE = 1000
+
+
+def stub_models(count):
+    """Newest first, every third repo has a keras_metadata.pb."""
+    start = datetime(2024, 1, 1)
+    models = []
+    for i in range(count):
+        siblings = [{'rfilename': 'README.md'}]
+        if i % 3 == 0:
+            siblings.append({'rfilename': 'keras_metadata.pb'})
+        models.append({
+            'id': f'author{i % 97}/model-{i}',
+            'lastModified': (start - timedelta(minutes=i)).strftime(monitoring_lambda.DATE_FORMAT),
+            'siblings': siblings,
+        })
+    return models
+
+
+def serve_stub_hub(models, latency):
+    """Serves a cursor paged /api/models listing on a free local port. Returns the endpoint."""
+
+    class StubHub(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            query = parse_qs(parts.query)
+            fields = query.get('expand[]', [])
+            offset = int(query.get('cursor', ['0'])[0])
+            page = [
+                {'id': model['id'], **{field: model[field] for field in fields if field in model}}
+                for model in models[offset:offset + PAGE_SIZE]
+            ]
+            # full pages cost more to build and send than the lastModified only listing
+            time.sleep(latency if 'siblings' in fields else latency / 4)
+            body = json.dumps(page).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            if offset + PAGE_SIZE < len(models):
+                query['cursor'] = [str(offset + PAGE_SIZE)]
+                next_url = f'{endpoint}{parts.path}?{urlencode(query, doseq=True)}'
+                self.send_header('Link', f'<{next_url}>; rel="next"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHub)
+    endpoint = f'http://127.0.0.1:{server.server_port}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return endpoint
+
+
+def stub_aws():
+    """Replaces the status table and queue with in-memory stand-ins. Returns the list every
+    enqueued model ends up in."""
+    enqueued = []
+    lock = threading.Lock()
+    state = {}
+
+    def enqueue_updated_models(keras_models):
+        keras_models = list(keras_models)
+        with lock:
+            enqueued.extend(keras_models)
+        return len(keras_models) > 0
+
+    def save_crawl_state(last_modified, cursor=None, pending_pages=None):
+        state.clear()
+        state.update(last_modified=last_modified, pending_pages=pending_pages or [])
+
+    monitoring_lambda.enqueue_updated_models = enqueue_updated_models
+    monitoring_lambda.get_crawl_state = lambda: dict(state)
+    monitoring_lambda.save_crawl_state = save_crawl_state
+    return enqueued
+
+
+def run_local_shard(shard):
+    return monitoring_lambda.shard_handler(shard, None)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--hf-endpoint', help='crawl this endpoint instead of a stub listing')
+    parser.add_argument('--models', type=int, default=10000, help='repos in the stub listing')
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds per stub listing page')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--aws', action='store_true', help='use real DynamoDB and SQS')
+    args = parser.parse_args()
+
+    monitoring_lambda.HF_ENDPOINT = args.hf_endpoint or serve_stub_hub(stub_models(args.models), args.latency)
+    monitoring_lambda.LISTING_MODE = 'full'
+    monitoring_lambda.get_api_token = lambda: os.getenv('HUGGINGFACE_TOKEN', '')
+    enqueued = None if args.aws else stub_aws()
+
+    for shards in args.shards:
+        monitoring_lambda.CRAWL_SHARDS = shards
+        if enqueued is not None:
+            enqueued.clear()
+            monitoring_lambda.save_crawl_state(None)
+        started = time.perf_counter()
+        monitoring_lambda.fan_out_crawl(monitoring_lambda.get_api_token(), None, run_shard=run_local_shard)
+        elapsed = time.perf_counter() - started
+        found = f', {len(enqueued)} keras models enqueued' if enqueued is not None else ''
+        print(f'{shards:>3} shards: {elapsed:.2f}s{found}')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,33 +7,71 @@ import requests
 import re
 import hashlib
 import os
+import time
+from botocore.config import Config
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
-EC2_AMI = 'ami-0b28c78d9f575dfa1'
+EC2_AMI = os.getenv('EC2_AMI', 'ami-0b28c78d9f575dfa1')
+INSTANCE_TYPE = os.getenv('INSTANCE_TYPE', 'g4dn.xlarge')
+USE_SPOT = os.getenv('USE_SPOT', 'false').lower() == 'true'
 DYNAMO_TABLE = os.getenv('DYNAMO_TABLE')
 WORKING_QUEUE = os.getenv('WORKING_QUEUE')
 HF_TOKEN = os.getenv('HF_TOKEN')
 AWS_REGION = os.getenv('AWS_REG')
 INSTANCE_PROFILE_ARN = os.getenv('INSTANCE_PROFILE_ARN')
 LOGGING_BUCKET = os.getenv('LOGGING_BUCKET')
+VERDICT_TABLE = os.getenv('VERDICT_TABLE', '')
 ANALYSIS_BUCKET = os.getenv('ANALYSIS_BUCKET')
 ANALYSIS_PATH = os.getenv('ANALYSIS_PATH')
+HF_ENDPOINT = os.getenv('HF_ENDPOINT', 'https://huggingface.co')
+# 'filtered' only lists keras repos changed since the last crawl, 'full' lists the whole hub
+LISTING_MODE = os.getenv('LISTING_MODE', 'filtered')
+KERAS_LIBRARIES = os.getenv('KERAS_LIBRARIES', 'keras,tf-keras').split(',')
+CRAWL_STATE_KEY = {'repo': '__bhakti_crawl_state__', 'version': 'listing'}
+# stop paging with this much of the lambda timeout left so the checkpoint gets written
+CRAWL_TIME_MARGIN_MS = int(os.getenv('CRAWL_TIME_MARGIN_MS', '60000'))
+DYNAMO_BATCH_SIZE = 100
+DIFF_WORKERS = int(os.getenv('DIFF_WORKERS', '8'))
+SQS_BATCH_SIZE = 10
+# one analysis worker per this many queued models, up to MAX_WORKERS running at once
+MESSAGES_PER_WORKER = int(os.getenv('MESSAGES_PER_WORKER', '500'))
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '4'))
+WORKER_TAG = {'Key': 'bhakti-role', 'Value': 'analysis-worker'}
+# FIFO queues hand out one message group at a time, so more groups means more workers can
+# drain the queue in parallel. 'single', 'author', 'repo' or 'buckets'
+MESSAGE_GROUPING = os.getenv('MESSAGE_GROUPING', 'single')
+MESSAGE_GROUP_BUCKETS = int(os.getenv('MESSAGE_GROUP_BUCKETS', '16'))
+SQS_BATCH_BYTES = 256 * 1024
+# when set, the scheduled run only plans the crawl and fans its pages out to this function
+CRAWL_SHARD_FUNCTION = os.getenv('CRAWL_SHARD_FUNCTION')
+CRAWL_SHARDS = int(os.getenv('CRAWL_SHARDS', '8'))
+# leftover pages are stored this many to a row, listing urls run to a few hundred bytes and
+# a dynamo item tops out at 400KB
+PENDING_PAGES_PER_ITEM = int(os.getenv('PENDING_PAGES_PER_ITEM', '500'))
+LISTING_FIELDS = ['lastModified', 'siblings']
 
 def get_user_data(bucket: str) -> str:
+    # python's zipfile does the unzipping since minimal images don't always ship unzip
     user_data = f"""#!/bin/bash
+mkdir -p /tmp/analysis
 aws s3 cp s3://{bucket} /tmp/analysis/scripts.zip
-unzip /tmp/analysis/scripts.zip -d /tmp/analysis
-chmod +x /tmp/analysis/monitoring_ec2_check.py
+python3 -m zipfile -e /tmp/analysis/scripts.zip /tmp/analysis
 export SQS_QUEUE={WORKING_QUEUE}
 export AWS_REG={AWS_REGION}
 export HUGGINGFACE_TOKEN={HF_TOKEN}
 export DYNAMO_STATUS_TABLE={DYNAMO_TABLE}
 export LOGGING_BUCKET={LOGGING_BUCKET}
-./tmp/analysis/monitoring_ec2_check.py"""
+export VERDICT_TABLE={VERDICT_TABLE}
+bash /tmp/analysis/bootstrap.sh"""
     return user_data
 
 def get_api_token():
@@ -69,130 +107,548 @@ def callHuggingFace(urlpointer, token):
     return response
 
 def findKeras(models, modelType): 
-    with open(f'/tmp/kerasFriends-{modelType}.txt', 'a' ) as kerasFriends:
-        for model in models:
-            for file in model['siblings']:
-                if modelType in file['rfilename']:
-                    model['keras_filename'] = file['rfilename']
-                    kerasFriends.write(json.dumps(model))
-                    kerasFriends.write("\n")
-
-def scanPublicModels(url, api_token, modelType):    
+    for model in models:
+        for file in model['siblings']:
+            if modelType in file['rfilename']:
+                model['keras_filename'] = file['rfilename']
+                yield model
+                break
+
+def get_listing_urls():
+    if LISTING_MODE == 'full':
+        return [f'{HF_ENDPOINT}/api/models/?full=full']
+    # newest first, and only the fields findKeras and the ec2 worker need
+    return [
+        f'{HF_ENDPOINT}/api/models?filter={library}&sort=lastModified&direction=-1'
+        '&limit=1000&expand[]=lastModified&expand[]=siblings'
+        for library in KERAS_LIBRARIES
+    ]
+
+def with_fields(url, fields):
+    """Rewrites a listing or page url to expand only the given fields. The paging cursor
+    doesn't depend on the expanded fields, so a page planned with a light listing can be
+    fetched in full by a shard.
+    """
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query) if key not in ('expand[]', 'full')]
+    query += [('expand[]', field) for field in fields]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+def next_page(response):
+    try:
+        return re.search('<(.+?)>', response.headers['link']).group(1)
+    except Exception:
+        return 'DONE'
+
+def scanPublicModels(url, api_token, modelType, since=None):    
+    """Filters one page of the listing for keras models. When the listing is sorted newest first,
+    passing the previous crawl's high-water mark as since stops paging once we reach models
+    we've already seen. Returns a generator over the keras models on the page, the next page
+    url (or 'DONE') and the newest lastModified seen.
+    """
     response = callHuggingFace(url, api_token)
     models = response.json()
-    findKeras(models, modelType)
+    newest = max((model['lastModified'] for model in models if model.get('lastModified')), default=None)
+    if since:
+        fresh = [model for model in models if model.get('lastModified', '') >= since]
+        caught_up = len(fresh) < len(models)
+        models = fresh
+    else:
+        caught_up = False
+    kerasFriends = findKeras(models, modelType)
 
-    try:
-        nextPage = response.headers['link']
-        url = re.search('<(.+?)>', nextPage).group(1)
-        return url
+    if caught_up:
+        return kerasFriends, 'DONE', newest
+    return kerasFriends, next_page(response), newest
 
-    except Exception as sslE:
-        url = 'DONE'
-        return url
 
+# built once per container so warm invocations reuse the connection pool
+dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
 
-def check_if_model_updated(id, lastModified):
-    latest_modification_date = datetime.strptime(lastModified, DATE_FORMAT)
-    try:
-        dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
-        table = dynamodb.Table(DYNAMO_TABLE)
-        response = table.get_item(
-            Key={'repo': id, 'version': 'v0'} 
-        )
+def pending_pages_key(chunk):
+    return {'repo': CRAWL_STATE_KEY['repo'], 'version': f'pending-{chunk}'}
+
+def get_crawl_state():
+    """The crawl state row holds the lastModified high-water mark of the last finished crawl
+    and, while a crawl is only partway done, a cursor saying where to pick it back up. The
+    pages a fanned out crawl left over are kept in rows of their own, which come back
+    joined up as pending_pages.
+    """
+    table = dynamodb.Table(DYNAMO_TABLE)
+    state = table.get_item(Key=CRAWL_STATE_KEY, ConsistentRead=True).get('Item', {})
+    chunks = int(state.pop('pending_chunks', 0))
+    for chunk in range(chunks):
+        item = table.get_item(Key=pending_pages_key(chunk), ConsistentRead=True).get('Item', {})
+        state.setdefault('pending_pages', []).extend(item.get('pages', []))
+    return state
+
+def save_crawl_state(last_modified, cursor=None, pending_pages=None):
+    table = dynamodb.Table(DYNAMO_TABLE)
+    item = dict(CRAWL_STATE_KEY, updated=datetime.now().strftime(DATE_FORMAT))
+    if last_modified:
+        item['last_modified'] = last_modified
+    if cursor:
+        item['cursor'] = cursor
+    # a full listing can leave thousands of pages over, far more than fit in one item
+    chunks = list(batched(pending_pages or [], PENDING_PAGES_PER_ITEM))
+    for chunk, pages in enumerate(chunks):
+        table.put_item(Item=dict(pending_pages_key(chunk), pages=pages))
+    if chunks:
+        item['pending_chunks'] = len(chunks)
+    previous = table.put_item(Item=item, ReturnValues='ALL_OLD').get('Attributes', {})
+    for chunk in range(len(chunks), int(previous.get('pending_chunks', 0))):
+        table.delete_item(Key=pending_pages_key(chunk))
+
+def out_of_time(context):
+    return context is not None and context.get_remaining_time_in_millis() < CRAWL_TIME_MARGIN_MS
 
-        if 'Item' not in response.keys():
-            logger.info(f'New model {id} identified, enqueing for processing')
+def check_if_model_updated(id, lastModified, last_checked=None):
+    latest_modification_date = datetime.strptime(lastModified, DATE_FORMAT)
+    if last_checked is None:
+        logger.info(f'New model {id} identified, enqueing for processing')
+        return True
+    else:
+        last_checked =  datetime.strptime(last_checked, DATE_FORMAT) 
+        if last_checked == latest_modification_date:
+            logger.info(f"We're up to date with analysis for {id}")
+            return False
+        elif last_checked < latest_modification_date:
+            logger.info(f"New version detected for {id}!")
             return True
-        else:
-            last_checked =  datetime.strptime(response['Item']['modified_date'], DATE_FORMAT) 
-            if last_checked == latest_modification_date:
-                logger.info(f"We're up to date with analysis for {id}")
-                return False
-            elif last_checked < latest_modification_date:
-                logger.info(f"New version detected for {id}!")
-                return True
 
-    except Exception as e:
-        logging.error(f'We had some trouble with dynamoDB: {e}')
+def get_last_checked(ids):
+    """Looks up the modified_date of the latest analysis (v0) for up to 100 repos with a single
+    BatchGetItem, retrying any keys dynamo hands back unprocessed. Returns a dict of repo to date.
+    """
+    client = dynamodb.meta.client
+    request = {DYNAMO_TABLE: {
+        'Keys': [{'repo': id, 'version': 'v0'} for id in ids],
+        'ProjectionExpression': '#repo, modified_date',
+        'ExpressionAttributeNames': {'#repo': 'repo'},
+    }}
+    last_checked = {}
+    backoff = 0.05
+    while request:
+        response = client.batch_get_item(RequestItems=request)
+        for item in response['Responses'].get(DYNAMO_TABLE, []):
+            last_checked[item['repo']] = item.get('modified_date')
+        request = response.get('UnprocessedKeys')
+        if request:
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 2)
+    return last_checked
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
+def diff_chunk(chunk, lookup):
+    last_checked = lookup.result()
+    for model in chunk:
+        lastModified = model['lastModified'] 
+        logger.info(f'model: {model["id"]} last modified on {lastModified}')
+        if check_if_model_updated(model['id'], lastModified, last_checked.get(model['id'])):
+            yield model
 
-def send_sqs(message, queue):
-    sqs = boto3.resource("sqs")
-    sqs_queue = sqs.get_queue_by_name(QueueName=queue)
+def find_updated_models(models):
+    """Lazily diffs huggingface models against the status table in chunks of 100 repos, with
+    up to DIFF_WORKERS chunk lookups in flight at once. Yields the models that are new or have
+    changed, so only a bounded window of the listing is ever held in memory.
+    """
+    with ThreadPoolExecutor(max_workers=DIFF_WORKERS) as pool:
+        in_flight = deque()
+        for chunk in batched(models, DYNAMO_BATCH_SIZE):
+            # BatchGetItem rejects duplicate keys
+            ids = list(dict.fromkeys(model['id'] for model in chunk))
+            in_flight.append((chunk, pool.submit(get_last_checked, ids)))
+            if len(in_flight) >= DIFF_WORKERS:
+                yield from diff_chunk(*in_flight.popleft())
+        while in_flight:
+            yield from diff_chunk(*in_flight.popleft())
+
+
+# sqs clients are thread safe, so one client and one url lookup per queue serve every send
+sqs_client = boto3.client('sqs', region_name=AWS_REGION)
+
+@lru_cache(maxsize=None)
+def get_queue_url(queue):
+    return sqs_client.get_queue_url(QueueName=queue)['QueueUrl']
+
+def sqs_batches(entries):
+    """Groups message entries into send_message_batch sized lists of at most 10 messages
+    and 256KB."""
+    batch = []
+    batch_bytes = 0
+    for message in entries:
+        size = len(message['MessageBody'].encode('utf-8'))
+        if batch and (len(batch) == SQS_BATCH_SIZE or batch_bytes + size > SQS_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(message)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+def deduplication_id(model):
+    """Identifies a single revision of a model's keras file, so SQS drops any copy of the same
+    revision enqueued within its 5 minute deduplication window, whoever sends it.
+    """
+    revision = '\n'.join([model['id'], model['lastModified'], model.get('keras_filename', '')])
+    return hashlib.sha256(revision.encode('utf-8')).hexdigest()
+
+def message_group_id(model):
+    """Every revision of a repo always lands in the same group, so a repo's messages stay in
+    order and per group deduplication still catches repeats.
+    """
     groupid = "bhakti_updates"
-    deduplicationid = hashlib.md5(
-        (
-            groupid + json.dumps(message) + datetime.now().strftime("%d%m%Y%H%M%S")
-        ).encode("utf-8")
-    ).hexdigest()
-    response = sqs_queue.send_message(
-        MessageBody=message,
-        MessageGroupId=groupid,
-        MessageDeduplicationId=deduplicationid,
+    if MESSAGE_GROUPING == 'repo':
+        return model['id']
+    if MESSAGE_GROUPING == 'author':
+        return model['id'].split('/')[0]
+    if MESSAGE_GROUPING == 'buckets':
+        bucket = int(hashlib.sha256(model['id'].encode('utf-8')).hexdigest()[:8], 16) % MESSAGE_GROUP_BUCKETS
+        return f'{groupid}_{bucket}'
+    return groupid
+
+def send_sqs_batch(messages, queue, attempts=3):
+    """Sends up to 10 messages, each a dict with a MessageBody, MessageGroupId and
+    MessageDeduplicationId, with one SendMessageBatch call, resending any entries SQS reports
+    as failed. Returns the number of messages sent.
+    """
+    entries = [dict(message, Id=str(position)) for position, message in enumerate(messages)]
+
+    backoff = 0.1
+    for attempt in range(attempts):
+        response = sqs_client.send_message_batch(QueueUrl=get_queue_url(queue), Entries=entries)
+        failed = {failure['Id']: failure for failure in response.get('Failed', [])}
+        entries = [entry for entry in entries if entry['Id'] in failed]
+        if not entries:
+            break
+        logger.info(f'Resending {len(entries)} messages: {list(failed.values())}')
+        time.sleep(backoff)
+        backoff *= 2
+    if entries:
+        logger.error(f'Failed to enqueue {len(entries)} messages after {attempts} attempts')
+    return len(messages) - len(entries)
+
+def queue_messages(updated_models):
+    for model in updated_models:
+        model['bhakti_request_date'] = datetime.now().strftime(DATE_FORMAT)
+        logger.info(f'send_sqs_message with {model}')
+        if len(model['siblings']) > 100:
+            model['siblings'] = 'too_many_files'
+            continue
+        yield {
+            'MessageBody': json.dumps(model),
+            'MessageGroupId': message_group_id(model),
+            'MessageDeduplicationId': deduplication_id(model),
+        }
+
+class EnqueueError(Exception):
+    """Raised when some of a page's changed models didn't make it onto the queue, so the crawl
+    mustn't checkpoint past that page. sent is how many did."""
+    def __init__(self, message, sent=0):
+        super().__init__(message)
+        self.sent = sent
+
+def enqueue_updated_models(keras_models):
+    """Streams keras models through the diff against dynamo and on to the working queue in
+    batches of 10. Returns the number of models enqueued, raising EnqueueError if any couldn't
+    be.
+    """
+    sent = 0
+    failed = 0
+    try:
+        for batch in sqs_batches(queue_messages(find_updated_models(keras_models))):
+            delivered = send_sqs_batch(batch, WORKING_QUEUE)
+            sent += delivered
+            failed += len(batch) - delivered
+    except Exception as e:
+        logging.error(f'We had some trouble with dynamoDB or SQS: {e}')
+        raise EnqueueError(f'stopped after enqueueing {sent} models: {e}', sent) from e
+    if failed:
+        raise EnqueueError(f'{failed} models could not be enqueued', sent)
+    return sent
+
+def start_analysis_instance(count=1):
+    ec2 = boto3.client('ec2', region_name=AWS_REGION)
+    spot = {}
+    if USE_SPOT:
+        # an interrupted worker's messages just reappear on the queue once their visibility lapses
+        spot['InstanceMarketOptions'] = {
+            'MarketType': 'spot',
+            'SpotOptions': {'SpotInstanceType': 'one-time', 'InstanceInterruptionBehavior': 'terminate'},
+        }
+    instance = ec2.run_instances(
+        ImageId=EC2_AMI,
+        InstanceType=INSTANCE_TYPE,
+        UserData=get_user_data(f'{ANALYSIS_BUCKET}/{ANALYSIS_PATH}'),
+        IamInstanceProfile={ 'Arn': INSTANCE_PROFILE_ARN },
+        InstanceInitiatedShutdownBehavior='terminate',
+        KeyName='bhakti-ssh-key',
+        TagSpecifications=[{'ResourceType': 'instance', 'Tags': [WORKER_TAG]}],
+        # take whatever capacity there is rather than failing the whole launch
+        MinCount=1,
+        MaxCount=count,
+        **spot
     )
-    return response
+
+    instance_data = {
+        'status_code': instance['ResponseMetadata']['HTTPStatusCode']
+    }
+
+    if instance['ResponseMetadata']['HTTPStatusCode'] == 200:
+        logger.info(f'Started {len(instance["Instances"])} EC2 instances for analysis...')
+        instance_data['instance_ids'] = [started['InstanceId'] for started in instance['Instances']]
+    else:
+        logger.error('EC2 instance failed to launch')
+        instance_data['instance_ids'] = 'N/A, FAILED'
+
+    logger.info(instance_data)
+
+def queue_depth():
+    """Approximate number of models waiting to be picked up. Messages a worker already has
+    in flight aren't counted, that worker is taking care of them."""
+    attributes = sqs_client.get_queue_attributes(
+        QueueUrl=get_queue_url(WORKING_QUEUE), AttributeNames=['ApproximateNumberOfMessages']
+    )['Attributes']
+    return int(attributes['ApproximateNumberOfMessages'])
+
+def running_workers():
+    """Counts analysis workers that are starting up or still draining the queue. Workers
+    terminate themselves once the queue is empty."""
+    ec2 = boto3.client('ec2', region_name=AWS_REGION)
+    paginator = ec2.get_paginator('describe_instances')
+    filters = [
+        {'Name': f'tag:{WORKER_TAG["Key"]}', 'Values': [WORKER_TAG['Value']]},
+        {'Name': 'instance-state-name', 'Values': ['pending', 'running']},
+    ]
+    return sum(
+        len(reservation['Instances'])
+        for page in paginator.paginate(Filters=filters)
+        for reservation in page['Reservations']
+    )
+
+def workers_to_launch(depth, running, per_worker=None, cap=None):
+    """Sizes the fleet at one worker per per_worker queued models, at most cap in total.
+    Workers that are still draining count towards the fleet, so they're only topped up when
+    the backlog has outgrown them."""
+    per_worker = per_worker or MESSAGES_PER_WORKER
+    cap = MAX_WORKERS if cap is None else cap
+    wanted = min(cap, -(-depth // per_worker))
+    return max(0, wanted - running)
+
+def schedule_workers(new_models=False):
+    # the approximate depth can lag behind messages we've only just sent
+    depth = queue_depth()
+    if new_models:
+        depth = max(depth, 1)
+    running = running_workers()
+    count = workers_to_launch(depth, running)
+    logger.info(f'{depth} models queued, {running} workers running, launching {count}')
+    if count:
+        start_analysis_instance(count)
+    return count
+
+def unseen(models, seen):
+    """Drops repos already handled this invocation; repos tagged with more than one keras
+    library show up in more than one listing."""
+    for model in models:
+        if model['id'] not in seen:
+            seen.add(model['id'])
+            yield model
+
+def crawl(api_token, context):
+    """Pages through the listings, enqueueing each page's changed keras models before
+    checkpointing past it, so a crawl cut short by the timeout resumes from the next page
+    on the following run. A page that couldn't be fully enqueued is checkpointed itself and
+    the crawl stops there. Returns True if anything was enqueued.
+    """
+    state = get_crawl_state()
+    cursor = state.get('cursor')
+    if cursor and cursor.get('mode') != LISTING_MODE:
+        logger.info(f'Dropping a {cursor.get("mode")} crawl checkpoint, we are crawling {LISTING_MODE} now')
+        cursor = None
+    urls = get_listing_urls()
+
+    if cursor:
+        since = cursor.get('since')
+        newest = cursor.get('newest')
+        first_listing = int(cursor['listing'])
+        resume_url = cursor.get('next_url')
+        logger.info(f'Resuming crawl from {resume_url or urls[first_listing]}')
+    else:
+        since = state.get('last_modified') if LISTING_MODE != 'full' else None
+        newest = since
+        first_listing = 0
+        resume_url = None
+    logger.info(f'Listing {LISTING_MODE} models changed since {since}')
+
+    new_models = False
+    seen = set()
+    for listing in range(first_listing, len(urls)):
+        next_url = resume_url if listing == first_listing and resume_url else urls[listing]
+        while next_url != 'DONE':
+            if out_of_time(context):
+                logger.info(f'Running out of time, checkpointing the crawl at {next_url}')
+                save_crawl_state(state.get('last_modified'), {
+                    'mode': LISTING_MODE, 'listing': listing, 'next_url': next_url,
+                    'since': since, 'newest': newest,
+                })
+                return new_models
+            page_url = next_url
+            keras_models, next_url, page_newest = scanPublicModels(page_url, api_token, 'keras_metadata.pb', since=since)
+            try:
+                if enqueue_updated_models(unseen(keras_models, seen)):
+                    new_models = True
+            except EnqueueError as e:
+                # neither the checkpoint nor the high-water mark can move past models we dropped
+                logger.error(f'Checkpointing the crawl at {page_url}, not all of it was enqueued: {e}')
+                save_crawl_state(state.get('last_modified'), {
+                    'mode': LISTING_MODE, 'listing': listing, 'next_url': page_url,
+                    'since': since, 'newest': newest,
+                })
+                return new_models or e.sent > 0
+            if page_newest and (newest is None or page_newest > newest):
+                newest = page_newest
+            if next_url != 'DONE':
+                checkpoint = {'listing': listing, 'next_url': next_url}
+            elif listing + 1 < len(urls):
+                checkpoint = {'listing': listing + 1}
+            else:
+                checkpoint = None
+            if checkpoint:
+                checkpoint.update({'mode': LISTING_MODE, 'since': since, 'newest': newest})
+                save_crawl_state(state.get('last_modified'), checkpoint)
+
+    # only move the high-water mark once everything newer than it has been enqueued
+    save_crawl_state(newest if LISTING_MODE != 'full' else state.get('last_modified'))
+    logger.info(f'Finished crawling, high-water mark is now {newest}')
+    return new_models
+
+def plan_crawl(api_token, since):
+    """Walks the listings asking only for lastModified, which is far cheaper than paging with
+    siblings, and returns the url of every page a shard needs to fetch in full along with the
+    newest lastModified seen.
+    """
+    pages = []
+    newest = since
+    for url in get_listing_urls():
+        next_url = with_fields(url, ['lastModified'])
+        while next_url != 'DONE':
+            response = callHuggingFace(next_url, api_token)
+            models = response.json()
+            if not models:
+                break
+            pages.append(with_fields(next_url, LISTING_FIELDS))
+            modified = [model['lastModified'] for model in models if model.get('lastModified')]
+            if modified and (newest is None or max(modified) > newest):
+                newest = max(modified)
+            if since and any(date < since for date in modified):
+                break
+            next_url = next_page(response)
+    return pages, newest
+
+def split_pages(pages, shards):
+    """Deals the pages out into at most shards contiguous partitions of near equal size."""
+    shards = max(1, min(shards, len(pages)))
+    size, extra = divmod(len(pages), shards)
+    partitions = []
+    start = 0
+    for shard in range(shards):
+        end = start + size + (1 if shard < extra else 0)
+        partitions.append(pages[start:end])
+        start = end
+    return [partition for partition in partitions if partition]
+
+def crawl_pages(pages, api_token, since, context, deadline=None):
+    """Runs one shard of a fanned out crawl: fetches each page in full, filters it for keras
+    models and enqueues the changed ones. Returns whether anything was enqueued and the pages
+    left over if the shard ran short of its own time or the coordinator's deadline (epoch ms),
+    or couldn't enqueue all of a page, which is then left over along with the rest.
+    """
+    new_models = False
+    seen = set()
+    for position, url in enumerate(pages):
+        if out_of_time(context) or (deadline and time.time() * 1000 >= deadline):
+            logger.info(f'Running out of time with {len(pages) - position} pages left in this shard')
+            return new_models, pages[position:]
+        keras_models, _, _ = scanPublicModels(url, api_token, 'keras_metadata.pb', since=since)
+        try:
+            if enqueue_updated_models(unseen(keras_models, seen)):
+                new_models = True
+        except EnqueueError as e:
+            logger.error(f'Leaving {len(pages) - position} pages for the next run, not all of {url} was enqueued: {e}')
+            return new_models or e.sent > 0, pages[position:]
+    return new_models, []
+
+# shards can run for the whole lambda timeout, so don't let the sync invoke time out or retry
+lambda_client = boto3.client('lambda', region_name=AWS_REGION, config=Config(read_timeout=900, retries={'max_attempts': 0}))
+
+def invoke_shard(shard):
+    response = lambda_client.invoke(FunctionName=CRAWL_SHARD_FUNCTION, Payload=json.dumps(shard).encode('utf-8'))
+    result = json.loads(response['Payload'].read() or 'null')
+    if response.get('FunctionError') or not isinstance(result, dict):
+        logger.error(f'Crawl shard failed: {result}')
+        return {'new_models': False, 'remaining': shard['pages']}
+    return result
+
+def fan_out_crawl(api_token, context, run_shard=invoke_shard):
+    """Plans the crawl, then runs the pages as CRAWL_SHARDS partitions in parallel, each in its
+    own invocation of run_shard. Pages a shard didn't get to are kept in the crawl state and
+    handed out first on the next run; the high-water mark only moves once none are left.
+    """
+    state = get_crawl_state()
+    since = state.get('last_modified') if LISTING_MODE != 'full' else None
+    pending = list(state.get('pending_pages', []))
+    pages, newest = plan_crawl(api_token, since)
+    pages = pending + [page for page in pages if page not in pending]
+    partitions = split_pages(pages, CRAWL_SHARDS)
+    logger.info(f'Crawling {len(pages)} pages changed since {since} across {len(partitions)} shards')
+    if not partitions:
+        return False
+
+    # shards have to hand back their leftovers while the coordinator still has time to save them
+    deadline = None
+    if context is not None:
+        deadline = int(time.time() * 1000) + context.get_remaining_time_in_millis() - CRAWL_TIME_MARGIN_MS
+    shards = [{'pages': partition, 'since': since, 'deadline': deadline} for partition in partitions]
+    with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        results = list(pool.map(run_shard, shards))
+
+    new_models = any(result.get('new_models') for result in results)
+    remaining = [page for result in results for page in result.get('remaining', [])]
+    if remaining:
+        logger.info(f'{len(remaining)} pages left over, they will be crawled first next run')
+        save_crawl_state(state.get('last_modified'), pending_pages=remaining)
+    else:
+        save_crawl_state(newest if LISTING_MODE != 'full' else state.get('last_modified'))
+        logger.info(f'Finished crawling, high-water mark is now {newest}')
+    return new_models
+
+def shard_handler(event, context):
+    """Entry point for a single crawl shard, invoked by the coordinator with its pages."""
+    logger.info(f'Crawling a shard of {len(event["pages"])} pages')
+    new_models, remaining = crawl_pages(
+        event['pages'], get_api_token(), event.get('since'), context, event.get('deadline'))
+    return {'new_models': new_models, 'remaining': remaining}
 
 def handler(event, context):
     logger.info("request: {}".format(json.dumps(event)))
 
     api_token = get_api_token()
-    url = "https://huggingface.co/api/models/?full=full"
-    scanning = True
-    new_models = False
 
     try:
-        next_url = scanPublicModels(url, api_token, 'keras_metadata.pb')
-        while scanning == True:
-            if 'huggingface' in next_url:
-                next_url = scanPublicModels(next_url, api_token, 'keras_metadata.pb')
-            else:
-                scanning = False
-     
-        with open('/tmp/kerasFriends-keras_metadata.pb.txt', 'r') as results:
-            current_keras_models = []
-            for line in results.readlines():
-                current_model = json.loads(line)
-                current_keras_models.append(current_model)
-        
-        for model in current_keras_models:
-            lastModified = model['lastModified'] 
-            logger.info(f'model: {model["modelId"]} last modified on {lastModified}')
-            update_needed = check_if_model_updated(model['id'], lastModified)
-            if update_needed:
-                new_models = True
-                model['bhakti_request_date'] = datetime.now().strftime(DATE_FORMAT)
-                logger.info(f'send_sqs_message with {model}')
-                if len(model['siblings']) > 100:
-                    model['siblings'] = 'too_many_files'
-                    continue
-                send_sqs(json.dumps(model), WORKING_QUEUE)
-
-        if new_models:
-            ec2 = boto3.client('ec2', region_name=AWS_REGION)
-            instance = ec2.run_instances(
-                ImageId=EC2_AMI,
-                InstanceType="g4dn.xlarge",
-                UserData=get_user_data(f'{ANALYSIS_BUCKET}/{ANALYSIS_PATH}'),
-                IamInstanceProfile={ 'Arn': INSTANCE_PROFILE_ARN },
-                InstanceInitiatedShutdownBehavior='terminate',
-                KeyName='bhakti-ssh-key',
-                MinCount=1,
-                MaxCount=1
-            )
-
-            instance_data = {
-                'status_code': instance['ResponseMetadata']['HTTPStatusCode']
-            }
-
-            if instance['ResponseMetadata']['HTTPStatusCode'] == 200:
-                logger.info('Started an EC2 instance for analysis...')
-                instance_data['instance_id'] = instance['Instances'][0]['InstanceId']
-            else:
-                logger.error('EC2 instance failed to launch')
-                instance_data['instance_id'] = 'N/A, FAILED'
-
-            logger.info(instance_data)
+        if CRAWL_SHARD_FUNCTION:
+            new_models = fan_out_crawl(api_token, context)
+        else:
+            new_models = crawl(api_token, context)
+        schedule_workers(new_models)
     
     except Exception as e:
-        logger.error(e)
\ No newline at end of file
+        logger.error(e)
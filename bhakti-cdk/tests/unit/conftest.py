@@ -0,0 +1,12 @@
+import os
+import sys
+from pathlib import Path
+
+# the analysis scripts and lambdas are flat modules that import each other by name, like
+# they do when run
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "analysis"))
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "lambda"))
+# the benchmarks and fake hub that build the test models aren't shipped to the workers, they
+# only live in the analysis directory at the root of the repo
+sys.path.append(str(Path(__file__).resolve().parents[3] / "analysis"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
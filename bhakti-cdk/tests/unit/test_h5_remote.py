@@ -0,0 +1,88 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+import checkModel
+from h5_remote import DEFAULT_BLOCK_SIZE
+
+FIXTURE = Path(__file__).parent / "fixtures" / "lambda_weights.h5"
+REPO = "author/model"
+
+
+def serve(body, ranges=True):
+    """Serves body at /author/model/resolve/main/lambda_weights.h5, answering Range requests
+    with 206 unless ranges is False. Returns the server, which counts the bytes it sent."""
+
+    class FixtureHub(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != f"/{REPO}/resolve/main/{FIXTURE.name}":
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            requested = self.headers.get("Range", "")
+            start, end = 0, len(body) - 1
+            if ranges and requested.startswith("bytes="):
+                first, _, last = requested[len("bytes="):].partition("-")
+                start, end = int(first), min(int(last), len(body) - 1)
+                if start >= len(body):
+                    self.send_response(416)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+            else:
+                self.send_response(200)
+            chunk = body[start : end + 1]
+            self.send_header("Content-Length", str(len(chunk)))
+            self.end_headers()
+            self.wfile.write(chunk)
+            with server.lock:
+                server.sent += len(chunk)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHub)
+    server.lock = threading.Lock()
+    server.sent = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    servers = []
+
+    def start(ranges=True):
+        server = serve(FIXTURE.read_bytes(), ranges)
+        servers.append(server)
+        monkeypatch.setattr(checkModel, "HF_ENDPOINT", f"http://127.0.0.1:{server.server_port}")
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def test_remote_h5_matches_local(hub):
+    server = hub()
+    remote = checkModel.check_remote_h5_for_code(REPO, FIXTURE.name, "")
+    local = checkModel.check_h5_for_code(str(FIXTURE), REPO)
+
+    assert remote is not None
+    assert remote["header_only"] is True
+    assert remote["contains_code"] is True
+    for field in ("contains_code", "lambda_layers", "extracted_encoded_code", "yara_matches"):
+        assert remote[field] == local[field]
+    # the superblock, root object header and model_config, not the weights
+    assert server.sent <= 2 * DEFAULT_BLOCK_SIZE
+    assert server.sent < FIXTURE.stat().st_size / 4
+
+
+def test_remote_h5_falls_back_without_ranges(hub):
+    hub(ranges=False)
+    assert checkModel.check_remote_h5_for_code(REPO, FIXTURE.name, "") is None
@@ -0,0 +1,58 @@
+import checkModel
+from bench_rules import SHELL, dense, lambda_layer, lambda_payload, model_config, saved_metadata
+from verdict_cache import CACHE_ENV
+
+
+def wrapped(name, layer):
+    return {"class_name": "TimeDistributed", "config": {"name": name, "layer": layer}}
+
+
+def write_pb(path, nodes):
+    path.write_bytes(saved_metadata(nodes))
+    return path
+
+
+def test_wrapped_lambda_is_reported_once(tmp_path):
+    inner = lambda_layer("lambda", SHELL)
+    outer = wrapped("time_distributed", inner)
+    # keras saves the wrapped layer as a node of its own, after the wrapper
+    pb = write_pb(
+        tmp_path / "keras_metadata.pb",
+        [
+            ("_tf_keras_network", model_config([dense("dense"), outer])),
+            ("_tf_keras_layer", dense("dense")),
+            ("_tf_keras_layer", outer),
+            ("_tf_keras_layer", inner),
+        ],
+    )
+    # room for the payload once but not twice
+    budget = len(lambda_payload(SHELL)) * 3 // 2
+    result = checkModel.check_pb_for_code(pb, "author/model", max_bytes=budget)
+    assert [layer["index"] for layer in result["lambda_layers"]] == [3]
+    assert "lambda_layers_truncated" not in result
+
+
+def test_layer_budget_counts_every_node(tmp_path):
+    nodes = [("_tf_keras_layer", dense(f"dense_{i}")) for i in range(50)]
+    nodes.append(("_tf_keras_layer", lambda_layer("lambda", SHELL)))
+    pb = write_pb(tmp_path / "keras_metadata.pb", nodes)
+    result = checkModel.check_pb_for_code(pb, "author/model", max_layers=10)
+    assert result["lambda_layers"] == []
+    assert result["lambda_layers_truncated"]
+    result = checkModel.check_pb_for_code(pb, "author/model", max_layers=51)
+    assert [layer["index"] for layer in result["lambda_layers"]] == [50]
+    assert "lambda_layers_truncated" not in result
+
+
+def test_every_lambda_payload_is_analyzed(tmp_path, monkeypatch):
+    monkeypatch.setenv(CACHE_ENV, str(tmp_path / "verdicts.sqlite3"))
+    layers = [lambda_layer("lambda", "lambda x: x * 2.0"), lambda_layer("lambda_1", SHELL)]
+    pb = write_pb(tmp_path / "keras_metadata.pb", [("_tf_keras_layer", layer) for layer in layers])
+
+    # the second time round the payload analyses come out of the cache
+    for _ in range(2):
+        result = checkModel.analyze_code(checkModel.check_pb_for_code(pb, "author/model"))
+        harmless, shell = result["lambda_layers"]
+        assert "os" not in harmless["bytecode"]["imports"]
+        assert shell["bytecode"]["imports"] == ["os"]
+        assert any("attacker.example" in url for url in shell["bytecode"]["urls"])
@@ -0,0 +1,78 @@
+import json
+import os
+
+import pytest
+
+# the worker module builds its dynamo table when it's imported
+os.environ.setdefault("DYNAMO_STATUS_TABLE", "bhakti-status")
+
+import monitoring_consumer
+
+
+def record(message_id, repo, group="bhakti_updates"):
+    return {
+        "messageId": message_id,
+        "body": json.dumps({"id": repo, "lastModified": "2024-01-01T00:00:00.000Z"}),
+        "attributes": {"MessageGroupId": group},
+    }
+
+
+@pytest.fixture
+def consumer(monkeypatch, tmp_path):
+    """Stubs out huggingface and dynamo. Repos listed in consumer.failing blow up in analysis,
+    the rest are recorded in consumer.analyzed in the order they were analyzed."""
+
+    class Consumer:
+        failing = set()
+        analyzed = []
+
+    def fetch_model(msg_body, token):
+        local_file = tmp_path / msg_body["id"].replace("/", "_")
+        local_file.write_bytes(b"")
+        return str(local_file)
+
+    def analyze_message(msg_body, local_file):
+        if msg_body["id"] in Consumer.failing:
+            raise RuntimeError("dynamo said no")
+        Consumer.analyzed.append(msg_body["id"])
+
+    monkeypatch.setattr(monitoring_consumer, "api_token", "hf_token")
+    monkeypatch.setattr(monitoring_consumer, "fetch_model", fetch_model)
+    monkeypatch.setattr(monitoring_consumer, "analyze_message", analyze_message)
+    return Consumer
+
+
+def test_reports_only_the_failed_record(consumer):
+    consumer.failing = {"author/b"}
+    event = {"Records": [record("1", "author/a", "a"), record("2", "author/b", "b"), record("3", "author/c", "c")]}
+
+    response = monitoring_consumer.handler(event, None)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "2"}]}
+    assert consumer.analyzed == ["author/a", "author/c"]
+
+
+def test_failure_fails_the_rest_of_its_message_group(consumer):
+    consumer.failing = {"author/b"}
+    event = {
+        "Records": [
+            record("1", "author/a", "g1"),
+            record("2", "author/b", "g1"),
+            record("3", "author/c", "g2"),
+            record("4", "author/d", "g1"),
+            record("5", "author/e", "g2"),
+        ]
+    }
+
+    response = monitoring_consumer.handler(event, None)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "2"}, {"itemIdentifier": "4"}]}
+    # records behind the failure in g1 aren't analyzed at all, so they can't overtake it
+    assert consumer.analyzed == ["author/a", "author/c", "author/e"]
+
+
+def test_downloads_are_removed(consumer, tmp_path):
+    event = {"Records": [record("1", "author/a"), record("2", "author/b")]}
+
+    assert monitoring_consumer.handler(event, None) == {"batchItemFailures": []}
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,391 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import monitoring_lambda
+
+PAGE_SIZE = 3
+
+
+def model(i, library="keras"):
+    """Higher numbers are modified later."""
+    return {
+        "id": f"author/model-{i}",
+        "lastModified": f"2024-01-01T00:{i // 60:02d}:{i % 60:02d}.000Z",
+        "library": library,
+        "siblings": [{"rfilename": "README.md"}, {"rfilename": "keras_metadata.pb"}],
+    }
+
+
+class Listing(BaseHTTPRequestHandler):
+    """A cursor paged /api/models, newest first, PAGE_SIZE models to a page."""
+
+    def do_GET(self):
+        hub = self.server
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        with hub.lock:
+            hub.requests.append(self.path)
+        models = [m for m in hub.models if m["library"] in query.get("filter", [m["library"]])]
+        models.sort(key=lambda m: m["lastModified"], reverse=True)
+        offset = int(query.get("cursor", ["0"])[0])
+        fields = ["lastModified", "siblings"] if "full" in query else query.get("expand[]", [])
+        page = [
+            {"id": m["id"], **{field: m[field] for field in fields if field in m}}
+            for m in models[offset : offset + PAGE_SIZE]
+        ]
+        body = json.dumps(page).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if offset + PAGE_SIZE < len(models):
+            query["cursor"] = [str(offset + PAGE_SIZE)]
+            self.send_header("Link", f'<{hub.endpoint}{parts.path}?{urlencode(query, doseq=True)}>; rel="next"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Listing)
+    server.endpoint = f"http://127.0.0.1:{server.server_port}"
+    server.models = []
+    server.requests = []
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(monitoring_lambda, "HF_ENDPOINT", server.endpoint)
+    monkeypatch.setattr(monitoring_lambda, "KERAS_LIBRARIES", ["keras", "tf-keras"])
+    monkeypatch.setattr(monitoring_lambda, "LISTING_MODE", "filtered")
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """The status table and working queue, under moto. Returns the queue."""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        dynamodb = boto3.resource("dynamodb")
+        dynamodb.create_table(
+            TableName="bhakti-status",
+            KeySchema=[
+                {"AttributeName": "repo", "KeyType": "HASH"},
+                {"AttributeName": "version", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "repo", "AttributeType": "S"},
+                {"AttributeName": "version", "AttributeType": "S"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        queue = boto3.resource("sqs").create_queue(
+            QueueName="bhakti-test.fifo", Attributes={"FifoQueue": "true"}
+        )
+        monkeypatch.setattr(monitoring_lambda, "DYNAMO_TABLE", "bhakti-status")
+        monkeypatch.setattr(monitoring_lambda, "WORKING_QUEUE", "bhakti-test.fifo")
+        monkeypatch.setattr(monitoring_lambda, "dynamodb", dynamodb)
+        monkeypatch.setattr(monitoring_lambda, "sqs_client", boto3.client("sqs"))
+        monitoring_lambda.get_queue_url.cache_clear()
+        yield queue
+        monitoring_lambda.get_queue_url.cache_clear()
+
+
+class Context:
+    """A lambda context with time for the given number of pages, after which it runs out."""
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get_remaining_time_in_millis(self):
+        self.pages -= 1
+        return 900_000 if self.pages >= 0 else 0
+
+
+def enqueued(queue):
+    ids = []
+    while True:
+        messages = queue.receive_messages(MaxNumberOfMessages=10)
+        if not messages:
+            return ids
+        for message in messages:
+            ids.append(json.loads(message.body)["id"])
+            message.delete()
+
+
+def analyzed(*models):
+    # what the workers leave behind once they're through with the queue
+    table = monitoring_lambda.dynamodb.Table(monitoring_lambda.DYNAMO_TABLE)
+    for m in models:
+        table.put_item(Item={"repo": m["id"], "version": "v0", "modified_date": m["lastModified"]})
+
+
+def ids(*numbers):
+    return [f"author/model-{i}" for i in numbers]
+
+
+def fail_to_send(monkeypatch, repos):
+    """Makes every batch holding one of repos fail to send, for as long as it's in there."""
+    send = monitoring_lambda.send_sqs_batch
+
+    def send_sqs_batch(messages, queue, attempts=3):
+        if any(json.loads(message["MessageBody"])["id"] in repos for message in messages):
+            return 0
+        return send(messages, queue, attempts)
+
+    monkeypatch.setattr(monitoring_lambda, "send_sqs_batch", send_sqs_batch)
+
+
+def test_crawl_resumes_from_its_checkpoint(hub, aws):
+    hub.models = [model(i) for i in range(10)]
+
+    assert monitoring_lambda.crawl("hf_token", Context(pages=2))
+
+    state = monitoring_lambda.get_crawl_state()
+    assert "cursor=6" in state["cursor"]["next_url"]
+    assert "last_modified" not in state
+    assert enqueued(aws) == ids(9, 8, 7, 6, 5, 4)
+
+    hub.requests.clear()
+    assert monitoring_lambda.crawl("hf_token", None)
+
+    # picks up at the page it stopped at rather than starting over
+    assert "cursor=6" in hub.requests[0]
+    assert enqueued(aws) == ids(3, 2, 1, 0)
+    state = monitoring_lambda.get_crawl_state()
+    assert "cursor" not in state
+    assert state["last_modified"] == model(9)["lastModified"]
+
+
+def test_high_water_mark_moves_only_after_a_full_pass(hub, aws):
+    hub.models = [model(i) for i in range(10)]
+    monitoring_lambda.crawl("hf_token", None)
+    analyzed(*hub.models)
+    enqueued(aws)
+    first_mark = monitoring_lambda.get_crawl_state()["last_modified"]
+
+    hub.models += [model(i) for i in range(10, 18)]
+    monitoring_lambda.crawl("hf_token", Context(pages=1))
+
+    state = monitoring_lambda.get_crawl_state()
+    assert state["last_modified"] == first_mark
+    assert state["cursor"]["since"] == first_mark
+    assert state["cursor"]["newest"] == model(17)["lastModified"]
+
+    monitoring_lambda.crawl("hf_token", None)
+
+    assert monitoring_lambda.get_crawl_state()["last_modified"] == model(17)["lastModified"]
+    assert sorted(enqueued(aws)) == sorted(ids(*range(10, 18)))
+
+
+def test_caught_up_crawl_stops_paging(hub, aws):
+    hub.models = [model(i) for i in range(10)]
+    monitoring_lambda.crawl("hf_token", None)
+    analyzed(*hub.models)
+    enqueued(aws)
+
+    hub.models.append(model(10))
+    hub.requests.clear()
+    monitoring_lambda.crawl("hf_token", None)
+
+    assert enqueued(aws) == ids(10)
+    # the first page already reaches back past the mark, so that's the only one fetched
+    assert len([path for path in hub.requests if "filter=keras&" in path]) == 1
+
+
+def test_enqueue_error_leaves_the_checkpoint_at_the_failed_page(hub, aws, monkeypatch):
+    hub.models = [model(i) for i in range(10)]
+    failing = {"author/model-5"}
+    fail_to_send(monkeypatch, failing)
+
+    monitoring_lambda.crawl("hf_token", None)
+
+    state = monitoring_lambda.get_crawl_state()
+    assert "cursor=3" in state["cursor"]["next_url"]
+    assert "last_modified" not in state
+    assert enqueued(aws) == ids(9, 8, 7)
+
+    failing.clear()
+    hub.requests.clear()
+    monitoring_lambda.crawl("hf_token", None)
+
+    assert "cursor=3" in hub.requests[0]
+    assert enqueued(aws) == ids(6, 5, 4, 3, 2, 1, 0)
+    assert monitoring_lambda.get_crawl_state()["last_modified"] == model(9)["lastModified"]
+
+
+def crawl_state_rows():
+    table = monitoring_lambda.dynamodb.Table(monitoring_lambda.DYNAMO_TABLE)
+    items = table.query(
+        KeyConditionExpression="repo = :repo",
+        ExpressionAttributeValues={":repo": monitoring_lambda.CRAWL_STATE_KEY["repo"]},
+    )["Items"]
+    return sorted(item["version"] for item in items)
+
+
+def run_shards(pages_each=None):
+    """Runs shards in process, each with time for pages_each pages. Returns the function to
+    hand fan_out_crawl and the list the shards it was called with are recorded in."""
+    shards = []
+
+    def run_shard(shard):
+        shards.append(shard)
+        return monitoring_lambda.shard_handler(shard, Context(pages_each) if pages_each else None)
+
+    return run_shard, shards
+
+
+def test_pending_pages_are_stored_across_rows(aws):
+    # far more than fit in a single 400KB item
+    pages = [f"https://huggingface.co/api/models?cursor={'x' * 300}{i}" for i in range(2000)]
+
+    monitoring_lambda.save_crawl_state(None, pending_pages=pages)
+
+    assert monitoring_lambda.get_crawl_state()["pending_pages"] == pages
+    assert crawl_state_rows() == ["listing", "pending-0", "pending-1", "pending-2", "pending-3"]
+
+    monitoring_lambda.save_crawl_state(None, pending_pages=pages[:3])
+
+    assert monitoring_lambda.get_crawl_state()["pending_pages"] == pages[:3]
+    assert crawl_state_rows() == ["listing", "pending-0"]
+
+    monitoring_lambda.save_crawl_state("2024-01-01T00:00:00.000Z")
+
+    assert "pending_pages" not in monitoring_lambda.get_crawl_state()
+    assert crawl_state_rows() == ["listing"]
+
+
+def test_fan_out_hands_leftover_pages_out_first(hub, aws, monkeypatch):
+    hub.models = [model(i) for i in range(10)]
+    monkeypatch.setattr(monitoring_lambda, "CRAWL_SHARDS", 2)
+    monkeypatch.setattr(monitoring_lambda, "get_api_token", lambda: "hf_token")
+    run_shard, shards = run_shards(pages_each=1)
+
+    assert monitoring_lambda.fan_out_crawl("hf_token", None, run_shard=run_shard)
+
+    # four pages over two shards, each with time for one of them
+    state = monitoring_lambda.get_crawl_state()
+    leftovers = [shard["pages"][1] for shard in shards]
+    assert sorted(state["pending_pages"]) == sorted(leftovers)
+    assert "last_modified" not in state
+    first_run = enqueued(aws)
+    assert sorted(first_run) == sorted(ids(9, 8, 7, 3, 2, 1))
+    analyzed(*[m for m in hub.models if m["id"] in first_run])
+
+    run_shard, shards = run_shards()
+    monitoring_lambda.fan_out_crawl("hf_token", None, run_shard=run_shard)
+
+    assert shards[0]["pages"][0] in leftovers
+    assert sorted(enqueued(aws)) == sorted(ids(6, 5, 4, 0))
+    state = monitoring_lambda.get_crawl_state()
+    assert "pending_pages" not in state
+    assert state["last_modified"] == model(9)["lastModified"]
+
+
+def test_fan_out_enqueue_error_leaves_the_page_pending(hub, aws, monkeypatch):
+    hub.models = [model(i) for i in range(10)]
+    monkeypatch.setattr(monitoring_lambda, "CRAWL_SHARDS", 1)
+    monkeypatch.setattr(monitoring_lambda, "get_api_token", lambda: "hf_token")
+    fail_to_send(monkeypatch, {"author/model-5"})
+    run_shard, shards = run_shards()
+
+    monitoring_lambda.fan_out_crawl("hf_token", None, run_shard=run_shard)
+
+    state = monitoring_lambda.get_crawl_state()
+    # the page that failed and every one after it
+    assert state["pending_pages"] == shards[0]["pages"][1:]
+    assert "last_modified" not in state
+    assert enqueued(aws) == ids(9, 8, 7)
+
+
+@pytest.mark.parametrize(
+    "depth, running, cap, expected",
+    [
+        (0, 0, 4, 0),
+        (1, 0, 4, 1),
+        (1200, 0, 4, 3),
+        (5000, 0, 4, 4),
+        (1200, 2, 4, 1),
+        (1200, 5, 4, 0),
+        (5000, 0, 0, 0),
+    ],
+)
+def test_workers_to_launch(depth, running, cap, expected):
+    assert monitoring_lambda.workers_to_launch(depth, running, per_worker=500, cap=cap) == expected
+
+
+@pytest.fixture
+def fleet(aws, monkeypatch):
+    """Two messages per worker, at most four workers. Returns the MaxCount of every
+    RunInstances call, and starts workers outside the lambda with fleet.start(count)."""
+    profile = boto3.client("iam").create_instance_profile(InstanceProfileName="bhakti-worker")
+    monkeypatch.setattr(monitoring_lambda, "INSTANCE_PROFILE_ARN", profile["InstanceProfile"]["Arn"])
+    monkeypatch.setattr(monitoring_lambda, "MESSAGES_PER_WORKER", 2)
+    monkeypatch.setattr(monitoring_lambda, "MAX_WORKERS", 4)
+
+    class Fleet(list):
+        def start(self, count, tags=(monitoring_lambda.WORKER_TAG,)):
+            instances = boto3.client("ec2").run_instances(
+                ImageId=monitoring_lambda.EC2_AMI,
+                MinCount=count,
+                MaxCount=count,
+                TagSpecifications=[{"ResourceType": "instance", "Tags": list(tags)}] if tags else [],
+            )["Instances"]
+            return [instance["InstanceId"] for instance in instances]
+
+    launches = Fleet()
+    # the lambda builds a new ec2 client per call, so listen on the session they come from
+    events = boto3.DEFAULT_SESSION.events
+    record = lambda params, **kwargs: launches.append(params["MaxCount"])
+    events.register("provide-client-params.ec2.RunInstances", record, unique_id="bhakti-fleet")
+    yield launches
+    events.unregister("provide-client-params.ec2.RunInstances", unique_id="bhakti-fleet")
+
+
+def queue_up(queue, count):
+    for i in range(count):
+        queue.send_message(MessageBody=str(i), MessageGroupId="g", MessageDeduplicationId=str(i))
+
+
+def test_schedule_workers_tops_up_the_running_fleet(aws, fleet):
+    queue_up(aws, 5)
+    fleet.start(1)
+    # neither of these is a worker that's still draining the queue
+    fleet.start(1, tags=())
+    boto3.client("ec2").terminate_instances(InstanceIds=fleet.start(1))
+    fleet.clear()
+
+    assert monitoring_lambda.running_workers() == 1
+    assert monitoring_lambda.schedule_workers() == 2
+    assert fleet == [2]
+
+
+def test_schedule_workers_is_capped(aws, fleet):
+    queue_up(aws, 50)
+    fleet.start(1)
+    fleet.clear()
+
+    assert monitoring_lambda.schedule_workers() == 3
+    assert fleet == [3]
+
+
+def test_schedule_workers_counts_models_just_sent(aws, fleet):
+    assert monitoring_lambda.schedule_workers() == 0
+    assert monitoring_lambda.schedule_workers(new_models=True) == 1
+    assert fleet == [1]
+
+
+def test_schedule_workers_with_no_workers_allowed(aws, fleet, monkeypatch):
+    monkeypatch.setattr(monitoring_lambda, "MAX_WORKERS", 0)
+    queue_up(aws, 50)
+
+    assert monitoring_lambda.schedule_workers(new_models=True) == 0
+    assert fleet == []
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import time
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# the worker module builds its dynamo table when it's imported
+os.environ.setdefault("DYNAMO_STATUS_TABLE", "bhakti-status")
+
+import monitoring_ec2_check
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        yield boto3.resource("sqs").create_queue(QueueName="bhakti-test")
+
+
+def send(queue, *repos):
+    for repo in repos:
+        queue.send_message(MessageBody=json.dumps({"id": repo, "lastModified": "2024-01-01T00:00:00.000Z"}))
+
+
+def receive(queue, visibility=1):
+    return queue.receive_messages(MaxNumberOfMessages=10, VisibilityTimeout=visibility)
+
+
+def visible(queue):
+    # receiving hides what it returns again, for long enough that it doesn't matter here
+    return sorted(json.loads(message.body)["id"] for message in receive(queue, visibility=30))
+
+
+def count_calls(queue, operation):
+    calls = []
+    queue.meta.client.meta.events.register(
+        f"provide-client-params.sqs.{operation}", lambda params, **kwargs: calls.append(params)
+    )
+    return calls
+
+
+def test_heartbeat_extends_until_released(queue):
+    send(queue, "author/kept", "author/released")
+    messages = {json.loads(message.body)["id"]: message for message in receive(queue)}
+    heartbeat = monitoring_ec2_check.VisibilityHeartbeat(queue, interval=0.2, timeout=30, max_age=60)
+    try:
+        heartbeat.track(messages["author/kept"])
+        heartbeat.track(messages["author/released"])
+        heartbeat.release(messages["author/released"])
+        time.sleep(1.5)
+        assert visible(queue) == ["author/released"]
+    finally:
+        heartbeat.stop()
+
+
+def test_heartbeat_gives_up_after_max_age(queue, caplog):
+    send(queue, "author/stuck")
+    (message,) = receive(queue)
+    heartbeat = monitoring_ec2_check.VisibilityHeartbeat(queue, interval=0.2, timeout=1, max_age=0.5)
+    try:
+        heartbeat.track(message)
+        time.sleep(2.5)
+        assert heartbeat.in_flight == {}
+        assert visible(queue) == ["author/stuck"]
+        assert "no longer extending it" in caplog.text
+    finally:
+        heartbeat.stop()
+
+
+def test_heartbeat_extends_in_batches_of_ten(queue):
+    send(queue, *[f"author/model-{i}" for i in range(23)])
+    messages = []
+    while len(messages) < 23:
+        messages += receive(queue, visibility=30)
+    calls = count_calls(queue, "ChangeMessageVisibilityBatch")
+    heartbeat = monitoring_ec2_check.VisibilityHeartbeat(queue, interval=0.2, timeout=30, max_age=60)
+    try:
+        for message in messages:
+            heartbeat.track(message)
+        time.sleep(0.3)
+    finally:
+        heartbeat.stop()
+    assert [len(call["Entries"]) for call in calls[:3]] == [10, 10, 3]
+
+
+def test_flush_deletes_in_batches_of_ten(queue):
+    send(queue, *[f"author/model-{i}" for i in range(23)])
+    messages = []
+    while len(messages) < 23:
+        messages += receive(queue, visibility=1)
+    calls = count_calls(queue, "DeleteMessageBatch")
+
+    monitoring_ec2_check.flush_deletes(queue, messages)
+
+    assert [len(call["Entries"]) for call in calls] == [10, 10, 3]
+    assert messages == []
+    time.sleep(1.5)
+    assert visible(queue) == []
+
+
+def test_flush_deletes_logs_partial_failures(queue, caplog):
+    send(queue, "author/a", "author/b")
+    first, second = sorted(receive(queue), key=lambda message: message.body)
+    # as if the message had been redelivered to another worker since we received it
+    stale = queue.Message("stale-receipt-handle")
+    stale.meta.data = {"MessageId": second.message_id}
+
+    monitoring_ec2_check.flush_deletes(queue, [first, stale])
+
+    assert f"Could not delete message {second.message_id}" in caplog.text
+    time.sleep(1.5)
+    # the one that couldn't be deleted comes back, the other one is gone
+    assert visible(queue) == ["author/b"]
+
+
+def test_main_deletes_only_what_was_stored(queue, monkeypatch):
+    repos = [f"author/model-{i}" for i in range(12)]
+    send(queue, *repos)
+    analyzed = []
+
+    def fetch_model(msg_body, token):
+        # an already analyzed revision comes back as None and is deleted without analysis
+        return None if msg_body["id"] == "author/model-0" else f"/tmp/{msg_body['id']}"
+
+    def analyze_message(msg_body, local_file):
+        if msg_body["id"] == "author/model-1":
+            raise RuntimeError("dynamo said no")
+        analyzed.append(msg_body["id"])
+
+    monkeypatch.setattr(monitoring_ec2_check, "SQS_QUEUE", "bhakti-test")
+    monkeypatch.setattr(monitoring_ec2_check, "RECEIVE_WAIT_SECONDS", 0)
+    monkeypatch.setattr(monitoring_ec2_check, "get_api_token", lambda: "hf_token")
+    monkeypatch.setattr(monitoring_ec2_check, "fetch_model", fetch_model)
+    monkeypatch.setattr(monitoring_ec2_check, "analyze_message", analyze_message)
+    monkeypatch.setattr(monitoring_ec2_check.subprocess, "call", lambda *args: 0)
+    monkeypatch.setattr(logging, "basicConfig", lambda **kwargs: None)
+
+    monitoring_ec2_check.main()
+
+    assert sorted(analyzed) == sorted(repos[2:])
+    queue.reload()
+    # the failed one is still on the queue, waiting out its visibility timeout
+    assert queue.attributes["ApproximateNumberOfMessages"] == "0"
+    assert queue.attributes["ApproximateNumberOfMessagesNotVisible"] == "1"
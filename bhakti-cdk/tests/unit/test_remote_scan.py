@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+import checkModel
+import hf_blobs
+from local_hub import serve_stub_hub, stub_repos
+from verdict_cache import CACHE_ENV, CACHE_TABLE_ENV
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    servers = []
+
+    def start(repos, flaky=0.0):
+        server = serve_stub_hub(latency=0.02, flaky=flaky)
+        server.repos = stub_repos(repos)
+        servers.append(server)
+        endpoint = f"http://127.0.0.1:{server.server_port}"
+        # both read HF_ENDPOINT when they're imported
+        monkeypatch.setattr(checkModel, "HF_ENDPOINT", endpoint)
+        monkeypatch.setattr(hf_blobs, "HF_ENDPOINT", endpoint)
+        # a cached verdict would skip the downloads
+        monkeypatch.setenv(CACHE_ENV, "")
+        monkeypatch.setenv(CACHE_TABLE_ENV, "")
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def scan(server, tmp_path, **options):
+    results_file = tmp_path / "results.jsonl"
+    count = checkModel.remote_scan(
+        server.repos,
+        str(results_file),
+        directory=str(tmp_path / "downloads"),
+        clean_up=True,
+        workers=2,
+        backoff=0.01,
+        **options,
+    )
+    results = {result["id"]: result for result in map(json.loads, results_file.read_text().splitlines())}
+    assert count == len(results) == len(server.repos)
+    return results
+
+
+def assert_verdicts(server, results):
+    for repo_id, (body, private) in server.repos.items():
+        if private:
+            assert results[repo_id] == {"id": repo_id, "private": True}
+        else:
+            assert "error" not in results[repo_id], repo_id
+            assert results[repo_id]["contains_code"] is (b"lambda" in body), repo_id
+
+
+def test_remote_scan_verdicts(hub, tmp_path):
+    server = hub(20)
+    results = scan(server, tmp_path, concurrency=8)
+
+    assert_verdicts(server, results)
+    assert sum(result.get("private", False) for result in results.values()) == 2
+    # the api lookup and the download of every public repo, the lookup of every private one
+    assert server.requests == {"GET": 2 * 18 + 2}
+
+
+def test_remote_scan_retries_throttling(hub, tmp_path):
+    server = hub(20, flaky=0.3)
+    results = scan(server, tmp_path, concurrency=8, attempts=10)
+
+    assert server.requests["throttled"] > 0
+    assert server.requests["GET"] == 2 * 18 + 2 + server.requests["throttled"]
+    assert_verdicts(server, results)
+
+
+def test_remote_scan_keeps_to_the_per_host_limit(hub, tmp_path):
+    server = hub(30)
+    results = scan(server, tmp_path, concurrency=16, per_host=3)
+
+    assert_verdicts(server, results)
+    assert server.peak == 3
@@ -0,0 +1,220 @@
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# the worker module builds its dynamo table when it's imported
+os.environ.setdefault("DYNAMO_STATUS_TABLE", "bhakti-status")
+
+import monitoring_ec2_check
+
+REPO = "author/model"
+
+
+@pytest.fixture
+def status(monkeypatch):
+    """A status table shaped like the stack's, which update_dynamo writes to."""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        dynamodb = boto3.resource("dynamodb")
+        table = dynamodb.create_table(
+            TableName=monitoring_ec2_check.DYNAMO_STATUS_TABLE,
+            KeySchema=[
+                {"AttributeName": "repo", "KeyType": "HASH"},
+                {"AttributeName": "version", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "repo", "AttributeType": "S"},
+                {"AttributeName": "version", "AttributeType": "S"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        monkeypatch.setattr(monitoring_ec2_check, "dynamodb", dynamodb)
+        monkeypatch.setattr(monitoring_ec2_check, "status_table", table)
+        yield table
+
+
+def analysis(modified_date, **fields):
+    return {"repo": REPO, "modified_date": modified_date, "keras_filenam": "keras_metadata.pb", **fields}
+
+
+def rows(table):
+    items = table.query(
+        KeyConditionExpression="repo = :repo", ExpressionAttributeValues={":repo": REPO}
+    )["Items"]
+    return {item["version"]: item for item in items}
+
+
+def test_first_write_is_v0(status):
+    monitoring_ec2_check.update_dynamo(analysis("2024-01-01", contains_code=True))
+
+    stored = rows(status)
+    assert list(stored) == ["v0"]
+    assert stored["v0"]["version_count"] == 1
+    assert stored["v0"]["contains_code"] is True
+
+
+def test_replaced_analyses_are_archived_in_order(status):
+    for month in range(1, 5):
+        monitoring_ec2_check.update_dynamo(analysis(f"2024-0{month}-01"))
+
+    stored = rows(status)
+    assert {version: row["modified_date"] for version, row in stored.items()} == {
+        "v0": "2024-04-01",
+        "v1": "2024-01-01",
+        "v2": "2024-02-01",
+        "v3": "2024-03-01",
+    }
+    assert stored["v0"]["version_count"] == 4
+
+
+def test_legacy_rows_are_counted(status):
+    # written before v0 carried a version count
+    status.put_item(Item={"repo": REPO, "version": "v0", "modified_date": "2023-06-01"})
+    status.put_item(Item={"repo": REPO, "version": "v1", "modified_date": "2023-01-01"})
+
+    monitoring_ec2_check.update_dynamo(analysis("2024-01-01"))
+
+    stored = rows(status)
+    assert stored["v2"]["modified_date"] == "2023-06-01"
+    assert stored["v1"]["modified_date"] == "2023-01-01"
+    assert stored["v0"]["modified_date"] == "2024-01-01"
+    assert stored["v0"]["version_count"] == 3
+
+
+def test_same_file_only_moves_v0_forward(status):
+    monitoring_ec2_check.update_dynamo(analysis("2024-01-01", sha256="abc", contains_code=True))
+    monitoring_ec2_check.update_dynamo(analysis("2024-02-01", sha256="abc", contains_code=True))
+
+    stored = rows(status)
+    assert list(stored) == ["v0"]
+    assert stored["v0"]["modified_date"] == "2024-02-01"
+    assert stored["v0"]["version_count"] == 1
+
+
+def test_older_analysis_is_dropped(status):
+    monitoring_ec2_check.update_dynamo(analysis("2024-02-01", contains_code=True))
+    monitoring_ec2_check.update_dynamo(analysis("2024-01-01", contains_code=False))
+
+    stored = rows(status)
+    assert list(stored) == ["v0"]
+    assert stored["v0"]["modified_date"] == "2024-02-01"
+    assert stored["v0"]["contains_code"] is True
+
+
+def interleave(table, *analyses):
+    """Has another worker store analyses right before each of our transactions goes out.
+    Returns the list our transactions are recorded in."""
+    other_worker = boto3.resource("dynamodb").Table(table.name)
+    queued = list(analyses)
+    transactions = []
+
+    def race(params, **kwargs):
+        transactions.append(params)
+        if queued:
+            current = other_worker.get_item(Key={"repo": REPO, "version": "v0"})["Item"]
+            versions = int(current["version_count"])
+            other_worker.put_item(Item={**current, "version": f"v{versions}"})
+            other_worker.put_item(Item={**queued.pop(0), "version": "v0", "version_count": versions + 1})
+
+    monitoring_ec2_check.dynamodb.meta.client.meta.events.register(
+        "provide-client-params.dynamodb.TransactWriteItems", race
+    )
+    return transactions
+
+
+def test_conflicting_write_is_retried(status):
+    monitoring_ec2_check.update_dynamo(analysis("2024-01-01"))
+    transactions = interleave(status, analysis("2024-02-01"))
+
+    monitoring_ec2_check.update_dynamo(analysis("2024-03-01"))
+
+    assert len(transactions) == 2
+    stored = rows(status)
+    assert {version: row["modified_date"] for version, row in stored.items()} == {
+        "v0": "2024-03-01",
+        "v1": "2024-01-01",
+        "v2": "2024-02-01",
+    }
+    assert stored["v0"]["version_count"] == 3
+
+
+def test_conflicting_newer_write_wins(status):
+    monitoring_ec2_check.update_dynamo(analysis("2024-01-01"))
+    transactions = interleave(status, analysis("2024-04-01"))
+
+    monitoring_ec2_check.update_dynamo(analysis("2024-03-01"))
+
+    assert len(transactions) == 1
+    assert {version: row["modified_date"] for version, row in rows(status).items()} == {
+        "v0": "2024-04-01",
+        "v1": "2024-01-01",
+    }
+
+
+def test_gives_up_after_repeated_conflicts(status):
+    monitoring_ec2_check.update_dynamo(analysis("2024-01-01"))
+    interleave(status, *[analysis(f"2024-02-0{day}") for day in range(1, 4)])
+
+    with pytest.raises(RuntimeError):
+        monitoring_ec2_check.update_dynamo(analysis("2024-03-01"), attempts=3)
+
+
+SHA256 = "ab" * 32
+
+
+def message(**fields):
+    sibling = {"rfilename": "keras_metadata.pb", "lfs": {"sha256": SHA256}}
+    return {
+        "id": REPO,
+        "lastModified": "2024-02-01",
+        "keras_filename": "keras_metadata.pb",
+        "siblings": [sibling],
+        **fields,
+    }
+
+
+class FakeCache:
+    def __init__(self, verdict):
+        self.verdict = verdict
+
+    def get_file(self, **blob):
+        return self.verdict
+
+
+def test_failed_analysis_has_no_digests(tmp_path, monkeypatch):
+    model = tmp_path / "keras_metadata.pb"
+    model.write_bytes(b"not a saved model")
+
+    def broken(path):
+        raise ValueError("truncated")
+
+    monkeypatch.setattr(monitoring_ec2_check, "get_verdict_cache", lambda: None)
+    monkeypatch.setattr(monitoring_ec2_check, "scan_nodes", broken)
+
+    assert monitoring_ec2_check.check_for_code(str(model)) == {}
+
+
+def test_incomplete_v0_is_not_reused(status, monkeypatch):
+    monkeypatch.setattr(monitoring_ec2_check, "get_verdict_cache", lambda: None)
+    # what a failed analysis used to leave behind
+    monitoring_ec2_check.update_dynamo(analysis("2024-01-01", sha256=SHA256))
+    current = monitoring_ec2_check.current_analysis(message())
+
+    assert monitoring_ec2_check.known_verdict(message(), "", current) is None
+
+    monitoring_ec2_check.update_dynamo(analysis("2024-01-15", sha256=SHA256, contains_code=False))
+    current = monitoring_ec2_check.current_analysis(message())
+
+    assert monitoring_ec2_check.known_verdict(message(), "", current)["contains_code"] is False
+
+
+def test_incomplete_cached_verdict_is_not_reused(status, monkeypatch):
+    monkeypatch.setattr(monitoring_ec2_check, "get_verdict_cache", lambda: FakeCache({"sha256": SHA256}))
+    assert monitoring_ec2_check.known_verdict(message(), "", None) is None
+
+    verdict = {"sha256": SHA256, "contains_code": True}
+    monkeypatch.setattr(monitoring_ec2_check, "get_verdict_cache", lambda: FakeCache(verdict))
+    assert monitoring_ec2_check.known_verdict(message(), "", None) == verdict
@@ -0,0 +1,50 @@
+import random
+
+import pytest
+
+import yara_rules
+
+RULES = r"""
+rule Overlapping
+{
+    strings:
+        $lambda = "lambda"
+        $lambda_layer = "lambda_layer"
+        $layer = "layer"
+        $ambda = "ambda" fullword
+    condition:
+        any of them
+}
+"""
+
+
+def test_scanner_finds_overlapping_literals():
+    rules = yara_rules.RuleSet(yara_rules.parse_rules(RULES))
+
+    assert isinstance(rules.scanner, yara_rules.LiteralScanner)
+    assert rules.found_strings(b"a lambda_layer") == {(0, "$lambda"), (0, "$lambda_layer"), (0, "$layer")}
+    # fullword is judged at each occurrence, not just the first
+    assert (0, "$ambda") in rules.found_strings(b"lambda ambda")
+    assert (0, "$ambda") not in rules.found_strings(b"lambda")
+
+
+def test_scanner_agrees_with_automaton():
+    generator = random.Random(0)
+    for _ in range(200):
+        patterns = {
+            bytes(generator.choice(b"ab") for _ in range(generator.randint(1, 4)))
+            for _ in range(generator.randint(1, 6))
+        }
+        automaton, scanner = yara_rules.AhoCorasick(), yara_rules.LiteralScanner()
+        for value, pattern in enumerate(sorted(patterns)):
+            automaton.add(pattern, value)
+            scanner.add(pattern, value)
+        automaton.build()
+        scanner.build()
+        buf = bytes(generator.choice(b"abc") for _ in range(60))
+        assert sorted(scanner.search(buf, 5, 50)) == sorted(automaton.search(buf, 5, 50))
+
+
+def test_empty_strings_are_refused():
+    with pytest.raises(yara_rules.RuleError):
+        yara_rules.parse_rules('rule Empty { strings: $a = "" condition: $a }')